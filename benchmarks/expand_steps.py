@@ -0,0 +1,78 @@
+#!/usr/bin/python3.4
+"""
+This module is a part of the virAnnot module
+Micro-benchmark of the driver: time and peak memory needed to read a
+map file and expand the arguments of every step for many samples.
+No module is created and no command is launched.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+# to allow code to work with Python 2 and 3
+from __future__ import print_function   # print is a function in python3
+from __future__ import unicode_literals # avoid adding "u" to each string
+from __future__ import division # avoid writing float(x) when dividing by x
+
+import argparse
+import io
+import os
+import sys
+import time
+import tracemalloc
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'launchers'))
+import virAnnot
+
+
+def main():
+	options = _set_options()
+	s = yaml.safe_load(open(options.step))
+	map_file = _make_map(options.samples, options.libraries)
+	start = time.time()
+	m = virAnnot.read_map_file(io.StringIO(map_file))
+	read_time = time.time() - start
+	modules = _expand(s, m)
+	total_time = time.time() - start
+	del m, modules
+	# second pass for the memory, tracemalloc slows the expansion down
+	tracemalloc.start()
+	modules = _expand(s, virAnnot.read_map_file(io.StringIO(map_file)))
+	current, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	print('samples\t' + str(options.samples))
+	print('steps\t' + str(len(s)))
+	print('modules\t' + str(len(modules)))
+	print('read_map_s\t' + str(round(read_time, 3)))
+	print('expand_s\t' + str(round(total_time, 3)))
+	print('peak_mem_mb\t' + str(round(peak / 1024 / 1024, 1)))
+
+
+def _expand(s, m):
+	"""
+	Arguments of every module of every step, kept in memory as the driver does.
+	"""
+	modules = []
+	for s_n in s:
+		modules.extend(virAnnot._step_args(s_n, s, m, {}, s_n.split('_')[0]))
+	return modules
+
+
+def _make_map(n_samples, n_libraries):
+	lines = ['#SampleID\tmid\tcommon\tfile1\tfile2\tlibrary']
+	for i in range(0, n_samples):
+		lib = 'lib' + str(i % n_libraries)
+		lines.append('\t'.join(['s' + str(i), 'ACGTACGT', 'TGTGTTGGGTGTGTTTGG', lib + '.R1.fastq', lib + '.R2.fastq', lib]))
+	return '\n'.join(lines) + '\n'
+
+
+def _set_options():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-s', '--step', help='The step file.', action='store', type=str,
+		default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples', 'step.yaml'))
+	parser.add_argument('-n', '--samples', help='Number of samples in the generated map.', action='store', type=int, default=10000)
+	parser.add_argument('-l', '--libraries', help='Number of libraries in the generated map.', action='store', type=int, default=100)
+	args = parser.parse_args()
+	return args
+
+
+if __name__ == "__main__":
+	main()
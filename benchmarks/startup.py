@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+"""
+This module is a part of the virAnnot module
+Startup benchmark of the driver: import virAnnot.py and resolve every
+launcher class under python -X importtime (python >= 3.7), the launchers
+being timed around their resolution.
+Exits with 1 when a heavy dependency is imported at startup or when the
+cumulative import time is above --max_ms, to be kept as a regression check.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+# to allow code to work with Python 2 and 3
+from __future__ import print_function   # print is a function in python3
+from __future__ import unicode_literals # avoid adding "u" to each string
+from __future__ import division # avoid writing float(x) when dividing by x
+
+import argparse
+import glob
+import os
+import re
+import subprocess
+import sys
+
+LAUNCHERS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'launchers')
+# only imported in the code paths using them
+HEAVY = ['Bio', 'matplotlib', 'lxml', 'numpy', 'pandas', 'ete3']
+
+
+def main():
+	options = _set_options()
+	if sys.version_info < (3, 7):
+		sys.exit('-X importtime needs python 3.7 or later.')
+	best = None
+	for i in range(0, options.repeat):
+		times = _import_times(_launcher_names())
+		if best is None or times['virAnnot'] + times['launchers'] < best['virAnnot'] + best['launchers']:
+			best = times
+	print('virAnnot_ms\t' + str(round(best['virAnnot'] / 1000, 1)))
+	print('launchers_ms\t' + str(round(best['launchers'] / 1000, 1)))
+	total = (best['virAnnot'] + best['launchers']) / 1000
+	print('total_ms\t' + str(round(total, 1)))
+	for name in sorted(best['modules'], key=lambda k: -best['modules'][k])[0:options.top]:
+		print(name + "\t" + str(round(best['modules'][name] / 1000, 1)))
+	heavy = [m for m in best['modules'] if m.split('.')[0] in HEAVY]
+	if heavy:
+		print('heavy modules imported at startup: ' + ', '.join(sorted(heavy)))
+		sys.exit(1)
+	if options.max_ms is not None and total > options.max_ms:
+		print('startup above ' + str(options.max_ms) + ' ms')
+		sys.exit(1)
+
+
+def _launcher_names():
+	names = []
+	for f in sorted(glob.glob(LAUNCHERS + '/*.py')):
+		name = os.path.basename(f)[:-3]
+		if re.search(r'^class ' + name + r'\b', open(f).read(), re.M):
+			names.append(name)
+	return names
+
+
+def _import_times(names):
+	"""
+	Cumulative import time (us) of virAnnot and of the launchers
+	it resolves, and the self time of every imported module.
+	The launchers are imported by importlib, not reported as top level
+	imports by -X importtime: their resolution is timed in the child.
+	"""
+	code = 'import sys, time; sys.path.insert(0, ' + repr(LAUNCHERS) + '); import virAnnot\n'
+	code += 'start = time.perf_counter()\n'
+	code += 'for name in ' + repr(names) + ':\n\tvirAnnot._module_class(name)\n'
+	code += 'sys.stderr.write("#launchers " + str(int((time.perf_counter() - start) * 1e6)) + "\\n")\n'
+	pipes = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	stderr = pipes.communicate()[1].decode('utf-8')
+	if pipes.returncode != 0:
+		sys.exit(stderr)
+	times = {'virAnnot': 0, 'launchers': 0, 'modules': {}}
+	for line in stderr.splitlines():
+		if line.startswith('#launchers '):
+			times['launchers'] = int(line.split()[1])
+			continue
+		m = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', line)
+		if m is None:
+			continue
+		times['modules'][m.group(4)] = int(m.group(1))
+		if len(m.group(3)) == 1 and m.group(4) == 'virAnnot':
+			times['virAnnot'] = int(m.group(2))
+	return times
+
+
+def _set_options():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-r', '--repeat', help='Number of runs, the fastest is kept.', action='store', type=int, default=5)
+	parser.add_argument('-t', '--top', help='Number of the slowest modules to print.', action='store', type=int, default=10)
+	parser.add_argument('--max_ms', help='Fail above this cumulative import time.', action='store', type=float, default=None)
+	args = parser.parse_args()
+	return args
+
+
+if __name__ == "__main__":
+	main()
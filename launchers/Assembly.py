@@ -6,7 +6,6 @@ from __future__ import division # avoid writing float(x) when dividing by x
 import os.path
 import logging as log
 import sys
-from Bio import SeqIO
 
 class Assembly:
 	"""
@@ -113,6 +112,7 @@ class Assembly:
 		f.close()
 
 		# retireve sequence 
+		from Bio import SeqIO
 		fasta_seq = SeqIO.parse(open(self.ising), 'fasta')
 		singletons_file = self.wd + '/' + self.sample + '_newbler/' + self.sample + '_newbler.singletons.fa'
 		with open(singletons_file, "w") as out_file:
@@ -11,8 +11,9 @@ from __future__ import division # avoid writing float(x) when dividing by x
 
 import os.path
 import logging as log
-import random
-import string
+import hashlib
+from transport import get_transport, upload, store_dir, content_hash, link_stored
+import detached
 
 class Blast:
 
@@ -29,43 +30,61 @@ class Blast:
         #
         # Send contig files and scripts to cluster to execute command
         #
+        self.queries, self.outs = Blast.query_files(self)
+        # outputs named for blast_launch.py, with compress they come back gzipped
+        self.remote_outs = []
+        for directory, name in self.outs:
+            if self.server == 'enki':
+                if getattr(self, 'pool', None):
+                    name = directory + '/' + name
+            elif self.compress and not name.endswith('.gz'):
+                name += '.gz'
+            self.remote_outs.append(name)
+        if self.server != 'enki':
+            # queries are kept on the server by content, sent once for all the steps
+            store = store_dir(self.params, self.server)
+            self.stored = dict([(q, store + '/' + content_hash(q)) for q in self.queries])
         ssh_cmd = self.get_exec_script()
         if self.server != 'enki':
-            cmd = 'scp ' + self.contigs + ' ' + self.params['servers'][self.server]['username'] + '@' + self.params['servers'][self.server]['adress']
-            cmd += ':' + self.params['servers'][self.server]['scratch']
+            self.transport = get_transport(self.params, self.server, self.compress != '')
+            self.uploads = list(self.queries)
+            if self.server == 'genouest':
+                self.uploads.append(self.genouest_cmd_file)
+            cmd = upload(self.transport, self.uploads, self.stored)
             log.debug(cmd)
             self.cmd.append(cmd)
-            if self.server == 'genouest':
-                cmd = 'scp ' + self.genouest_cmd_file + ' ' + self.params['servers'][self.server]['username']
-                cmd += '@' + self.params['servers'][self.server]['adress']
-                cmd += ':' + self.params['servers'][self.server]['scratch']
-                log.debug(cmd)
-                self.cmd.append(cmd)
             fw = open(self.remote_cmd_file, mode='w')
             fw.write(ssh_cmd)
             fw.close()
-            if self.server != 'curta':
-                cmd = 'ssh ' + self.params['servers'][self.server]['username'] + '@' + self.params['servers'][self.server]['adress']
-                cmd += ' \'bash -s\' < ' + self.remote_cmd_file
-                log.debug(cmd)
-                self.cmd.append(cmd)
-                cmd = 'scp ' + self.params['servers'][self.server]['username'] + '@' + self.params['servers'][self.server]['adress'] + ':'
-                cmd += self.params['servers'][self.server]['scratch'] + '/' + self.out_dir + '/' + os.path.basename(self.out) + ' ' + self.wd
-                log.debug(cmd)
-                self.cmd.append(cmd)
-            else:
-                cmd = 'ssh ' + self.params['servers'][self.server]['username'] + '@' + self.params['servers'][self.server]['adress']
-                cmd += ' \'bash -s\' < ' + self.remote_cmd_file
-                log.debug(cmd)
-                self.cmd.append(cmd)
-                cmd = 'scp ' + self.params['servers'][self.server]['username'] + '@' + self.params['servers'][self.server]['adress']
-                cmd += ':' + self.params['servers'][self.server]['scratch'] + '/' + self.out_dir + '/' + os.path.basename(self.out) + ' ' + self.wd
+            fetch = []
+            for (directory, name), remote_out in zip(self.outs, self.remote_outs):
+                fetch.append(self.transport.fetch(self.out_dir + '/' + remote_out, directory))
+                if remote_out != name:
+                    fetch.append('gzip -df ' + directory + '/' + remote_out)
+            cmd = self.transport.run(self.remote_cmd_file)
+            if self.detach:
+                # the results are fetched by virAnnot.py -n collect
+                cmd = detached.record(cmd, self.server, self.out_dir, fetch)
+                fetch = []
+            log.debug(cmd)
+            self.cmd.append(cmd)
+            for cmd in fetch:
                 log.debug(cmd)
                 self.cmd.append(cmd)
         elif self.server == 'enki':
             self.cmd.append(ssh_cmd)
 
 
+    def query_files(self):
+        #
+        # Contigs searched by the job and (directory, name) of their outputs:
+        # the ones of the sample, or of every sample of a pool
+        #
+        if getattr(self, 'pool', None):
+            return [p[1] for p in self.pool], [os.path.split(p[2]) for p in self.pool]
+        return [self.contigs], [(self.wd, os.path.basename(self.out))]
+
+
     def get_exec_script(self):
         #
         # Set cluster environment and launch blast_launch.py
@@ -87,28 +106,39 @@ class Blast:
             ssh_cmd += 'echo "source not found."' + "\n"
             ssh_cmd += 'fi' + "\n"
             ssh_cmd += 'cd ' + self.params['servers'][self.server]['scratch'] + "\n"
-            ssh_cmd += 'mkdir ' + self.params['servers'][self.server]['scratch'] + '/' + self.out_dir + "\n"
-            ssh_cmd += 'mv ' + self.params['servers'][self.server]['scratch'] + '/' + os.path.basename(self.contigs) + ' ' + self.out_dir + "\n"
+            # the directory of the same sample and step is reused, files of a previous run are removed
+            ssh_cmd += 'rm -rf ' + self.params['servers'][self.server]['scratch'] + '/' + self.out_dir + "\n"
+            ssh_cmd += 'mkdir -p ' + self.params['servers'][self.server]['scratch'] + '/' + self.out_dir + "\n"
+            ssh_cmd += link_stored(self.queries, self.stored, self.out_dir)
             if self.server == 'genouest':
                 ssh_cmd += 'mv ' + self.params['servers'][self.server]['scratch'] + '/' + os.path.basename(self.genouest_cmd_file) + ' ' + self.out_dir + "\n"
             ssh_cmd += 'cd ' + self.params['servers'][self.server]['scratch'] + '/' + self.out_dir + "\n"
 
         if self.server == 'genouest':
             self.create_genouest_script()
-            ssh_cmd += 'sbatch ' + self.params['servers'][self.server]['scratch'] + '/' + self.out_dir
+            if self.detach:
+                ssh_cmd += 'rm -f ' + detached.EXIT_FILE + "\n"
+                ssh_cmd += 'sbatch --parsable '
+            else:
+                ssh_cmd += 'sbatch '
+            ssh_cmd += self.params['servers'][self.server]['scratch'] + '/' + self.out_dir
             ssh_cmd += '/' + os.path.basename(self.genouest_cmd_file)
         else:
-            if self.server == "genologin":
-                ssh_cmd += 'sbatch '
-            ssh_cmd += 'blast_launch.py -c ' + self.server + ' -n ' + self.num_chunk + ' --n_cpu 8 --tc ' + self.tc
-            ssh_cmd += ' -d ' + self.params['servers'][self.server]['db'][self.db]
+            blast_cmd = 'blast_launch.py -c ' + self.server + self.num_chunk + ' --n_cpu 8 --tc ' + self.tc
+            blast_cmd += ' -d ' + self.params['servers'][self.server]['db'][self.db]
             if self.server != 'enki':
-                ssh_cmd += ' -s ' + os.path.basename(self.contigs)
+                blast_cmd += ' -s ' + ' '.join([os.path.basename(q) for q in self.queries])
+            else:
+                blast_cmd += ' -s ' + ' '.join(self.queries)
+            blast_cmd += ' --prefix ' + self.out_dir
+            blast_cmd += ' -p ' + self.type + ' -o ' + ' '.join(self.remote_outs) + ' -r ' + ' --outfmt ' + self.outfmt
+            blast_cmd += ' --max_target_seqs ' + self.max_target_seqs + self.cache + self.compress
+            if self.detach:
+                ssh_cmd += detached.detach(blast_cmd, self.server)
+            elif self.server == "genologin":
+                ssh_cmd += 'sbatch ' + blast_cmd
             else:
-                ssh_cmd += ' -s ' + self.contigs
-            ssh_cmd += ' --prefix ' + self.out_dir
-            ssh_cmd += ' -p ' + self.type + ' -o ' + os.path.basename(self.out) + ' -r ' + ' --outfmt 5'
-            ssh_cmd += ' --max_target_seqs ' + self.max_target_seqs
+                ssh_cmd += blast_cmd
         return ssh_cmd
 
 
@@ -119,20 +149,27 @@ class Blast:
         go_cmd = '#!/bin/bash' + "\n"
         go_cmd += '. /local/env/envconda.sh' + "\n"
         go_cmd += 'conda activate ~/blast_env' + "\n"
-        go_cmd += 'blast_launch.py -c ' + self.server + ' -n ' + self.num_chunk + ' --n_cpu 8 --tc ' + self.tc
-        go_cmd += ' -d ' + self.params['servers'][self.server]['db'][self.db] + ' -s ' + os.path.basename(self.contigs)
+        go_cmd += 'blast_launch.py -c ' + self.server + self.num_chunk + ' --n_cpu 8 --tc ' + self.tc
+        go_cmd += ' -d ' + self.params['servers'][self.server]['db'][self.db] + ' -s ' + ' '.join([os.path.basename(q) for q in self.queries])
         go_cmd += ' --prefix ' + self.out_dir
-        go_cmd += ' -p ' + self.type + ' -o ' + os.path.basename(self.out) + ' -r ' + ' --outfmt 5'
-        go_cmd += ' --max_target_seqs ' + self.max_target_seqs
+        go_cmd += ' -p ' + self.type + ' -o ' + ' '.join(self.remote_outs) + ' -r ' + ' --outfmt ' + self.outfmt
+        go_cmd += ' --max_target_seqs ' + self.max_target_seqs + self.cache + self.compress
+        if self.detach:
+            go_cmd += "\n" + 'echo $? > ' + detached.EXIT_FILE
         fw = open(self.genouest_cmd_file, mode='w')
         fw.write(go_cmd)
         fw.close()
 
 
     def check_args(self, args=dict):
+        self.pool = None
+        if 'iter' in args and args['iter'] == 'global':
+            args = self.pool_args(args)
         if 'sample' in args:
             self.sample = str(args['sample'])
         self.wd = os.getcwd() + '/' + self.sample
+        if self.pool is not None:
+            self.wd = os.getcwd()
         accepted_type = ['tblastx', 'blastx', 'blastn', 'blastp', 'rpstblastn']
         if 'contigs' in args:
             if os.path.exists(self.wd + '/' + args['contigs']):
@@ -165,17 +202,39 @@ class Blast:
             self.max_target_seqs = str(args['max_target_seqs'])
         else:
             self.max_target_seqs = '5'
+        if 'outfmt' in args:
+            self.outfmt = str(args['outfmt'])
+        else:
+            self.outfmt = '5'
+        # result cache of blast_launch.py on the server
+        if 'cache' in args:
+            self.cache = ' --cache ' + str(args['cache'])
+        else:
+            self.cache = ''
+        # gzip the contigs, the chunks and the result on their way and on the server
+        if 'compress' in args and bool(args['compress']):
+            self.compress = ' --compress'
+        else:
+            self.compress = ''
 
+        # without num_chunk, blast_launch.py chooses it from previous runs
         if 'num_chunk' in args:
-            self.num_chunk = str(args['num_chunk'])
+            self.num_chunk = ' -n ' + str(args['num_chunk'])
         else:
-            self.num_chunk = '100'
+            self.num_chunk = ''
         if 'out' in args:
             self.out = args['out']
         if 'params' in args:
             self.params = args['params']
         if 'server' in args:
             self.server = args['server']
+        # submit the job and let virAnnot.py -n collect fetch its results
+        self.detach = False
+        if 'detach' in args and bool(args['detach']):
+            if self.server == 'enki':
+                log.critical('detach is not available on enki, the results are waited for.')
+            else:
+                self.detach = True
         if 'db' in args:
             if args['db'] not in self.params['servers'][self.server]['db']:
                 log.critical(args['db'] + ' not defined in parameters file')
@@ -186,5 +245,59 @@ class Blast:
         self.cmd_file = self.wd + '/' + self.sample + '_' + self.type + '_' + self.db + '_blast_cmd.txt'
         self.remote_cmd_file = self.wd + '/' + self.sample + '_' + self.type + '_' + self.db + '_remote_blast_cmd.txt'
         self.genouest_cmd_file = self.wd + '/' + self.sample + '_' + self.type + '_' + self.db + '_genouest_cmd.txt'
-        self.random_string = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(4))
-        self.out_dir = self.random_string + '_' + self.sample + '_' + self.type
+        # same remote directory for the same sample, program, database and output so re-runs can be compared
+        self.run_id = hashlib.md5((self.cmd_file + ' ' + self.out).encode('utf-8')).hexdigest()[:4].upper()
+        self.out_dir = self.run_id + '_' + self.sample + '_' + self.type
+        # the directory is emptied by the launch, not while a detached run in it is not collected
+        if detached.submitted(self.out_dir):
+            log.critical(self.out_dir + ': a detached run of this step is not collected yet, launch -n collect before launching it again.')
+            self.execution = 0
+
+
+    def pool_args(self, args):
+        #
+        # iter: global pools the samples: the contigs of every sample are searched
+        # by a single blast_launch.py run (one split, job array and merge) and each
+        # sample gets its out file back. Only contigs and out may differ between the
+        # samples: with other options differing (e.g. a db given by a map file
+        # column), the step is not run.
+        #
+        self.iter = 'global'
+        self.pool = []
+        samples = list(args['args'])
+        names = set()
+        options = self._pool_options(args['args'][samples[0]])
+        for s_id in samples:
+            other = self._pool_options(args['args'][s_id])
+            differ = sorted([k for k in set(options) | set(other) if options.get(k) != other.get(k)])
+            if differ:
+                log.critical('options ' + ', '.join(differ) + ' of ' + s_id + ' differ from the ones of ' + samples[0] + ', samples with different options cannot be pooled.')
+                self.pool = []
+                break
+            contigs = os.getcwd() + '/' + s_id + '/' + args['args'][s_id]['contigs']
+            out = os.getcwd() + '/' + s_id + '/' + args['args'][s_id]['out']
+            if not os.path.exists(contigs):
+                log.critical('Input fasta file do not exists. ' + contigs)
+                continue
+            if os.path.basename(contigs) in names or os.path.basename(out) in names:
+                log.critical('contigs and out file names must differ between samples to pool them (' + s_id + ').')
+                self.pool = []
+                break
+            names.update([os.path.basename(contigs), os.path.basename(out)])
+            self.pool.append((s_id, contigs, out))
+        self.execution = 1
+        if not self.pool:
+            self.execution = 0
+        pool_args = dict(args['args'][samples[0]])
+        del pool_args['contigs']
+        pool_args['sample'] = 'pool'
+        # the pool is identified by all its outputs
+        pool_args['out'] = ' '.join([p[2] for p in self.pool])
+        for k in ['params', 'sge']:
+            if k in args:
+                pool_args[k] = args[k]
+        return pool_args
+
+
+    def _pool_options(self, sample_args):
+        return dict([(k, sample_args[k]) for k in sample_args if k not in ['contigs', 'out']])
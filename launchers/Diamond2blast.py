@@ -12,9 +12,8 @@ from __future__ import division # avoid writing float(x) when dividing by x
 
 import os.path
 import logging as log
-import random
-import string
-import re
+import hashlib
+from transport import get_transport, upload
 
 
 class Diamond2blast:
@@ -38,18 +37,20 @@ class Diamond2blast:
 		"""
 		Create command
 		"""
+		# with compress, the result comes back gzipped
+		self.remote_out = os.path.basename(self.out)
+		if self.compress and self.server != 'enki' and not self.remote_out.endswith('.gz'):
+			self.remote_out += '.gz'
 		ssh_cmd = self._get_env_script()
 		if self.server == 'genouest':
 			exec_cmd = self._get_exec_script()
 			cluster_cmd = self._get_clust_script()
 		if self.server != 'enki':
-			cmd = 'scp ' + self.contigs + ' ' + self.params['servers'][self.server]['username'] + '@' + self.params['servers'][self.server]['adress']
-			cmd += ':' + self.params['servers'][self.server]['scratch']
-			log.debug(cmd)
-			self.cmd.append(cmd)
+			self.transport = get_transport(self.params, self.server, self.compress != '')
 			fw = open(self.remote_cmd_file, mode='w')
 			fw.write(ssh_cmd)
 			fw.close()
+			self.uploads = [self.contigs]
 			if self.server == 'genouest':
 				fw = open(self.cluster_cmd_file, mode='w')
 				fw.write(cluster_cmd)
@@ -57,28 +58,24 @@ class Diamond2blast:
 				fw = open(self.cluster_exec_cmd_file, mode='w')
 				fw.write(exec_cmd)
 				fw.close()
-				cmd = 'ssh ' + self.params['servers'][self.server]['username'] + '@' + self.params['servers'][self.server]['adress'] + ' \'bash -s\' < '
-				cmd += self.remote_cmd_file
-				log.debug(cmd)
-				self.cmd.append(cmd)
-				cmd = 'scp ' + self.cluster_cmd_file + ' ' + self.params['servers'][self.server]['username']  + '@'
-				cmd += self.params['servers'][self.server]['adress'] + ':' + self.params['servers'][self.server]['scratch'] + '/' + self.out_dir
-				log.debug(cmd)
-				self.cmd.append(cmd)
-				cmd = 'ssh ' + self.params['servers'][self.server]['username'] + '@' + self.params['servers'][self.server]['adress']
-				cmd += ' \'bash -s\' < ' + self.cluster_exec_cmd_file
-				log.debug(cmd)
-				self.cmd.append(cmd)
-			else:
-				cmd = 'ssh ' + self.params['servers'][self.server]['username'] + '@' + self.params['servers'][self.server]['adress']
-				cmd += ' \'bash -s\' < ' + self.remote_cmd_file
+				self.uploads.append(self.cluster_cmd_file)
+			cmd = upload(self.transport, self.uploads)
+			log.debug(cmd)
+			self.cmd.append(cmd)
+			cmd = self.transport.run(self.remote_cmd_file)
+			log.debug(cmd)
+			self.cmd.append(cmd)
+			if self.server == 'genouest':
+				cmd = self.transport.run(self.cluster_exec_cmd_file)
 				log.debug(cmd)
 				self.cmd.append(cmd)
-
-			cmd = 'scp ' + self.params['servers'][self.server]['username'] + '@' + self.params['servers'][self.server]['adress'] + ':'
-			cmd += self.params['servers'][self.server]['scratch'] + '/' + self.out_dir + '/' + os.path.basename(self.out) + ' ' + self.wd
+			cmd = self.transport.fetch(self.out_dir + '/' + self.remote_out, self.wd)
 			log.debug(cmd)
 			self.cmd.append(cmd)
+			if self.remote_out != os.path.basename(self.out):
+				cmd = 'gzip -df ' + self.wd + '/' + self.remote_out
+				log.debug(cmd)
+				self.cmd.append(cmd)
 		elif self.server == 'enki':
 			self.cmd.append(ssh_cmd)
 
@@ -102,11 +99,11 @@ class Diamond2blast:
 		clust_cmd = '. /softs/local/env/envpython-3.6.3.sh \n'
 		clust_cmd += '. /softs/local/env/envblast-2.6.0.sh \n'
 		clust_cmd += 'cd ' + self.params['servers'][self.server]['scratch'] + '/' + self.out_dir + '/' + '\n'
-		clust_cmd += 'blast_launch.py -c ' + self.server + ' -n ' + self.num_chunk + ' --n_cpu ' + self.n_cpu + ' --tc ' + self.tc
+		clust_cmd += 'blast_launch.py -c ' + self.server + self.num_chunk + ' --n_cpu ' + self.n_cpu + ' --tc ' + self.tc
 		clust_cmd += ' -d ' + self.params['servers'][self.server]['db'][self.db]
 		clust_cmd += ' -s ' + self.params['servers'][self.server]['scratch'] + '/' + self.out_dir + '/' + os.path.basename(self.contigs)
-		clust_cmd += ' --prefix ' + self.out_dir + ' -p ' + self.type + ' -o ' + os.path.basename(self.out) + ' -r ' + ' --outfmt 5'
-		clust_cmd += ' --max_target_seqs ' + self.max_target_seqs
+		clust_cmd += ' --prefix ' + self.out_dir + ' -p ' + self.type + ' -o ' + self.remote_out + ' -r ' + ' --outfmt ' + self.outfmt
+		clust_cmd += ' --max_target_seqs ' + self.max_target_seqs + self.cache + self.compress
 		return clust_cmd
 
 
@@ -136,15 +133,19 @@ class Diamond2blast:
 			if self.server == 'avakas':
 				ssh_cmd += 'source ~/.bashrc' + "\n"
 			ssh_cmd += 'cd ' + self.params['servers'][self.server]['scratch'] + "\n"
-			ssh_cmd += 'mkdir ' + self.params['servers'][self.server]['scratch'] + '/' + self.out_dir + "\n"
+			# the directory of the same sample and step is reused, files of a previous run are removed
+			ssh_cmd += 'rm -rf ' + self.params['servers'][self.server]['scratch'] + '/' + self.out_dir + "\n"
+			ssh_cmd += 'mkdir -p ' + self.params['servers'][self.server]['scratch'] + '/' + self.out_dir + "\n"
 			ssh_cmd += 'mv ' + self.params['servers'][self.server]['scratch'] + '/' + os.path.basename(self.contigs) + ' ' + self.out_dir + "\n"
+			if self.server == 'genouest':
+				ssh_cmd += 'mv ' + self.params['servers'][self.server]['scratch'] + '/' + os.path.basename(self.cluster_cmd_file) + ' ' + self.out_dir + "\n"
 			ssh_cmd += 'cd ' + self.params['servers'][self.server]['scratch'] + '/' + self.out_dir + "\n"
 		if self.server != 'genouest':
 			if self.server == 'genotoul':
 				ssh_cmd += 'echo "'
 			if self.server == "genologin":
 				ssh_cmd += 'sbatch '
-			ssh_cmd += 'blast_launch.py -c ' + self.server + ' -n ' + self.num_chunk + ' --n_cpu ' + self.n_cpu + ' --tc ' + self.tc
+			ssh_cmd += 'blast_launch.py -c ' + self.server + self.num_chunk + ' --n_cpu ' + self.n_cpu + ' --tc ' + self.tc
 			ssh_cmd += ' -d ' + self.params['servers'][self.server]['db'][self.db]
 			if self.server != 'enki':
 				ssh_cmd += ' -s ' + os.path.basename(self.contigs)
@@ -152,8 +153,8 @@ class Diamond2blast:
 				ssh_cmd += ' -s ' + self.contigs
 
 			ssh_cmd += ' --prefix ' + self.out_dir
-			ssh_cmd += ' -p ' + self.type + ' -o ' + os.path.basename(self.out) + ' -r ' + ' --outfmt 5'
-			ssh_cmd += ' --max_target_seqs ' + self.max_target_seqs
+			ssh_cmd += ' -p ' + self.type + ' -o ' + self.remote_out + ' -r ' + ' --outfmt ' + self.outfmt
+			ssh_cmd += ' --max_target_seqs ' + self.max_target_seqs + self.cache + self.compress
 			if self.server == 'genotoul':
 				ssh_cmd += '"'
 				ssh_cmd += ' | qsub -sync yes -V -wd ' + self.params['servers'][self.server]['scratch'] + '/' + self.out_dir + ' -N ' + self.sample
@@ -163,35 +164,66 @@ class Diamond2blast:
 	def csv_to_fasta(self):
 		"""
 		From diamond csv results
-		extract Viral sequences and
-		generate fasta file
+		extract the sequences whose taxonomy is selected
+		and generate fasta file
 		"""
-		#File input
+		ids = []
+		sequences = {}
+		total = set()
+		log.debug("Converting to FASTA...")
 		file_input = open(self.i, "r")
-		#File output
+		header = [_unquote(f) for f in file_input.readline().rstrip("\n").split("\t")]
+		# blast2ecsv.pl starts its header with #
+		header[0] = header[0].lstrip('#')
+		if 'query_id' not in header or 'taxonomy' not in header:
+			log.critical(self.i + ' has no query_id or taxonomy column.')
+			file_input.close()
+			return
+		id_col = header.index('query_id')
+		taxo_col = header.index('taxonomy')
+		seq_col = None
+		if 'sequence' in header:
+			seq_col = header.index('sequence')
+		for line in file_input:
+			fields = line.rstrip("\n").split("\t")
+			if len(fields) <= taxo_col:
+				continue
+			query_id = _unquote(fields[id_col])
+			total.add(query_id)
+			if query_id in sequences or not self._selected(_unquote(fields[taxo_col])):
+				continue
+			ids.append(query_id)
+			# the sequence of a query is only given on its first row
+			sequences[query_id] = ''
+			if seq_col is not None and seq_col < len(fields):
+				sequences[query_id] = _unquote(fields[seq_col])
+		file_input.close()
+		# without sequence column, the sequences come from the contigs
+		if any([sequences[q_id] == '' for q_id in ids]):
+			if os.path.exists(self.icontigs):
+				sequences.update(_fasta_sequences(self.icontigs, set([q_id for q_id in ids if sequences[q_id] == ''])))
+			else:
+				log.warning(self.icontigs + ' does not exist, the queries without sequence in ' + self.i + ' are left out.')
 		file_output = open(self.contigs, "w")
-		#Seq count
-		count = 1
+		for query_id in ids:
+			if sequences[query_id] == '':
+				log.warning(query_id + ' has no sequence in ' + self.i + ' nor in ' + self.icontigs + '.')
+				continue
+			file_output.write(">" + query_id + "\n")
+			file_output.write(sequences[query_id] + "\n")
+		file_output.close()
+		log.info(self.sample + ': ' + str(len(ids)) + ' of ' + str(len(total)) + ' queries selected for ' + self.type + '.')
 
-		#Loop through each line in the input file
-		log.debug("Converting to FASTA...")
-		for strLine in file_input:
-			reg = re.compile(r"^\"Virus.*")
-			taxo = strLine.split("\t")[14]
-			query_id = strLine.split("\t")[1]
-			#Test if viral
-			if re.match(reg, taxo) != None:
-				seq = strLine.split("\t")[15]
-				#Write sequence header
-				file_output.write(">" + query_id.replace("\"", "") + "\n")
-				#Write sequence
-				file_output.write(seq.replace('\"', ''))
-				count = count + 1
-		log.debug("FASTA conversion done for " + self.sample)
 
-		#Close the input and output file
-		file_input.close()
-		file_output.close()
+	def _selected(self, taxonomy):
+		"""
+		A taxonomy is selected if one of its names starts with a name of
+		self.taxonomy and none with a name of self.exclude_taxonomy.
+		"""
+		names = [n.strip() for n in taxonomy.split(';')]
+		if not any([n.startswith(t) for n in names for t in self.taxonomy]):
+			return False
+		return not any([n.startswith(t) for n in names for t in self.exclude_taxonomy])
 
 
 	def check_args(self, args=dict):
@@ -213,6 +245,18 @@ class Diamond2blast:
 			self.contigs = self.wd + '/' + args['contigs']
 		else:
 			self.contigs = self.wd + '/' + self.sample + "_idba.scaffold.dmdx2bltx.fa"
+		# source of the sequences when the csv has no sequence column
+		if 'icontigs' in args:
+			self.icontigs = self.wd + '/' + args['icontigs']
+		else:
+			self.icontigs = self.wd + '/' + self.sample + "_idba.scaffold.fa"
+		# names of the lineages to select and to leave out
+		self.taxonomy = ['Virus']
+		if 'taxonomy' in args:
+			self.taxonomy = _names(args['taxonomy'])
+		self.exclude_taxonomy = []
+		if 'exclude_taxonomy' in args:
+			self.exclude_taxonomy = _names(args['exclude_taxonomy'])
 		if 'type' in args:
 			if args['type'] in accepted_type:
 				self.type = args['type']
@@ -237,11 +281,26 @@ class Diamond2blast:
 			self.max_target_seqs = str(args['max_target_seqs'])
 		else:
 			self.max_target_seqs = '5'
+		if 'outfmt' in args:
+			self.outfmt = str(args['outfmt'])
+		else:
+			self.outfmt = '5'
+		# result cache of blast_launch.py on the server
+		if 'cache' in args:
+			self.cache = ' --cache ' + str(args['cache'])
+		else:
+			self.cache = ''
+		# gzip the contigs, the chunks and the result on their way and on the server
+		if 'compress' in args and bool(args['compress']):
+			self.compress = ' --compress'
+		else:
+			self.compress = ''
 
+		# without num_chunk, blast_launch.py chooses it from previous runs
 		if 'num_chunk' in args:
-			self.num_chunk = str(args['num_chunk'])
+			self.num_chunk = ' -n ' + str(args['num_chunk'])
 		else:
-			self.num_chunk = '100'
+			self.num_chunk = ''
 		if 'out' in args:
 			self.out = args['out']
 		if 'params' in args:
@@ -263,5 +322,52 @@ class Diamond2blast:
 		self.remote_cmd_file = self.wd + '/' + self.sample + '_' + self.type + '_' + self.db + '_remote_d2b_cmd.txt'
 		self.cluster_cmd_file = self.wd + '/' + self.sample + '_' + self.type + '_' + self.db + '_cluster_d2b_cmd.sh'
 		self.cluster_exec_cmd_file = self.wd + '/' + self.sample + '_' + self.type + '_' + self.db + '_exec_d2b_cmd.sh'
-		self.random_string = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(4))
-		self.out_dir = self.random_string + '_' + self.sample + '_' + self.type
+		# same remote directory for the same sample, program, database and output so re-runs can be compared
+		self.run_id = hashlib.md5((self.cmd_file + ' ' + self.out).encode('utf-8')).hexdigest()[:4].upper()
+		self.out_dir = self.run_id + '_' + self.sample + '_' + self.type
+
+
+def _names(value):
+	if isinstance(value, list):
+		return [str(v) for v in value]
+	return [str(value)]
+
+
+def _unquote(field):
+	return field.strip().replace('"', '')
+
+
+def _fasta_sequences(fasta, wanted):
+	"""
+	Sequences of the wanted ids of fasta, read at their offsets when the
+	fasta has a samtools index (.fai), in a single pass otherwise.
+	"""
+	sequences = {}
+	if os.path.exists(fasta + '.fai'):
+		fh = open(fasta, "rb")
+		for line in open(fasta + '.fai'):
+			name, length, offset, line_bases, line_bytes = line.split("\t")[:5]
+			if name not in wanted:
+				continue
+			length = int(length)
+			fh.seek(int(offset))
+			# read the line ends with the sequence
+			size = length + (length // int(line_bases) + 1) * (int(line_bytes) - int(line_bases))
+			sequences[name] = ''.join(fh.read(size).decode('ascii').split())[:length]
+		fh.close()
+		return sequences
+	name = None
+	seq = []
+	for line in open(fasta, "r"):
+		if line.startswith('>'):
+			if name is not None:
+				sequences[name] = ''.join(seq)
+			name = line[1:].split()[0]
+			if name not in wanted:
+				name = None
+			seq = []
+		elif name is not None:
+			seq.append(line.strip())
+	if name is not None:
+		sequences[name] = ''.join(seq)
+	return sequences
@@ -5,10 +5,10 @@ from __future__ import division # avoid writing float(x) when dividing by x
 
 import os.path
 import logging as log
-import random
-import string
-from Bio import SeqIO
+import hashlib
 from Blast import Blast
+from transport import link_stored
+import detached
 
 class Rps2blast:
 	"""
@@ -44,6 +44,7 @@ class Rps2blast:
 				query_length = line.strip().split("\t")[1]
 				if query_length != "no_hit":
 					wanted.add(query_id.replace("\"", "") )
+		from Bio import SeqIO
 		fasta_sequences = SeqIO.parse(open(fasta_file),'fasta')
 		with open(result_file, "w") as f:
 			for seq in fasta_sequences:
@@ -71,28 +72,39 @@ class Rps2blast:
 			ssh_cmd += 'echo "source not found."' + "\n"
 			ssh_cmd += 'fi' + "\n"
 			ssh_cmd += 'cd ' + self.params['servers'][self.server]['scratch'] + "\n"
-			ssh_cmd += 'mkdir ' + self.params['servers'][self.server]['scratch'] + '/' + self.out_dir + "\n"
-			ssh_cmd += 'mv ' + self.params['servers'][self.server]['scratch'] + '/' + os.path.basename(self.contigs) + ' ' + self.out_dir + "\n"
+			# the directory of the same sample and step is reused, files of a previous run are removed
+			ssh_cmd += 'rm -rf ' + self.params['servers'][self.server]['scratch'] + '/' + self.out_dir + "\n"
+			ssh_cmd += 'mkdir -p ' + self.params['servers'][self.server]['scratch'] + '/' + self.out_dir + "\n"
+			ssh_cmd += link_stored(self.queries, self.stored, self.out_dir)
 			if self.server == 'genouest':
 				ssh_cmd += 'mv ' + self.params['servers'][self.server]['scratch'] + '/' + os.path.basename(self.genouest_cmd_file) + ' ' + self.out_dir + "\n"
 			ssh_cmd += 'cd ' + self.params['servers'][self.server]['scratch'] + '/' + self.out_dir + "\n"
 
 		if self.server == 'genouest':
 			self.create_genouest_script()
-			ssh_cmd += 'sbatch ' + self.params['servers'][self.server]['scratch'] + '/' + self.out_dir
+			if self.detach:
+				ssh_cmd += 'rm -f ' + detached.EXIT_FILE + "\n"
+				ssh_cmd += 'sbatch --parsable '
+			else:
+				ssh_cmd += 'sbatch '
+			ssh_cmd += self.params['servers'][self.server]['scratch'] + '/' + self.out_dir
 			ssh_cmd += '/' + os.path.basename(self.genouest_cmd_file)
 		else:
-			if self.server == "genologin":
-				ssh_cmd += 'sbatch --mem=2G '
-			ssh_cmd += 'blast_launch.py -c ' + self.server + ' -n ' + self.num_chunk + ' --n_cpu 8 --tc ' + self.tc
-			ssh_cmd += ' -d ' + self.params['servers'][self.server]['db'][self.db]
+			blast_cmd = 'blast_launch.py -c ' + self.server + self.num_chunk + ' --n_cpu 8 --tc ' + self.tc
+			blast_cmd += ' -d ' + self.params['servers'][self.server]['db'][self.db]
 			if self.server != 'enki':
-				ssh_cmd += ' -s ' + os.path.basename(self.contigs)
+				blast_cmd += ' -s ' + ' '.join([os.path.basename(q) for q in self.queries])
+			else:
+				blast_cmd += ' -s ' + ' '.join(self.queries)
+			blast_cmd += ' --prefix ' + self.out_dir
+			blast_cmd += ' -p ' + self.type + ' -o ' + ' '.join(self.remote_outs) + ' -r ' + ' --outfmt ' + self.outfmt
+			blast_cmd += ' --max_target_seqs ' + self.max_target_seqs + self.cache + self.compress
+			if self.detach:
+				ssh_cmd += detached.detach(blast_cmd, self.server)
+			elif self.server == "genologin":
+				ssh_cmd += 'sbatch --mem=2G ' + blast_cmd
 			else:
-				ssh_cmd += ' -s ' + self.contigs
-			ssh_cmd += ' --prefix ' + self.out_dir
-			ssh_cmd += ' -p ' + self.type + ' -o ' + os.path.basename(self.out) + ' -r ' + ' --outfmt 5'
-			ssh_cmd += ' --max_target_seqs ' + self.max_target_seqs
+				ssh_cmd += blast_cmd
 		return ssh_cmd
 
 
@@ -148,17 +160,39 @@ class Rps2blast:
 			self.max_target_seqs = str(args['max_target_seqs'])
 		else:
 			self.max_target_seqs = '5'
+		if 'outfmt' in args:
+			self.outfmt = str(args['outfmt'])
+		else:
+			self.outfmt = '5'
+		# result cache of blast_launch.py on the server
+		if 'cache' in args:
+			self.cache = ' --cache ' + str(args['cache'])
+		else:
+			self.cache = ''
+		# gzip the contigs, the chunks and the result on their way and on the server
+		if 'compress' in args and bool(args['compress']):
+			self.compress = ' --compress'
+		else:
+			self.compress = ''
 
+		# without num_chunk, blast_launch.py chooses it from previous runs
 		if 'num_chunk' in args:
-			self.num_chunk = str(args['num_chunk'])
+			self.num_chunk = ' -n ' + str(args['num_chunk'])
 		else:
-			self.num_chunk = '100'
+			self.num_chunk = ''
 		if 'out' in args:
 			self.out = args['out']
 		if 'params' in args:
 			self.params = args['params']
 		if 'server' in args:
 			self.server = args['server']
+		# submit the job and let virAnnot.py -n collect fetch its results
+		self.detach = False
+		if 'detach' in args and bool(args['detach']):
+			if self.server == 'enki':
+				log.critical('detach is not available on enki, the results are waited for.')
+			else:
+				self.detach = True
 		if 'username' in args['params']['servers'][self.server]:
 			self.username = args['params']['servers'][self.server]['username']
 		else:
@@ -173,5 +207,10 @@ class Rps2blast:
 		self.cmd_file = self.wd + '/' + self.sample + '_' + self.type + '_' + self.db + '_rps2blast_cmd.txt'
 		self.remote_cmd_file = self.wd + '/' + self.sample + '_' + self.type + '_' + self.db + '_remote_rps2blast_cmd.txt'
 		self.genouest_cmd_file = self.wd + '/' + self.sample + '_' + self.type + '_' + self.db + '_genouest_rps2blast_cmd.txt'
-		self.random_string = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(4))
-		self.out_dir = self.random_string + '_' + self.sample + '_' + self.type
+		# same remote directory for the same sample, program, database and output so re-runs can be compared
+		self.run_id = hashlib.md5((self.cmd_file + ' ' + self.out).encode('utf-8')).hexdigest()[:4].upper()
+		self.out_dir = self.run_id + '_' + self.sample + '_' + self.type
+		# the directory is emptied by the launch, not while a detached run in it is not collected
+		if detached.submitted(self.out_dir):
+			log.critical(self.out_dir + ': a detached run of this step is not collected yet, launch -n collect before launching it again.')
+			self.execution = 0
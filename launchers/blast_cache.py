@@ -0,0 +1,122 @@
+"""
+This module is a part of the virAnnot module
+SQLite cache of the BLAST result of each query sequence.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+# to allow code to work with Python 2 and 3
+from __future__ import print_function   # print is a function in python3
+from __future__ import unicode_literals # avoid adding "u" to each string
+from __future__ import division # avoid writing float(x) when dividing by x
+
+import glob
+import hashlib
+import os
+import sqlite3
+import zlib
+
+# sequences looked up or stored per statement
+BATCH = 500
+
+
+class BlastCache:
+	"""
+	BLAST result of each query sequence, its XML <Iteration> lines or its
+	tabular rows, keyed by the sha1 of its residues and the search settings
+	(see search_settings). The defline the result was computed with is kept
+	to rename the query when the same sequence comes with another name.
+	The XML header of the last search is kept for each settings.
+	"""
+
+	def __init__(self, path, settings):
+		self.settings = settings
+		self.conn = sqlite3.connect(path, timeout=600)
+		self.conn.execute('PRAGMA journal_mode=WAL')
+		self.conn.execute('CREATE TABLE IF NOT EXISTS result (settings TEXT, seq TEXT, defline BLOB, result BLOB, PRIMARY KEY (settings, seq))')
+		self.conn.execute('CREATE TABLE IF NOT EXISTS header (settings TEXT PRIMARY KEY, header BLOB)')
+		self.conn.commit()
+
+	def known(self, hashes):
+		"""
+		Return the set of hashes having a result.
+		"""
+		hashes = list(hashes)
+		found = set()
+		for i in range(0, len(hashes), BATCH):
+			batch = hashes[i:i + BATCH]
+			sql = 'SELECT seq FROM result WHERE settings = ? AND seq IN (' + ','.join(['?'] * len(batch)) + ')'
+			for row in self.conn.execute(sql, [self.settings] + batch):
+				found.add(row[0])
+		return found
+
+	def get(self, seq):
+		"""
+		Return (defline, result) of the sequence hash seq, None if not cached.
+		"""
+		row = self.conn.execute('SELECT defline, result FROM result WHERE settings = ? AND seq = ?', (self.settings, seq)).fetchone()
+		if row is None:
+			return None
+		return bytes(row[0]), zlib.decompress(row[1])
+
+	def put(self, results):
+		"""
+		Store the (seq, defline, result) of results in one transaction.
+		"""
+		self.conn.executemany('INSERT OR REPLACE INTO result (settings, seq, defline, result) VALUES (?, ?, ?, ?)',
+			[(self.settings, seq, sqlite3.Binary(defline), sqlite3.Binary(zlib.compress(result))) for seq, defline, result in results])
+		self.conn.commit()
+
+	def header(self):
+		row = self.conn.execute('SELECT header FROM header WHERE settings = ?', (self.settings,)).fetchone()
+		if row is None:
+			return None
+		return bytes(row[0])
+
+	def set_header(self, header):
+		self.conn.execute('INSERT OR REPLACE INTO header (settings, header) VALUES (?, ?)', (self.settings, sqlite3.Binary(header)))
+		self.conn.commit()
+
+	def close(self):
+		self.conn.close()
+
+
+def search_settings(prog, db, evalue, max_target_seqs, outfmt):
+	"""
+	Key of the search settings, the database is identified by its path
+	(see db_path) and the size and modification time of its files.
+	"""
+	return '\t'.join([prog, db_path(db), str(db_version(db)), str(evalue), str(max_target_seqs), str(outfmt)])
+
+
+def db_path(db):
+	"""
+	Absolute path of the BLAST database db, looked for in the current
+	directory then in BLASTDB as BLAST does, db itself when not found.
+	"""
+	paths = [db]
+	if not os.path.isabs(db):
+		paths += [os.path.join(d, db) for d in os.environ.get('BLASTDB', '').split(os.pathsep) if d]
+	for path in paths:
+		if glob.glob(glob.escape(path) + '.*'):
+			return os.path.abspath(path)
+	return db
+
+
+def db_version(db):
+	"""
+	Digest of the names, sizes and modification times of the files of
+	the BLAST database db (see db_path). None if not found.
+	"""
+	files = glob.glob(glob.escape(db_path(db)) + '.*')
+	if not files:
+		return None
+	digest = hashlib.sha1()
+	for f in sorted(files):
+		digest.update(('%s %i %i\n' % (os.path.basename(f), os.path.getsize(f), int(os.path.getmtime(f)))).encode('utf-8'))
+	return digest.hexdigest()[:16]
+
+
+def sequence_hash(seq):
+	"""
+	sha1 of the residues of a sequence given with its line breaks.
+	"""
+	return hashlib.sha1(seq.translate(None, b'\r\n \t').upper()).hexdigest()
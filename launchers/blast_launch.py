@@ -6,9 +6,59 @@ import subprocess
 import time
 import glob
 import shutil
-import random
-import warnings
-from Bio import SeqIO
+import gzip
+import array
+import heapq
+import math
+import mmap
+import shlex
+import signal
+import socket
+import sys
+import threading
+import functools
+import concurrent.futures
+import zlib
+from job_monitor import JobMonitor
+from blast_cache import db_path
+
+# records of a length class sorted exactly by _balance_chunks
+SORT_LIMIT = 100000
+# records of larger classes given at once to a chunk
+BLOCK = 256
+EVALUE = 0.001
+# extension of the chunk results for each -outfmt
+RESULT_EXT = {5: 'xml', 6: 'm8'}
+# gzip level of the chunks and their results with --compress
+CHUNK_GZIP_LEVEL = 1
+# bytes read at once when os.sendfile is not available
+COPY_BUFFER = 16 * 1024 * 1024
+# runs of records copied by os.sendfile, smaller ones are gathered
+SENDFILE_MIN = 1024 * 1024
+# buffers given to a single os.writev
+IOV_MAX = 1024
+# BLAST XML lines renumbered when merging chunks
+ITER_NUM = re.compile(rb'(\s*<Iteration_iter-num>)\d+(</Iteration_iter-num>\s*)$')
+QUERY_ID = re.compile(rb'(\s*<Iteration_query-ID>(?:lcl\|)?Query_)\d+(</Iteration_query-ID>\s*)$')
+XML_DOCTYPES = [b'<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">',
+                b'<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "NCBI_BlastOutput.dtd">']
+XML_HEADER_MAX = 10000
+XML_FOOTER_MAX = 1000
+QUERY_NAME = re.compile(rb'(\s*<Iteration_query-(?:ID|def)>)(.*)(</Iteration_query-(?:ID|def)>\s*)$')
+# a fasta record: header and sequence lines up to the next line starting with >
+RECORD = re.compile(rb'>[^\n]*\n?((?:[^>\n][^\n]*\n?|\n)*)')
+# query description written by BLAST for a defline without one
+NO_DEFINITION = b'No definition line'
+# name of the nth sequence searched by _blast_cached, the deflines of the inputs may collide
+MISS_NAME = re.compile(rb'^(?:lcl\|)?q(\d+)$')
+# core seconds per query residue of each program before any run is recorded
+DEFAULT_COST = {'blastn': 1e-4, 'blastp': 5e-3, 'blastx': 1e-2, 'tblastx': 2e-2, 'rpstblastn': 1e-3}
+# last chunk timings of the history used to calibrate the chunk count
+HISTORY_MAX = 1000
+# chunks shorter than this (seconds) measure the start of BLAST, not its cost
+HISTORY_MIN_SECONDS = 60
+# chunks needed before the history replaces DEFAULT_COST
+HISTORY_MIN_CHUNKS = 5
 
 def main():
     args = _set_options()
@@ -21,163 +71,1040 @@ def main():
     out_dir = wd + '/' + args.prefix + '_split'
     if not os.path.exists(out_dir):
         os.mkdir(out_dir)
-    num_files = _split_fasta(args.seq,args.chunk,out_dir,args.random)
-    jobid = _launch_jobs(num_files,out_dir,args.prefix,args.cluster,args.prog,args.db,args.n_cpu,args.tc,args.outfmt,args.max_target_seqs,args.mem)
-    _wait_job(args.cluster,jobid)
-    if args.outfmt == 5:
-        _concat_xml(out_dir,args.out)
-    elif args.outfmt == 6:
-        _concat_m8(out_dir,args.out)
+    if len(args.seq) != len(args.out):
+        log.critical('one output file is needed for each input file.')
+        sys.exit(1)
+    seqs = [_plain_input(args.seq[n],n + 1,out_dir) for n in range(len(args.seq))]
+    if args.cache is None and len(seqs) == 1:
+        _blast(seqs[0],args.out[0],out_dir,args)
+    else:
+        _blast_cached(seqs,args.out,out_dir,args)
 
     if args.clean:
         shutil.rmtree(out_dir)
 
 
-def _concat_m8(path, out_file):
-    files = glob.glob(path + '/' + '*.xml')
-    for f in files:
-        cmd = 'cat ' + f + ' >> ' + out_file
-        os.system(cmd)
+def _blast(seq, out_file, out_dir, args):
+    """
+    Split seq in chunks, run them on the cluster or locally and merge
+    their results in out_file.
+    """
+    index = _index_fasta(seq)
+    # threads of each BLAST, reduced to the cores available with -c local
+    n_cpu = args.n_cpu
+    if args.cluster == 'local':
+        n_cpu = _local_threads(args.n_cpu,args.cores)
+    # the history is kept per database file and host
+    db = db_path(args.db)
+    host = socket.gethostname()
+    chunk = args.chunk
+    if chunk is None:
+        chunk = _auto_chunk(index[2],args.prog,db,host,n_cpu,args.target_time,args.max_chunks,args.history)
+    loads = _split_fasta(seq,chunk,out_dir,args.random,index,args.compress)
+    num_files = len(loads) - 1
+    if args.cluster == 'local':
+        if args.speculate:
+            log.warning('--speculate is ignored with -c local.')
+        _run_local(num_files+1,out_dir,args.prog,args.db,n_cpu,args.tc,args.cores,args.outfmt,args.max_target_seqs,out_file,args.retries,args.compress)
+    else:
+        blt_script = _write_script(out_dir,args.cluster,args.prog,args.db,args.n_cpu,args.outfmt,args.max_target_seqs,args.compress)
+        submit = functools.partial(_submit_chunks,args.cluster,out_dir,args.n_cpu,args.tc,args.mem,blt_script)
+        cancel = functools.partial(_cancel_chunks,args.cluster)
+        tracker = ChunkTracker(out_dir,num_files+1,args.outfmt,submit,cancel,JobMonitor(_get_scheduler(args.cluster),shared=args.monitor),args.retries,args.speculate,args.compress)
+        _merge_files(tracker.run(),args.outfmt,out_file)
+    _record_history(args.history,args.prog,db,host,n_cpu,loads,_chunk_times(out_dir,len(loads)))
+
+
+def _blast_cached(seqs, out_files, out_dir, args):
+    """
+    Search the distinct sequences of all seqs without result in the cache
+    once, store their results and write each out_file from the cache with
+    the deflines of its input. Without --cache, a cache in out_dir is used
+    to deduplicate the inputs.
+    """
+    from blast_cache import BlastCache, search_settings
+    settings = search_settings(args.prog,args.db,EVALUE,args.max_target_seqs,args.outfmt)
+    if args.cache is None:
+        cache = BlastCache(out_dir + '/' + 'queries.sqlite',settings)
+    else:
+        if settings.split('\t')[2] == 'None':
+            log.warning('files of the database ' + args.db + ' not found, cached results will not follow its updates.')
+        cache = BlastCache(args.cache,settings)
+    inputs = [_query_records(seq) for seq in seqs]
+    if not [records for records in inputs if records]:
+        log.critical(', '.join(seqs) + ' contain no sequence.')
+        sys.exit(1)
+    distinct = set([r[3] for records in inputs for r in records])
+    known = cache.known(distinct)
+    misses = []
+    searched = set()
+    stats = []
+    for seq, records in zip(seqs, inputs):
+        n_misses = len(misses)
+        for r in records:
+            if r[3] not in known and r[3] not in searched:
+                misses.append((seq, r))
+                searched.add(r[3])
+        stats.append([seq, len(records), len(set([r[3] for r in records])), len([r for r in records if r[3] in known]), len(misses) - n_misses])
+    _report_dedup(stats, len(distinct), args.prefix + '_dedup.tsv')
+    if misses:
+        # searched as q0, q1... and found back by name: -r reorders the records
+        miss_fasta = out_dir + '/' + 'misses.fa'
+        _write_records(misses,miss_fasta,[_miss_name(n) for n in range(len(misses))])
+        miss_out = out_dir + '/' + 'misses.' + RESULT_EXT[args.outfmt]
+        _blast(miss_fasta,miss_out,out_dir,args)
+        if args.outfmt == 5:
+            _store_xml(cache,miss_out,[r for seq, r in misses])
+        else:
+            _store_m8(cache,miss_out,[r for seq, r in misses])
+    for records, out_file in zip(inputs, out_files):
+        if args.outfmt == 5:
+            _splice_xml(cache,records,out_file)
+        else:
+            _splice_m8(cache,records,out_file)
+    cache.close()
+
+
+def _report_dedup(stats, distinct, report):
+    """
+    Log and write in report the number of queries, distinct sequences,
+    cached queries and searched sequences of each input and of all of them,
+    with the ratio of queries not searched.
+    """
+    total = ['total', sum([x[1] for x in stats]), distinct, sum([x[3] for x in stats]), sum([x[4] for x in stats])]
+    lines = ["\t".join(['#input', 'queries', 'distinct', 'cached', 'searched', 'saved'])]
+    for x in stats:
+        lines.append("\t".join([str(v) for v in x] + [_ratio(x[1] - x[4], x[1])]))
+    log.info(str(total[1]) + ' queries in ' + str(len(stats)) + ' inputs, ' + str(distinct) + ' distinct sequences, ' + str(total[3]) + ' cached queries, ' +
+             str(total[4]) + ' sequences to search: ' + _ratio(total[1] - total[4], total[1]) + ' of the queries not searched.')
+    lines.append("\t".join([str(v) for v in total] + [_ratio(total[1] - total[4], total[1])]))
+    with open(report, 'w') as fh:
+        fh.write("\n".join(lines) + "\n")
+
+
+def _ratio(part, whole):
+    if whole == 0:
+        return '0.0%'
+    return str(round(100 * part / whole, 1)) + '%'
+
+
+def _plain_input(seq, n, out_dir):
+    """
+    seq itself, or its decompressed copy out_dir/input_n.fa when seq ends
+    with .gz or .zst, the records of the inputs being memory-mapped.
+    """
+    if not seq.endswith('.gz') and not seq.endswith('.zst'):
+        return seq
+    plain = out_dir + '/' + 'input_%i.fa' % n
+    with open(plain, 'wb') as dst:
+        if seq.endswith('.gz'):
+            with gzip.open(seq, 'rb') as src:
+                shutil.copyfileobj(src, dst, COPY_BUFFER)
+        elif subprocess.call(['zstd', '-dc', seq], stdout=dst) != 0:
+            log.critical('cannot decompress ' + seq + ' with zstd.')
+            sys.exit(1)
+    log.info(seq + ' decompressed in ' + plain + '.')
+    return plain
+
+
+def _query_records(fasta):
+    """
+    Offset, size, defline and residues sha1 of each record of fasta.
+    """
+    from blast_cache import sequence_hash
+    records = []
+    with open(fasta, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return records
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        start = 0
+        if mm[0:1] != b'>':
+            start = mm.find(b'\n>') + 1
+        if start > 0 or mm[0:1] == b'>':
+            for m in RECORD.finditer(mm, start):
+                defline = mm[m.start() + 1:m.start(1)].rstrip(b'\r\n')
+                records.append((m.start(), m.end() - m.start(), defline, sequence_hash(m.group(1))))
+        mm.close()
+    return records
+
+
+def _write_records(records, out_file, names=None):
+    """
+    Copy the (fasta, record) of records to out_file,
+    each one ending with a line break. With names, the nth
+    record is written with the defline names[n].
+    """
+    out = os.open(out_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    handles = {}
+    for n, (fasta, (offset, size, defline, seq)) in enumerate(records):
+        if fasta not in handles:
+            handles[fasta] = open(fasta, 'rb')
+        fh = handles[fasta]
+        if names is None:
+            _copy_range(fh, out, offset, size)
+        else:
+            fh.seek(offset)
+            header = len(fh.readline())
+            os.write(out, b'>' + names[n] + b'\n')
+            _copy_range(fh, out, offset + header, size - header)
+        fh.seek(offset + size - 1)
+        if fh.read(1) != b'\n':
+            os.write(out, b'\n')
+    for fh in handles.values():
+        fh.close()
+    os.close(out)
+
+
+def _store_xml(cache, xml, records):
+    """
+    Store the <Iteration> of each record searched in the BLAST XML file xml,
+    the nth record being the query named _miss_name(n).
+    """
+    h = open(xml, 'rb')
+    cache.set_header(_read_xml_header(h))
+    batch = []
+    found = set()
+    iteration = None
+    name = None
+    for line in h:
+        if iteration is not None:
+            iteration.append(line)
+            m = QUERY_NAME.match(line)
+            if m is not None and (name is None or b'query-def' in line):
+                fields = m.group(2).split(None, 1)
+                if fields and MISS_NAME.match(fields[0]):
+                    name = fields[0]
+            if b'</Iteration>' in line:
+                n = _miss_index(xml, name, records, found)
+                batch.append((records[n][3], _miss_name(n), b''.join(iteration)))
+                iteration = None
+                if len(batch) == 1000:
+                    cache.put(batch)
+                    batch = []
+        elif b'<Iteration>' in line:
+            iteration = [line]
+            name = None
+    h.close()
+    if len(found) != len(records):
+        raise ValueError('%s has %i iterations for %i queries' % (xml, len(found), len(records)))
+    cache.put(batch)
+
+
+def _store_m8(cache, m8, records):
+    """
+    Store the rows of each record searched in the tabular file m8, the nth
+    record being the query named _miss_name(n), records without rows are
+    stored as searched without hit.
+    """
+    batch = []
+    found = set()
+    name = None
+    rows = []
+    with open(m8, 'rb') as h:
+        for line in h:
+            qseqid = line.split(b'\t', 1)[0]
+            if qseqid != name:
+                if rows:
+                    n = _miss_index(m8, name, records, found)
+                    batch.append((records[n][3], _miss_name(n), b''.join(rows)))
+                    rows = []
+                name = qseqid
+            rows.append(line)
+            if len(batch) >= 1000:
+                cache.put(batch)
+                batch = []
+    if rows:
+        n = _miss_index(m8, name, records, found)
+        batch.append((records[n][3], _miss_name(n), b''.join(rows)))
+    for n in range(len(records)):
+        if n not in found:
+            batch.append((records[n][3], _miss_name(n), b''))
+    cache.put(batch)
+
+
+def _miss_name(n):
+    return b'q%i' % n
+
+
+def _miss_index(f, name, records, found):
+    """
+    Index of the record searched as name in the result file f, added to
+    found. A name not searched or found twice is an error.
+    """
+    m = None
+    if name is not None:
+        m = MISS_NAME.match(name)
+    if m is None or int(m.group(1)) >= len(records):
+        raise ValueError('%s has results of %s not matching the queries' % (f, repr(name)))
+    n = int(m.group(1))
+    if n in found:
+        raise ValueError('%s has the results of %s twice' % (f, name.decode('utf-8')))
+    found.add(n)
+    return n
+
+
+def _query_id(defline):
+    return defline.split(None, 1)[0] if defline.strip() else b''
+
+
+def _splice_xml(cache, records, out_file):
+    """
+    Write the BLAST XML of the records from the cache, renumbered and
+    renamed after their deflines.
+    """
+    header = cache.header()
+    if header is None:
+        raise ValueError('no BLAST XML header in the cache')
+    part = out_file + '.part'
+    f_out = _open_output(out_file, part)
+    f_out.write(header)
+    n_iter = 0
+    for offset, size, defline, seq in records:
+        cached_defline, result = cache.get(seq)
+        n_iter += 1
+        for line in result.splitlines(True):
+            if b'<Iteration_' in line:
+                m = ITER_NUM.match(line)
+                if m is not None:
+                    line = m.group(1) + str(n_iter).encode() + m.group(2)
+                else:
+                    m = QUERY_ID.match(line)
+                    if m is not None:
+                        line = m.group(1) + str(n_iter).encode() + m.group(2)
+                    elif cached_defline != defline:
+                        line = _rename_query(line, cached_defline, defline)
+            f_out.write(line)
+    f_out.write(b"  </BlastOutput_iterations>\n")
+    f_out.write(b"</BlastOutput>\n")
+    f_out.close()
+    os.rename(part, out_file)
+    log.info(str(n_iter) + ' iterations written in ' + out_file + ' from the cache.')
+
+
+def _rename_query(line, old, new):
+    """
+    Rename the query of a <Iteration_query-ID> or <Iteration_query-def>
+    line from the defline old to new. With -parse_deflines, BLAST writes
+    the first word of the defline in the ID and the rest, or
+    NO_DEFINITION, in the description; otherwise the description is
+    the whole defline.
+    """
+    m = QUERY_NAME.match(line)
+    if m is None:
+        return line
+    old_id, old_desc = (old.split(None, 1) + [b''])[:2]
+    new_id, new_desc = (new.split(None, 1) + [b''])[:2]
+    text = m.group(2)
+    if b'query-ID' in m.group(1):
+        before = _xml_escape(old_id)
+        if before and (text == before or text.endswith(b'|' + before)):
+            return m.group(1) + text[:len(text) - len(before)] + _xml_escape(new_id) + m.group(3)
+        return line
+    if text == _xml_escape(old):
+        return m.group(1) + _xml_escape(new) + m.group(3)
+    if text == (_xml_escape(old_desc) or NO_DEFINITION):
+        return m.group(1) + (_xml_escape(new_desc) or NO_DEFINITION) + m.group(3)
+    return line
+
+
+def _xml_escape(text):
+    return text.replace(b'&', b'&amp;').replace(b'<', b'&lt;').replace(b'>', b'&gt;').replace(b'"', b'&quot;').replace(b"'", b'&apos;')
+
+
+def _splice_m8(cache, records, out_file):
+    """
+    Write the tabular rows of the records from the cache,
+    renamed after their deflines.
+    """
+    part = out_file + '.part'
+    f_out = _open_output(out_file, part)
+    n_rows = 0
+    for offset, size, defline, seq in records:
+        cached_defline, result = cache.get(seq)
+        if not result:
+            continue
+        if cached_defline != defline:
+            old_id = _query_id(cached_defline)
+            new_id = _query_id(defline)
+            lines = []
+            for line in result.splitlines(True):
+                fields = line.split(b'\t', 1)
+                if fields[0] == old_id:
+                    line = new_id + b'\t' + fields[1]
+                lines.append(line)
+            result = b''.join(lines)
+        n_rows += result.count(b'\n')
+        f_out.write(result)
+    f_out.close()
+    os.rename(part, out_file)
+    log.info(str(n_rows) + ' rows written in ' + out_file + ' from the cache.')
 
 
-def _concat_xml(path, out_file):
-    files = glob.glob(path + '/' + '*.xml')
-    if len(files) == 1:
-        shutil.move(files[0], out_file)
-        return 0
-    f_out = open(out_file, mode='w')
-    h = None
+def _merge_files(files, outfmt, out_file):
+    """
+    Merge the chunk results files in their order, XML chunks
+    being all checked before writing anything.
+    """
+    if outfmt == 5:
+        errors = [e for e in [_check_xml(f) for f in files] if e is not None]
+        if errors:
+            for e in errors:
+                log.critical(e)
+            raise ValueError('%i invalid BLAST XML chunks in %s' % (len(errors), os.path.dirname(files[0])))
+        merger = XmlMerger(out_file)
+    else:
+        merger = M8Merger(out_file)
     for f in files:
-        h = open(f)
-        header = h.readline()
-        if not header:
-            h.close()
-            continue;
-            warnings.warn("BLAST XML file %s was empty" % f)
-        if header.strip() != '<?xml version="1.0"?>':
-            f_out.write(header) #for diagnosis
-            f_out.close()
-            h.close()
-            raise ValueError("%s is not an XML file!" % f)
-        line = h.readline()
-        header += line
-        if line.strip() not in ['<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">',
-                                '<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "NCBI_BlastOutput.dtd">']:
-            f_out.write(header) #for diagnosis
-            f_out.close()
-            h.close()
-            raise ValueError("%s is not a BLAST XML file!" % f)
-        while True:
-            line = h.readline()
-            if not line:
-                f_out.write(header) #for diagnosis
-                f_out.close()
-                h.close()
-                log.critical('BLAST XML file %s ended prematurely' % f)
-                raise ValueError("BLAST XML file %s ended prematurely" % f)
-            header += line
-            if "<Iteration>" in line:
-                break
-            if len(header) > 10000:
-                #Something has gone wrong, don't load too much into memory!
-                #Write what we have to the merged file for diagnostics
-                f_out.write(header)
-                f_out.close()
-                h.close()
-                raise ValueError("BLAST XML file %s has too long a header!" % f)
-        if "<BlastOutput>" not in header:
-            f_out.close()
-            h.close()
-            log.critical("%s is not a BLAST XML file:\n%s\n..." % (f, header))
-            raise ValueError("%s is not a BLAST XML file:\n%s\n..." % (f, header))
-        if f == files[0]:
-            f_out.write(header)
+        merger.add(f)
+    merger.close()
+
+
+def _open_output(out_file, path):
+    """
+    Open path to write out_file, with gzip when out_file ends with .gz.
+    """
+    if out_file.endswith('.gz'):
+        return gzip.open(path, 'wb', compresslevel=6)
+    return open(path, 'wb')
+
+
+def _open_input(f):
+    """
+    Open the chunk result f to read it, with gzip when f ends with .gz.
+    """
+    if f.endswith('.gz'):
+        return gzip.open(f, 'rb')
+    return open(f, 'rb')
+
+
+class M8Merger:
+    """
+    Append tabular chunk results to out_file, chunks being given in order.
+    A chunk compressed like out_file (gzip when the name ends with .gz) is
+    copied as it is, gzip members being concatenated, others go through
+    gzip. The result is written in out_file.part and renamed by close.
+    """
+
+    def __init__(self, out_file):
+        self.out_file = out_file
+        self.part = out_file + '.part'
+        self.compressed = out_file.endswith('.gz')
+        self.n_files = 0
+        self.empty = []
+        self.fd = os.open(self.part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    def add(self, f):
+        size = os.path.getsize(f)
+        if size == 0 or f.endswith('.gz') and _gzip_empty(f):
+            self.empty.append(os.path.basename(f))
+        if f.endswith('.gz') == self.compressed:
+            with open(f, 'rb') as h:
+                _copy_range(h, self.fd, 0, size)
         else:
-            f_out.write("    <Iteration>\n")
+            raw = os.fdopen(os.dup(self.fd), 'wb')
+            f_out = raw
+            if self.compressed:
+                f_out = gzip.GzipFile(filename='', mode='wb', compresslevel=6, fileobj=raw)
+            with _open_input(f) as h:
+                shutil.copyfileobj(h, f_out, COPY_BUFFER)
+            f_out.close()
+            raw.close()
+        self.n_files += 1
+
+    def close(self):
+        if self.empty:
+            log.warning(str(len(self.empty)) + ' empty chunk results: ' + ', '.join(self.empty))
+        os.close(self.fd)
+        os.rename(self.part, self.out_file)
+        log.info(str(self.n_files) + ' chunks concatenated in ' + self.out_file + '.')
+
+    def abort(self):
+        os.close(self.fd)
+        os.remove(self.part)
+
+
+def _gzip_empty(f):
+    """
+    Whether the gzip file f holds no data.
+    """
+    with gzip.open(f, 'rb') as h:
+        return h.read(1) == b''
+
+
+class XmlMerger:
+    """
+    Append BLAST XML chunk results to out_file one line at a time, chunks
+    being given in order. Iterations are renumbered and automatic query IDs
+    (Query_N) follow the merged numbering. The header is the one of the
+    first chunk. The result is written in out_file.part and renamed by close.
+    """
+
+    def __init__(self, out_file):
+        self.out_file = out_file
+        self.part = out_file + '.part'
+        self.f_out = _open_output(out_file, self.part)
+        self.n_files = 0
+        self.n_iter = 0
+
+    def add(self, f):
+        h = _open_input(f)
+        header = _read_xml_header(h)
+        if self.n_files == 0:
+            self.f_out.write(header)
+        n_iter = self.n_iter
+        f_out = self.f_out
         for line in h:
-            if "</BlastOutput_iterations>" in line:
+            if b'<Iteration_' in line:
+                m = ITER_NUM.match(line)
+                if m is not None:
+                    n_iter += 1
+                    line = m.group(1) + str(n_iter).encode() + m.group(2)
+                else:
+                    m = QUERY_ID.match(line)
+                    if m is not None:
+                        line = m.group(1) + str(n_iter).encode() + m.group(2)
+            elif b'</BlastOutput_iterations>' in line:
                 break
-            #TODO - Increment <Iteration_iter-num> and if required automatic query names
-            #like <Iteration_query-ID>Query_3</Iteration_query-ID> to be increasing?
             f_out.write(line)
         h.close()
-    f_out.write("  </BlastOutput_iterations>\n")
-    f_out.write("</BlastOutput>\n")
-    f_out.close()
+        self.n_iter = n_iter
+        self.n_files += 1
 
+    def close(self):
+        self.f_out.write(b"  </BlastOutput_iterations>\n")
+        self.f_out.write(b"</BlastOutput>\n")
+        self.f_out.close()
+        os.rename(self.part, self.out_file)
+        log.info(str(self.n_files) + ' chunks merged in ' + self.out_file + ', ' + str(self.n_iter) + ' iterations.')
 
-def _wait_job(cluster=str, jobid=int):
-    qstat_cmd = _get_qstat_cmd(cluster,jobid)
-    log.info('Waiting job array ' + jobid)
-    pipes = subprocess.Popen(qstat_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = pipes.communicate()
-    stdoutdata = stdout.decode("utf-8").split("\n")
-    while len(stdoutdata) > 2:
-        log.debug('job ' + jobid + ' still runing...')
-        time.sleep(20)
-        pipes = subprocess.Popen(qstat_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = pipes.communicate()
-        stdoutdata = stdout.decode("utf-8").split("\n")
-        log.debug(stdoutdata)
+    def abort(self):
+        self.f_out.close()
+        os.remove(self.part)
+
+
+def _read_xml_header(h):
+    """
+    Lines up to <BlastOutput_iterations>, None if not found in XML_HEADER_MAX bytes.
+    """
+    header = b''
+    for line in h:
+        header += line
+        if b'<BlastOutput_iterations>' in line:
+            return header
+        if len(header) > XML_HEADER_MAX:
+            break
+    return None
+
+
+def _check_xml(f):
+    """
+    Check the header and the end of a chunk BLAST XML file,
+    return the error or None. A gzip file is read up to its end.
+    """
+    if os.path.getsize(f) == 0:
+        return 'BLAST XML file %s is empty' % f
+    h = _open_input(f)
+    try:
+        header = _read_xml_header(h)
+        if f.endswith('.gz'):
+            tail = b''
+            for block in iter(functools.partial(h.read, COPY_BUFFER), b''):
+                tail = (tail + block)[-XML_FOOTER_MAX:]
+        else:
+            h.seek(max(0, os.path.getsize(f) - XML_FOOTER_MAX))
+            tail = h.read()
+    except (EOFError, IOError, zlib.error) as e:
+        return 'cannot read %s: %s' % (f, e)
+    finally:
+        h.close()
+    if header is None:
+        return 'BLAST XML file %s has no <BlastOutput_iterations> in its header' % f
+    lines = header.split(b'\n')
+    if lines[0].strip() != b'<?xml version="1.0"?>':
+        return '%s is not an XML file' % f
+    if lines[1].strip() not in XML_DOCTYPES:
+        return '%s is not a BLAST XML file' % f
+    if b'<BlastOutput>' not in header:
+        return '%s is not a BLAST XML file' % f
+    tail = tail.rstrip()
+    if not tail.endswith(b'</BlastOutput>') or b'</BlastOutput_iterations>' not in tail:
+        return 'BLAST XML file %s ended prematurely' % f
+    return None
+
+
+def _run_local(n_chunks, o_d, prog, db, n_cpu, tc, cores, outfmt, max_target_seqs, out_file, retries, compress=False):
+    """
+    Run the chunks on this host, each BLAST with n_cpu threads and at most
+    tc of them at once within cores. Chunks are checked as they finish and
+    appended to out_file in chunk order while the next ones run. A failed
+    chunk is run again up to retries times, then stops the run: running
+    BLAST are killed, no merged output is left. With compress, chunks and
+    their results are gzipped (see _blast_line).
+    """
+    n_cpu = _local_threads(n_cpu, cores)
+    workers = max(1, min(tc, cores // n_cpu, n_chunks))
+    log.info('running ' + str(n_chunks) + ' chunks locally, ' + str(workers) + ' at once with ' + str(n_cpu) + ' threads each.')
+    ext = _result_ext(outfmt, compress)
+    if outfmt == 5:
+        merger = XmlMerger(out_file)
+    else:
+        merger = M8Merger(out_file)
+    runner = LocalRunner(workers)
+    futures = {}
+    attempts = {}
+    for i in range(1, n_chunks + 1):
+        cmd = _blast_cmd(prog, o_d, db, i, outfmt, max_target_seqs, n_cpu, compress)
+        futures[runner.submit(cmd, o_d + '/' + 'group_%i.log' % i)] = i
+        attempts[i] = 1
+    finished = set()
+    next_chunk = 1
+    error = None
+    while futures and error is None:
+        completed = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)[0]
+        for future in completed:
+            i = futures.pop(future)
+            error = _chunk_error(future, o_d + '/' + 'group_%i.%s' % (i, ext), outfmt)
+            if error is not None and attempts[i] <= retries:
+                log.warning('chunk ' + str(i) + ': ' + error + ', attempt ' + str(attempts[i] + 1) + '.')
+                attempts[i] += 1
+                error = None
+                cmd = _blast_cmd(prog, o_d, db, i, outfmt, max_target_seqs, n_cpu, compress)
+                futures[runner.submit(cmd, o_d + '/' + 'group_%i.log' % i)] = i
+                continue
+            if error is not None:
+                break
+            with open(o_d + '/' + 'group_%i.time' % i, 'w') as fh:
+                fh.write(str(runner.elapsed[o_d + '/' + 'group_%i.log' % i]) + '\n')
+            finished.add(i)
+        while next_chunk in finished:
+            merger.add(o_d + '/' + 'group_%i.%s' % (next_chunk, ext))
+            finished.remove(next_chunk)
+            next_chunk += 1
+    if error is not None:
+        log.critical('chunk ' + str(i) + ': ' + error)
+        runner.stop()
+        runner.shutdown()
+        merger.abort()
+        raise ValueError('chunk %i of %s failed' % (i, o_d))
+    runner.shutdown()
+    merger.close()
+
+
+def _chunk_error(future, result, outfmt):
+    """
+    Error of a finished local chunk or None.
+    """
+    try:
+        code = future.result()
+    except OSError as e:
+        return 'cannot run BLAST: ' + str(e)
+    if code is None:
+        return 'not run'
+    if code != 0:
+        return 'BLAST exited with code ' + str(code)
+    if not os.path.exists(result):
+        return 'no result ' + result
+    if outfmt == 5:
+        return _check_xml(result)
+    return None
 
 
-def _get_qstat_cmd(cluster=str, jobid=int) :
-    qstat_cmd = ''
+def _local_threads(n_cpu, cores):
+    """
+    Threads of each BLAST run by _run_local, n_cpu within cores.
+    """
+    if n_cpu > cores:
+        log.warning('n_cpu ' + str(n_cpu) + ' reduced to the ' + str(cores) + ' available cores.')
+        return cores
+    return n_cpu
+
+
+def _blast_cmd(prog, o_d, db, i, outfmt, max_target_seqs, n_cpu, compress=False):
+    """
+    Command of the chunk i, the one of the cluster scripts.
+    """
+    query = o_d + '/' + 'group_%i.fa' % i
+    result = o_d + '/' + 'group_%i.%s' % (i, RESULT_EXT[outfmt])
+    if compress:
+        return ['/bin/sh', '-c', _blast_line(prog, shlex.quote(query), shlex.quote(db), shlex.quote(result), outfmt, max_target_seqs, n_cpu, compress)]
+    return [prog, '-query', query, '-db', db, '-out', result,
+        '-evalue', str(EVALUE), '-outfmt', str(outfmt), '-max_target_seqs', str(max_target_seqs), '-parse_deflines',
+        '-num_threads', str(n_cpu)]
+
+
+def _blast_line(prog, query, db, result, outfmt, max_target_seqs, n_cpu, compress=False):
+    """
+    Shell command running BLAST on the chunk file query. With compress,
+    the chunk is query.gz, read through gzip, and the result is gzipped
+    in result.gz once BLAST succeeded.
+    """
+    options = '-db %s -evalue %s -outfmt %d -max_target_seqs %d -parse_deflines -num_threads %i' % (db, EVALUE, outfmt, max_target_seqs, n_cpu)
+    if not compress:
+        return '%s -query %s %s -out %s' % (prog, query, options, result)
+    # the status of a pipe is the one of BLAST, the chunk is tested after
+    return 'gzip -dc %s.gz | %s -query - %s -out %s && gzip -t %s.gz && gzip -%i -f %s' % (query, prog, options, result, query, CHUNK_GZIP_LEVEL, result)
+
+
+def _result_ext(outfmt, compress=False):
+    """
+    Extension of the chunk results.
+    """
+    if compress:
+        return RESULT_EXT[outfmt] + '.gz'
+    return RESULT_EXT[outfmt]
+
+
+class LocalRunner:
+    """
+    Pool of threads, each one running a command and waiting for it.
+    The output of a command goes to its log file, its wall time
+    to elapsed[log_file]. Each command runs in its own process group,
+    killed as a whole (e.g. a BLAST reading from gzip -dc under sh).
+    """
+
+    def __init__(self, workers):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.procs = set()
+        self.stopped = False
+        self.elapsed = {}
+
+    def submit(self, cmd, log_file):
+        """
+        Return a future giving the exit code of cmd, None if the
+        runner was stopped before cmd started.
+        """
+        return self.pool.submit(self._run, cmd, log_file)
+
+    def stop(self):
+        """
+        Kill the running commands, the pending ones will not start.
+        """
+        with self.lock:
+            self.stopped = True
+            for p in self.procs:
+                try:
+                    os.killpg(p.pid, signal.SIGTERM)
+                except OSError:
+                    # the group already ended
+                    pass
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+    def _run(self, cmd, log_file):
+        with self.lock:
+            if self.stopped:
+                return None
+            log.debug(cmd)
+            fh = open(log_file, 'wb')
+            p = subprocess.Popen(cmd, stdout=fh, stderr=subprocess.STDOUT, start_new_session=True)
+            self.procs.add(p)
+            start = time.time()
+        code = p.wait()
+        self.elapsed[log_file] = round(time.time() - start, 3)
+        fh.close()
+        with self.lock:
+            self.procs.discard(p)
+        return code
+
+
+class ChunkTracker:
+    """
+    Follow the chunks of a cluster run from the files written by their
+    tasks (see _load_script) and the state of their jobs.
+    A chunk is done when its exit code is 0 and its result is complete.
+    A chunk whose task failed, or whose job ended without exit code, is
+    submitted again up to retries times, the task of a job in error being
+    cancelled first.
+    With speculate, once half of the chunks are done, a chunk running for
+    more than speculate times their median time is split in two halves
+    submitted as new chunks. The chunk is resolved by itself or by both
+    halves, whichever comes first, and the other tasks are cancelled.
+    submit(ids) returns {jobid: ids}, cancel(jobid, ids) kills tasks.
+    With compress, chunks and results are gzipped.
+    """
+
+    def __init__(self, o_d, n_chunks, outfmt, submit, cancel, monitor, retries=2, speculate=None, compress=False):
+        self.o_d = o_d
+        self.n_chunks = n_chunks
+        self.outfmt = outfmt
+        self.compress = compress
+        self.ext = _result_ext(outfmt, compress)
+        self.submit = submit
+        self.cancel = cancel
+        self.monitor = monitor
+        self.retries = retries
+        self.speculate = speculate
+        # submitted, done or failed (no attempt left)
+        self.state = {}
+        self.job_of = {}
+        self.attempts = {}
+        self.halves = {}
+        self.parent = {}
+        self.next_id = n_chunks + 1
+
+    def run(self):
+        """
+        Submit the chunks and wait until each one is resolved.
+        Return the result files in chunk order.
+        """
+        self._submit(list(range(1, self.n_chunks + 1)))
+        interval = self.monitor.interval
+        while True:
+            self.monitor.poll()
+            changed = self._update()
+            left = len([c for c in range(1, self.n_chunks + 1) if self.files(c) is None])
+            if left == 0:
+                break
+            if changed:
+                interval = self.monitor.interval
+            else:
+                interval = min(interval * self.monitor.factor, self.monitor.max_interval)
+            log.debug(str(left) + ' chunks left, next check in ' + str(interval) + ' seconds.')
+            time.sleep(interval)
+        self._cancel([i for i in self.state if self.state[i] == 'submitted'])
+        files = []
+        for c in range(1, self.n_chunks + 1):
+            files += self.files(c)
+        return files
+
+    def files(self, c):
+        """
+        Result files of the chunk c, None while it is not resolved.
+        """
+        if self.state[c] == 'done':
+            return [self._path(c, self.ext)]
+        if self.halves.get(c) and all([self.state[h] == 'done' for h in self.halves[c]]):
+            return [self._path(h, self.ext) for h in self.halves[c]]
+        return None
+
+    def _update(self):
+        changed = False
+        retry = []
+        for i in sorted(self.state):
+            if self.state[i] != 'submitted':
+                continue
+            code = self._read(i, 'exit')
+            if code is None:
+                job_state = self.monitor.jobs[self.job_of[i]]
+                if job_state not in ['done', 'error']:
+                    continue
+                error = 'job ended without exit code'
+                if job_state == 'error':
+                    # a task in error (SGE Eqw) stays queued, deleted before another copy runs
+                    error = 'job in error'
+                    self.cancel(self.job_of[i], [i])
+            elif code != 0:
+                error = 'exit code ' + str(int(code))
+            else:
+                error = self._result_error(i)
+            changed = True
+            if error is None:
+                self.state[i] = 'done'
+                continue
+            c = self.parent.get(i, i)
+            if self.files(c) is not None:
+                # already resolved by the other tasks
+                self.state[i] = 'failed'
+            elif self.attempts[i] <= self.retries:
+                log.warning('chunk ' + str(i) + ': ' + error + ', attempt ' + str(self.attempts[i] + 1) + '.')
+                retry.append(i)
+            else:
+                self.state[i] = 'failed'
+                log.critical('chunk ' + str(i) + ': ' + error + ' after ' + str(self.attempts[i]) + ' attempts.')
+                if not self._alive(c):
+                    self._cancel([j for j in self.state if self.state[j] == 'submitted'])
+                    raise ValueError('chunk %i of %s failed' % (c, self.o_d))
+        if retry:
+            self._submit(retry)
+        if self.speculate:
+            changed = self._speculate() or changed
+        return changed
+
+    def _alive(self, c):
+        """
+        Whether the chunk c can still be resolved by itself or its halves.
+        """
+        if self.state[c] != 'failed':
+            return True
+        halves = self.halves.get(c)
+        return bool(halves) and 'failed' not in [self.state[h] for h in halves]
+
+    def _speculate(self):
+        times = [self._read(c, 'time') for c in range(1, self.n_chunks + 1) if self.state[c] == 'done']
+        times = sorted([t for t in times if t is not None])
+        if len(times) * 2 < self.n_chunks:
+            return False
+        limit = self.speculate * max(times[len(times) // 2], 1)
+        split = False
+        for c in range(1, self.n_chunks + 1):
+            if self.state[c] != 'submitted' or c in self.halves:
+                continue
+            start = self._read(c, 'start')
+            if start is not None and time.time() - start > limit:
+                self._split(c)
+                split = True
+        return split
+
+    def _split(self, c):
+        """
+        Write the two halves (by residues) of the chunk c and submit them.
+        """
+        fasta = self._path(c, 'fa')
+        if self.compress:
+            with gzip.open(fasta + '.gz', 'rb') as src, open(fasta, 'wb') as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFFER)
+        offsets, sizes, residues = _index_fasta(fasta)
+        if len(offsets) < 2:
+            self.halves[c] = []
+            if self.compress:
+                os.remove(fasta)
+            return
+        half = sum(residues) / 2
+        k = 0
+        done = 0
+        while k < len(offsets) - 1 and (k == 0 or done + residues[k] / 2 <= half):
+            done += residues[k]
+            k += 1
+        runs = [array.array('q', [offsets[0], offsets[k - 1] + sizes[k - 1]]),
+                array.array('q', [offsets[k], offsets[-1] + sizes[-1]])]
+        first = self.next_id
+        self.next_id += 2
+        _write_chunks(fasta, runs, self.o_d, first, self.compress)
+        if self.compress:
+            os.remove(fasta)
+        self.halves[c] = [first, first + 1]
+        for h in self.halves[c]:
+            self.parent[h] = c
+            self.attempts[h] = 0
+        log.info('chunk ' + str(c) + ' is a straggler, racing its halves ' + str(first) + ' and ' + str(first + 1) + '.')
+        self._submit(self.halves[c])
+
+    def _submit(self, ids):
+        for i in ids:
+            for ext in ['start', 'exit', 'time', self.ext]:
+                if os.path.exists(self._path(i, ext)):
+                    os.remove(self._path(i, ext))
+        jobs = self.submit(ids)
+        for jobid in jobs:
+            self.monitor.watch(jobid)
+            for i in jobs[jobid]:
+                self.job_of[i] = jobid
+                self.attempts[i] = self.attempts.get(i, 0) + 1
+                self.state[i] = 'submitted'
+
+    def _cancel(self, ids):
+        jobs = {}
+        for i in ids:
+            jobs.setdefault(self.job_of[i], []).append(i)
+            self.state[i] = 'failed'
+        for jobid in jobs:
+            if self.monitor.jobs[jobid] not in ['done', 'error']:
+                self.cancel(jobid, jobs[jobid])
+
+    def _result_error(self, i):
+        result = self._path(i, self.ext)
+        if not os.path.exists(result):
+            return 'no result ' + result
+        if self.outfmt == 5:
+            return _check_xml(result)
+        return None
+
+    def _read(self, i, ext):
+        try:
+            with open(self._path(i, ext)) as fh:
+                return float(fh.read().strip())
+        except (IOError, ValueError):
+            return None
+
+    def _path(self, i, ext):
+        return self.o_d + '/' + 'group_%i.%s' % (i, ext)
+
+
+def _get_scheduler(cluster=str):
     if cluster == 'enki':
-        qstat_cmd = ['qstat', '-j',str(jobid)]
-    elif cluster == 'genologin':
-        qstat_cmd = ['squeue', '-j',str(jobid)]
-    elif cluster == 'genouest':
-        qstat_cmd = ['squeue', '-j',str(jobid)]
-    elif cluster == 'curta':
-        qstat_cmd = ['qstat', '-i',str(jobid)]
+        return 'sge'
+    elif cluster in ['genologin', 'genouest', 'curta']:
+        return 'slurm'
     else:
         log.critical('unknown cluster.')
-    return qstat_cmd
 
 
-def _launch_jobs(n_f, o_d, prefix, cluster, prog, db, n_cpu, tc, outfmt, max_target_seqs, mem):
-    script = _load_script(cluster,prog)
+def _write_script(o_d, cluster, prog, db, n_cpu, outfmt, max_target_seqs, compress=False):
+    chunk = o_d + '/' + 'group_' + _task_variable(cluster)
+    blast = _blast_line(prog, chunk + '.fa', db, chunk + '.' + RESULT_EXT[outfmt], outfmt, max_target_seqs, n_cpu, compress)
+    script = _load_script(cluster, chunk, blast)
     blt_script = o_d + '/' + 'blast_script.sh'
     fw = open(blt_script, mode='w')
-    fw.write(script % (prog, o_d, db, o_d, 0.001, outfmt, max_target_seqs, n_cpu))
+    fw.write(script)
     fw.close()
-    qsub_cmd, job_regex = _get_qsub_cmd(cluster,n_f,o_d,n_cpu,tc,mem,blt_script)
-    log.info(qsub_cmd)
-    pipes = subprocess.Popen(qsub_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = pipes.communicate()
-    stdoutdata = stdout.decode("utf-8")
-    log.debug(stdoutdata)
-    # stdoutdata = subprocess.getoutput(qsub_cmd)
-    # log.debug(stdoutdata)
-    p = re.compile(job_regex)
-    m = p.match(stdoutdata)
-    try:
-        jobid = m.group(1)
-    except AttributeError:
-        jobid = m.group()
-    log.debug('job launch with jobid ' + jobid + '.')
-    time.sleep(10)
-    return jobid
-
-def _get_qsub_cmd(cluster=str, n_f=str, o_d=str, n_cpu=int, tc=int, mem=int, blt_script=str):
+    return blt_script
+
+
+def _submit_chunks(cluster, o_d, n_cpu, tc, mem, blt_script, ids):
+    """
+    Submit the array tasks ids: in one job with SLURM, in one
+    job per range of consecutive ids with SGE. Return {jobid: ids}.
+    """
+    ranges = []
+    for i in sorted(ids):
+        if ranges and ranges[-1][1] == i - 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    specs = ['%i-%i' % (r[0], r[1]) for r in ranges]
+    if _get_scheduler(cluster) == 'sge':
+        groups = [(specs[j], list(range(ranges[j][0], ranges[j][1] + 1))) for j in range(len(ranges))]
+    else:
+        groups = [(','.join(specs), sorted(ids))]
+    jobs = {}
+    for spec, group in groups:
+        qsub_cmd, job_regex = _get_qsub_cmd(cluster,spec,o_d,n_cpu,tc,mem,blt_script)
+        log.info(qsub_cmd)
+        pipes = subprocess.Popen(qsub_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = pipes.communicate()
+        stdoutdata = stdout.decode("utf-8")
+        log.debug(stdoutdata)
+        p = re.compile(job_regex)
+        m = p.match(stdoutdata)
+        try:
+            jobid = m.group(1)
+        except AttributeError:
+            jobid = m.group()
+        log.debug('job launch with jobid ' + jobid + '.')
+        jobs[jobid] = group
+    return jobs
+
+
+def _cancel_chunks(cluster, jobid, ids):
+    if _get_scheduler(cluster) == 'sge':
+        cmds = [['qdel', jobid, '-t', '%i-%i' % (i, i)] for i in ids]
+    else:
+        cmds = [['scancel'] + [jobid + '_' + str(i) for i in ids]]
+    for cmd in cmds:
+        log.debug(cmd)
+        subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _get_qsub_cmd(cluster=str, tasks=str, o_d=str, n_cpu=int, tc=int, mem=int, blt_script=str):
     qsub_cmd = ''
     job_regex = ''
     if cluster == 'enki':
-        qsub_cmd = ['qsub', '-V', '-t', '1-' + str(n_f+1), '-tc', str(tc), '-wd', o_d, '-pe', 'multithread', str(n_cpu), blt_script]
-        job_regex = '^Your job-array (\d+)\.1-\d+'
+        qsub_cmd = ['qsub', '-V', '-t', tasks, '-tc', str(tc), '-wd', o_d, '-pe', 'multithread', str(n_cpu), blt_script]
+        job_regex = r'^Your job-array (\d+)\.\d+-\d+'
     elif cluster == 'curta':
-        qsub_cmd = ['sbatch', '--export=ALL', '--array=1-' + str(n_f+1), '-D' , o_d, '--time=250:00:00',
+        qsub_cmd = ['sbatch', '--export=ALL', '--array=' + tasks, '-D' , o_d, '--time=250:00:00',
             '--mem=' + str(mem) + 'G', '--nodes=1 --ntasks=', str(n_cpu), blt_script]
-        job_regex = '^Submitted batch job (\d+)'
+        job_regex = r'^Submitted batch job (\d+)'
     elif cluster == 'genouest':
-        qsub_cmd = ['sbatch','--export=ALL', '--array=1-' + str(n_f+1) + '%10' , '--ntasks-per-node=' + str(tc), '-D', o_d,
+        qsub_cmd = ['sbatch','--export=ALL', '--array=' + tasks + '%10' , '--ntasks-per-node=' + str(tc), '-D', o_d,
             '--mem=' + str(mem) + 'G', '--cpus-per-task=' + str(n_cpu), blt_script]
-        job_regex = '^Submitted batch job (\d+)'
+        job_regex = r'^Submitted batch job (\d+)'
     elif cluster == 'genologin':
-        qsub_cmd = ['sbatch','--export=ALL', '--array=1-' + str(n_f+1) + '%50' , '--ntasks-per-node=' + str(tc), '-D', o_d,
+        qsub_cmd = ['sbatch','--export=ALL', '--array=' + tasks + '%50' , '--ntasks-per-node=' + str(tc), '-D', o_d,
             '--mem=' + str(mem) + 'G', '--cpus-per-task=' + str(n_cpu), blt_script]
-        job_regex = '^Submitted batch job (\d+)'
+        job_regex = r'^Submitted batch job (\d+)'
         # job_regex = '^Waiting job array (\d+)'
 
     else:
@@ -186,66 +1113,367 @@ def _get_qsub_cmd(cluster=str, n_f=str, o_d=str, n_cpu=int, tc=int, mem=int, blt
     return qsub_cmd, job_regex
 
 
-def _split_fasta(fasta,chunk,directory,rand):
-    record_iter = SeqIO.parse(open(fasta),'fasta')
-    if rand:
-        record_iter = sorted(record_iter, key=lambda k : random.random())
-    for i, batch in enumerate(batch_iterator(iter(record_iter), chunk)):
-        filename = directory + '/' + "group_%i.fa" % (i + 1)
-        with open(filename, "w") as handle:
-            count = SeqIO.write(batch, handle, "fasta")
-    log.info(fasta + ' file splited in ' + str(i+1) + ' part in ' + directory + '.')
-    return i
-
-
-def batch_iterator(iterator, batch_size):
-    entry = True
-    while entry:
-        batch = []
-        while len(batch) < batch_size:
+def _auto_chunk(residues, prog, db, host, n_cpu, target_time, max_chunks, history):
+    """
+    Sequences per chunk so that a chunk of n_cpu threads takes about
+    target_time seconds, from the core seconds per residue of prog on db
+    in the history of host, of prog on any database of host, or
+    DEFAULT_COST. There are at most max_chunks chunks.
+    """
+    if not residues:
+        return 1
+    cost, source = _residue_cost(history, prog, db, host)
+    total = sum(residues)
+    n_chunks = int(math.ceil(total * cost / (n_cpu * target_time)))
+    n_chunks = max(1, min(n_chunks, max_chunks, len(residues)))
+    chunk = int(math.ceil(len(residues) / n_chunks))
+    log.info('%i residues, %g core seconds per residue (%s): %i sequences per chunk.' % (total, cost, source, chunk))
+    return chunk
+
+
+def _residue_cost(history, prog, db, host):
+    """
+    Core seconds per residue and where it comes from. Chunks shorter than
+    HISTORY_MIN_SECONDS are left out, and fewer than HISTORY_MIN_CHUNKS
+    chunks do not replace DEFAULT_COST.
+    """
+    rows = [r for r in _read_history(history) if r[0] == prog and r[2] == host and r[5] >= HISTORY_MIN_SECONDS]
+    for source, selected in [(prog + ' on ' + db, [r for r in rows if r[1] == db]),
+                             (prog + ' on all databases', rows)]:
+        selected = selected[-HISTORY_MAX:]
+        if len(selected) >= HISTORY_MIN_CHUNKS:
+            return sum([r[3] * r[5] for r in selected]) / sum([r[4] for r in selected]), str(len(selected)) + ' chunks of ' + source
+    return DEFAULT_COST[prog], 'default'
+
+
+def _read_history(history):
+    """
+    Chunk timings [prog, db, host, n_cpu, residues, seconds] of previous
+    runs. Rows without host, written before it was recorded, are skipped.
+    """
+    rows = []
+    if not os.path.exists(history):
+        return rows
+    with open(history) as fh:
+        for line in fh:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 6 or line.startswith('#'):
+                continue
             try:
-                entry = next(iterator)
-            except StopIteration:
-                entry = None
-            if entry is None:
-                break
-            batch.append(entry)
-        if batch:
-            yield batch
+                row = [fields[0], fields[1], fields[2], int(fields[3]), int(fields[4]), float(fields[5])]
+            except ValueError:
+                continue
+            if row[4] > 0:
+                rows.append(row)
+    return rows
+
+
+def _chunk_times(path, n_chunks):
+    """
+    Wall time of each chunk read from group_N.time, None when not recorded.
+    """
+    times = []
+    for i in range(1, n_chunks + 1):
+        f = path + '/' + 'group_%i.time' % i
+        try:
+            with open(f) as fh:
+                times.append(float(fh.read().strip()))
+        except (IOError, ValueError):
+            times.append(None)
+    return times
+
+
+def _record_history(history, prog, db, host, n_cpu, loads, times):
+    """
+    Append the timings of the chunks, run on host with n_cpu threads each,
+    to the history.
+    """
+    lines = ''
+    n_chunks = 0
+    for i in range(len(loads)):
+        if times[i] is not None and loads[i] > 0:
+            lines += '\t'.join([prog, db, host, str(n_cpu), str(loads[i]), str(times[i])]) + '\n'
+            n_chunks += 1
+    log.info('recording the timings of ' + str(n_chunks) + ' chunks run with ' + str(n_cpu) + ' threads each in ' + history + '.')
+    try:
+        with open(history, 'a') as fh:
+            fh.write(lines)
+    except IOError as e:
+        log.warning('cannot record chunk timings in ' + history + ': ' + str(e))
+
+
+def _split_fasta(fasta,chunk,directory,rand,index=None,compress=False):
+    """
+    Split fasta in ceil(records / chunk) files group_N.fa. With rand, records
+    are balanced between the files by residue count, otherwise each file gets
+    chunk consecutive records. Records are copied as they are in fasta.
+    index is the result of _index_fasta when already computed.
+    With compress, the files are gzipped (group_N.fa.gz).
+    Return the number of residues of each file.
+    """
+    if index is None:
+        index = _index_fasta(fasta)
+    offsets, sizes, residues = index
+    if not offsets:
+        log.critical(fasta + ' contains no sequence.')
+        sys.exit(1)
+    n_chunks = int(math.ceil(len(offsets) / chunk))
+    if rand:
+        chunk_of = _balance_chunks(residues, n_chunks)
+        runs = _chunk_runs(offsets, sizes, chunk_of, n_chunks)
+        loads = [0] * n_chunks
+        for i in range(len(residues)):
+            loads[chunk_of[i]] += residues[i]
+    else:
+        runs = []
+        loads = []
+        for c in range(n_chunks):
+            last = min((c + 1) * chunk, len(offsets)) - 1
+            runs.append(array.array('q', [offsets[c * chunk], offsets[last] + sizes[last]]))
+            loads.append(sum(residues[c * chunk:last + 1]))
+    _write_chunks(fasta, runs, directory, 1, compress)
+    log.info(fasta + ' file splited in ' + str(n_chunks) + ' part in ' + directory + '.')
+    log.info('residues per part: min ' + str(min(loads)) + ', max ' + str(max(loads)) + '.')
+    return loads
+
+
+def _index_fasta(fasta):
+    """
+    Byte offset, byte length and number of residues of each record.
+    Records are matched on the memory-mapped file, the sequences are
+    only read to count their residues.
+    """
+    offsets = array.array('q')
+    sizes = array.array('q')
+    residues = array.array('q')
+    with open(fasta, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return offsets, sizes, residues
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        # skip what is before the first record
+        start = 0
+        if mm[0:1] != b'>':
+            start = mm.find(b'\n>') + 1
+        if start > 0 or mm[0:1] == b'>':
+            for m in RECORD.finditer(mm, start):
+                start, end = m.span()
+                seq_start = m.start(1)
+                offsets.append(start)
+                sizes.append(end - start)
+                if mm.find(b'\n', seq_start, end - 1) == -1:
+                    # single line sequence, no copy
+                    n = end - seq_start
+                    if n and mm[end - 1] == 10:
+                        n -= 1
+                    if n and mm[seq_start + n - 1] == 13:
+                        n -= 1
+                    residues.append(n)
+                else:
+                    seq = mm[seq_start:end]
+                    residues.append(len(seq) - seq.count(b'\n') - seq.count(b'\r'))
+        mm.close()
+    return offsets, sizes, residues
+
+
+def _balance_chunks(residues, n_chunks):
+    """
+    Longest processing time first: from the longest, each record goes to
+    the chunk having the fewest residues. Records are grouped by power of two
+    length classes. Classes larger than SORT_LIMIT are not sorted, their
+    records go by blocks of consecutive records (at most 1/64 of the share
+    of a chunk) so chunks stay made of long byte ranges.
+    """
+    classes = {}
+    for i in range(len(residues)):
+        classes.setdefault(residues[i].bit_length(), array.array('q')).append(i)
+    heap = [(0, c) for c in range(n_chunks)]
+    chunk_of = array.array('l', [0]) * len(residues)
+    for length_class in sorted(classes, reverse=True):
+        records = classes.pop(length_class)
+        block = 1
+        if len(records) <= SORT_LIMIT:
+            records = sorted(records, key=residues.__getitem__, reverse=True)
+        else:
+            block = max(1, min(BLOCK, len(records) // (n_chunks * 64)))
+        for b in range(0, len(records), block):
+            load, c = heap[0]
+            for i in records[b:b + block]:
+                chunk_of[i] = c
+                load += residues[i]
+            heapq.heapreplace(heap, (load, c))
+    return chunk_of
+
+
+def _chunk_runs(offsets, sizes, chunk_of, n_chunks):
+    """
+    Byte ranges of each chunk as [start, end, start, end, ...],
+    consecutive records of a chunk being merged in one range.
+    """
+    runs = [array.array('q') for c in range(n_chunks)]
+    for i in range(len(chunk_of)):
+        r = runs[chunk_of[i]]
+        if r and r[-1] == offsets[i]:
+            r[-1] += sizes[i]
+        else:
+            r.append(offsets[i])
+            r.append(offsets[i] + sizes[i])
+    return runs
+
+
+def _write_chunks(fasta, runs, directory, first=1, compress=False):
+    """
+    Write each chunk file in turn from its byte ranges of fasta: by
+    os.sendfile for large ranges, smaller ones are gathered from the
+    memory-mapped file and written by os.writev. Files are numbered
+    from first. With compress, the ranges of the memory-mapped file
+    go through gzip in group_N.fa.gz.
+    """
+    with open(fasta, 'rb') as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mm)
+        for c in range(len(runs)):
+            if compress:
+                _write_gzip_chunk(directory + '/' + "group_%i.fa.gz" % (c + first), view, runs[c])
+                runs[c] = None
+                continue
+            out = os.open(directory + '/' + "group_%i.fa" % (c + first), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            gathered = []
+            size = 0
+            r = runs[c]
+            for j in range(0, len(r), 2):
+                if r[j + 1] - r[j] >= SENDFILE_MIN:
+                    _write_views(out, gathered, size)
+                    gathered = []
+                    size = 0
+                    _copy_range(fh, out, r[j], r[j + 1] - r[j])
+                else:
+                    gathered.append(view[r[j]:r[j + 1]])
+                    size += r[j + 1] - r[j]
+                    if len(gathered) == IOV_MAX:
+                        _write_views(out, gathered, size)
+                        gathered = []
+                        size = 0
+            # the last record of the file may lack its end of line
+            if r[-1] == len(mm) and mm[-1:] != b'\n':
+                gathered.append(b'\n')
+                size += 1
+            _write_views(out, gathered, size)
+            os.close(out)
+            runs[c] = None
+        gathered = None
+        view.release()
+        mm.close()
+
+
+def _write_gzip_chunk(path, view, r):
+    """
+    Write the byte ranges r of the memory-mapped fasta view in the gzip
+    file path, the last record ending with a line break.
+    """
+    with gzip.open(path, 'wb', compresslevel=CHUNK_GZIP_LEVEL) as out:
+        for j in range(0, len(r), 2):
+            out.write(view[r[j]:r[j + 1]])
+        if r[-1] == len(view) and view[-1:] != b'\n':
+            out.write(b'\n')
+
+
+def _write_views(fd, views, size):
+    """
+    Write a list of buffers of size bytes in total, by a single
+    os.writev when possible.
+    """
+    if not views:
+        return
+    if hasattr(os, 'writev'):
+        written = os.writev(fd, views)
+    else:
+        written = os.write(fd, b''.join(views))
+    if written < size:
+        # short write, send the rest buffer by buffer
+        for v in views:
+            if written >= len(v):
+                written -= len(v)
+                continue
+            v = v[written:]
+            written = 0
+            while len(v):
+                v = v[os.write(fd, v):]
+
+
+def _copy_range(src, dst, offset, count):
+    """
+    Copy count bytes of the file src from offset to the descriptor dst,
+    in the kernel when os.sendfile is available.
+    """
+    while count > 0:
+        try:
+            sent = os.sendfile(dst, src.fileno(), offset, count)
+        except (AttributeError, OSError):
+            src.seek(offset)
+            sent = os.write(dst, src.read(min(count, COPY_BUFFER)))
+        if sent == 0:
+            raise IOError('unexpected end of file while copying records')
+        offset += sent
+        count -= sent
 
 
 def _set_options():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-s','--seq',help='The fasta sequence file.',action='store',type=str,required=True)
-    parser.add_argument('-c','--cluster',help='The cluster name.',action='store',type=str,required=True,default='avakas',choices=['enki','genologin','genouest', 'curta'])
-    parser.add_argument('-n','--num_chunk',dest='chunk',help='The number of chunks to split the fasta in.',action='store',type=int,default=100)
+    parser.add_argument('-s','--seq',help='The fasta sequence files, identical sequences of several files are searched once.',action='store',type=str,nargs='+',required=True)
+    parser.add_argument('-c','--cluster',help='The cluster name.',action='store',type=str,required=True,default='avakas',choices=['enki','genologin','genouest', 'curta', 'local'])
+    parser.add_argument('-n','--num_chunk',dest='chunk',help='The number of sequences per chunk, the fasta is split in ceil(sequences / num_chunk) chunks. Chosen from --target_time when not given.',action='store',type=int,default=None)
+    parser.add_argument('--target_time',help='Wall time of a chunk (seconds) used to choose the number of chunks.',action='store',type=float,default=1800)
+    parser.add_argument('--max_chunks',help='Maximum number of chunks chosen from --target_time.',action='store',type=int,default=1000)
+    parser.add_argument('--history',help='Chunk timings of the previous runs, used to choose the number of chunks.',action='store',type=str,default=os.path.expanduser('~/.blast_launch_history.tsv'))
+    parser.add_argument('--monitor',help='Directory shared by the blast_launch.py runs of the user: the jobs of all the runs are followed with one scheduler query.',action='store',type=str,default=os.path.expanduser('~/.blast_launch_monitor'))
     parser.add_argument('--tc',dest='tc',help='The number of concurent jobs to launch on SGE servers.',action='store',type=int,default=100)
     parser.add_argument('--n_cpu',help='The number of cpu cores to use per job.',action='store',type=int,default=5)
+    parser.add_argument('--cores',help='With -c local, the number of cores shared by the jobs.',action='store',type=int,default=os.cpu_count())
     parser.add_argument('--mem',dest='mem',help='The number of memory to use per job in Go.',action='store',type=int,default=20)
     parser.add_argument('-p','--prog',help='The Blast program to use.',action='store',type=str,default='blastx',choices=['blastx','blastn','blastp','tblastx','rpstblastn'])
     parser.add_argument('-d','--db',help='The Blast database to use.',action='store',type=str,default='nr')
-    parser.add_argument('-o','--out',help='Output XML file.',action='store',type=str,default='blast-out.xml')
+    parser.add_argument('-o','--out',help='Output files (XML or m8), one for each --seq file, compressed with gzip if its name ends with .gz.',action='store',type=str,nargs='+',default=['blast-out.xml'])
     parser.add_argument('--outfmt',help='Output Blast format. 5: XML, 6: m8',action='store',type=int,default=5,choices=[5,6])
     parser.add_argument('--max_target_seqs',help='Maximum number of aligned sequences to keep.',action='store',type=int,default=5)
     parser.add_argument('--prefix',help='Directory prefix to store splited files.',action='store',type=str,default='split')
     parser.add_argument('--clean',help='Delete blast directory.',action='store_true')
-    parser.add_argument('-r','--random',help='Randomly split sequences to balance load between jobs.',action='store_true')
+    parser.add_argument('-r','--random',help='Balance the chunks by residue count (longest sequences first) to balance load between jobs.',action='store_true')
+    parser.add_argument('--cache',help='SQLite cache of the result of each query sequence: only the sequences not in it are searched.',action='store',type=str,default=None)
+    parser.add_argument('--retries',help='Number of times a failed chunk is submitted again.',action='store',type=int,default=2)
+    parser.add_argument('--compress',help='Gzip the chunks and their results, read through gzip by BLAST. Inputs ending with .gz or .zst are decompressed in any case.',action='store_true')
+    parser.add_argument('--speculate',help='Split in two halves, and run them besides, the chunks running for more than this number of times the median chunk time.',action='store',type=float,default=None)
     parser.add_argument('-v','--verbosity',help='Verbose level', action='store',type=int,choices=[1,2,3,4],default=1)
     args = parser.parse_args()
     return args
 
 
-def _load_script(cluster, prog):
-    script_sge = ''
+def _task_variable(cluster):
     if cluster == 'enki':
-        script_sge = "#!/bin/sh\n%s -query %s/group_$SGE_TASK_ID.fa -db %s -out %s/group_$SGE_TASK_ID.xml -evalue %f -outfmt %d -max_target_seqs %d -parse_deflines -num_threads %i"
-    elif cluster == 'genouest':
-        script_sge = "#!/bin/sh\n"
-        script_sge += "%s -query %s/group_$SLURM_ARRAY_TASK_ID.fa -db %s -out %s/group_$SLURM_ARRAY_TASK_ID.xml -evalue %f -outfmt %d -max_target_seqs %d -parse_deflines -num_threads %i"
-    elif cluster == 'genologin':
-        script_sge = "#!/bin/sh\n%s -query %s/group_$SLURM_ARRAY_TASK_ID.fa -db %s -out %s/group_$SLURM_ARRAY_TASK_ID.xml -evalue %f -outfmt %d -max_target_seqs %d -parse_deflines -num_threads %i"
-    elif  cluster == 'curta':
-        script_sge = "#!/bin/bash\n%s -query %s/group_$SLURM_ARRAY_TASK_ID.fa -db %s -out %s/group_$SLURM_ARRAY_TASK_ID.xml -evalue %f -outfmt %d -max_target_seqs %d -parse_deflines -num_threads %i"
+        return '$SGE_TASK_ID'
+    return '$SLURM_ARRAY_TASK_ID'
+
+
+def _load_script(cluster, chunk, blast):
+    """
+    Script of an array task, chunk being the path of its files without
+    extension: chunk.start gets its start time, then the blast command
+    runs, chunk.time gets its wall time if it succeeded and chunk.exit
+    its exit code.
+    """
+    if cluster in ['enki', 'genouest', 'genologin']:
+        shell = '/bin/sh'
+    elif cluster == 'curta':
+        shell = '/bin/bash'
+    else:
+        return ''
+    script_sge = "#!" + shell + "\n"
+    script_sge += "start=$(date +%s)\n"
+    script_sge += "echo $start > " + chunk + ".start\n"
+    script_sge += blast + "\n"
+    script_sge += "code=$?\n"
+    script_sge += "if [ $code -eq 0 ]; then echo $(( $(date +%s) - start )) > " + chunk + ".time; fi\n"
+    script_sge += "echo $code > " + chunk + ".exit\n"
+    script_sge += "exit $code\n"
     return script_sge
 
 
@@ -0,0 +1,167 @@
+"""
+This module is a part of the virAnnot module
+Follow the Blast runs submitted without waiting for their results (detach)
+and fetch the finished ones (collect).
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+# to allow code to work with Python 2 and 3
+from __future__ import print_function   # print is a function in python3
+from __future__ import unicode_literals # avoid adding "u" to each string
+from __future__ import division # avoid writing float(x) when dividing by x
+
+import json
+import logging as log
+import os
+import subprocess
+import time
+
+from transport import get_transport
+
+# file written on the server, in the run directory, with the exit code of blast_launch.py
+EXIT_FILE = 'blast_launch.exit'
+LOG_FILE = 'blast_launch.log'
+
+
+def state_dir():
+	return os.getcwd() + '/.virAnnot/detached'
+
+
+def record(cmd, server, out_dir, fetch):
+	"""
+	Command running cmd, the submission of a run on server in out_dir
+	(relative to its scratch directory), then storing the run with the
+	commands fetching its results and its job id, the last line printed
+	by cmd. The record of a previous run of out_dir is replaced only once
+	the submission succeeded.
+	"""
+	path = state_dir() + '/' + out_dir
+	run = json.dumps({'server': server, 'out_dir': out_dir, 'fetch': fetch, 'time': time.time()})
+	cmd = 'mkdir -p ' + state_dir() + ' && ' + cmd + ' > ' + path + '.log.tmp'
+	cmd += ' && tail -n 1 ' + path + '.log.tmp > ' + path + '.job.tmp'
+	cmd += " && printf '%s\\n' " + _quote(run) + ' > ' + path + '.json'
+	# the job file marks the run as submitted, written last
+	cmd += ' && mv ' + path + '.job.tmp ' + path + '.job && mv ' + path + '.log.tmp ' + path + '.log'
+	return cmd
+
+
+def submitted(out_dir):
+	"""
+	Whether a run of out_dir was submitted and is not collected yet.
+	"""
+	return os.path.exists(state_dir() + '/' + out_dir + '.json')
+
+
+def detach(cmd, server):
+	"""
+	Remote command starting cmd without waiting for it and printing its job
+	id. The exit code of cmd goes to EXIT_FILE.
+	"""
+	cmd += '; echo $? > ' + EXIT_FILE
+	launch = 'rm -f ' + EXIT_FILE + "\n"
+	if server == 'genologin':
+		return launch + 'sbatch --mem=2G --parsable --wrap ' + _quote(cmd)
+	return launch + 'nohup sh -c ' + _quote(cmd) + ' > ' + LOG_FILE + ' 2>&1 < /dev/null &' + "\n" + 'echo $!'
+
+
+def outstanding():
+	"""
+	Submitted runs not collected yet, with their job id.
+	"""
+	runs = []
+	directory = state_dir()
+	if not os.path.exists(directory):
+		return runs
+	for f in sorted(os.listdir(directory)):
+		if not f.endswith('.job'):
+			continue
+		path = directory + '/' + f[:-len('.job')]
+		if not os.path.exists(path + '.json'):
+			continue
+		run = json.load(open(path + '.json'))
+		run['job'] = open(path + '.job').read().strip()
+		run['path'] = path
+		runs.append(run)
+	return runs
+
+
+def collect(params, ex):
+	"""
+	Ask each server at once which of its runs ended, then fetch the results
+	of the finished ones in parallel with the executor ex (--fetch_jobs
+	at once). Runs still going on are left for the next collect.
+	"""
+	runs = outstanding()
+	if not runs:
+		log.info('No detached run to collect.')
+		return
+	servers = {}
+	for run in runs:
+		servers.setdefault(run['server'], []).append(run)
+	running = 0
+	for server in sorted(servers):
+		if server not in params['servers']:
+			log.critical(server + ' not defined in parameters file, its runs are not collected.')
+			continue
+		exits = _poll(params, server, [run['out_dir'] for run in servers[server]])
+		if exits is None:
+			continue
+		for run in servers[server]:
+			if run['out_dir'] not in exits:
+				running += 1
+			elif exits[run['out_dir']] != '0':
+				log.critical(run['out_dir'] + ' (job ' + run['job'] + ') failed on ' + server + ' with exit code ' + exits[run['out_dir']] +
+					', see ' + run['out_dir'] + '/' + LOG_FILE + '. Launch the step again.')
+				_forget(run['path'])
+			else:
+				log.info(run['out_dir'] + ' (job ' + run['job'] + ') finished on ' + server + ', fetching its results.')
+				ex.submit('collect_' + run['out_dir'], run['fetch'], 1, _fetched(run['path']))
+	failed = ex.wait()
+	if failed:
+		log.critical('Failed to fetch: ' + ', '.join(failed))
+	if running:
+		log.info(str(running) + ' detached run(s) still running.')
+
+
+def _poll(params, server, out_dirs):
+	"""
+	Exit code of the runs of out_dirs that ended on server, None if the server
+	can not be reached.
+	"""
+	script = state_dir() + '/poll_' + server + '.sh'
+	fw = open(script, mode='w')
+	fw.write('cd ' + params['servers'][server]['scratch'] + "\n")
+	fw.write('for d in ' + ' '.join(out_dirs) + '; do' + "\n")
+	fw.write('[ -f $d/' + EXIT_FILE + ' ] && echo "$d $(cat $d/' + EXIT_FILE + ')"' + "\n")
+	fw.write('done' + "\n")
+	fw.write('exit 0' + "\n")
+	fw.close()
+	cmd = get_transport(params, server).run(script)
+	log.debug(cmd)
+	try:
+		output = subprocess.check_output(cmd, shell=True).decode('utf-8')
+	except subprocess.CalledProcessError:
+		log.critical('Can not reach ' + server + ', its runs are not collected.')
+		return None
+	exits = {}
+	for line in output.splitlines():
+		fields = line.split()
+		if len(fields) == 2 and fields[0] in out_dirs:
+			exits[fields[0]] = fields[1]
+	return exits
+
+
+def _fetched(path):
+	def done(status):
+		if status == 0:
+			_forget(path)
+	return done
+
+
+def _forget(path):
+	for ext in ['.json', '.job', '.log']:
+		if os.path.exists(path + ext):
+			os.remove(path + ext)
+
+
+def _quote(cmd):
+	return "'" + cmd.replace("'", "'\\''") + "'"
@@ -40,7 +40,7 @@ class drVM:
                 log.debug(str(cmd))
                 self.cmd.append(cmd)
             return out
-        elif: in_file.lower().endswith('.fq') or in_file.lower().endswith('.fastq'):
+        elif in_file.lower().endswith('.fq') or in_file.lower().endswith('.fastq'):
             log.debug('Format seems to be fastq.')
             return in_file
         else:
@@ -0,0 +1,220 @@
+"""
+This module is a part of the virAnnot module
+Run the command lists of several modules concurrently on the local host.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+# to allow code to work with Python 2 and 3
+from __future__ import print_function   # print is a function in python3
+from __future__ import unicode_literals # avoid adding "u" to each string
+from __future__ import division # avoid writing float(x) when dividing by x
+
+import logging as log
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class CoreBudget:
+	"""
+	Count the cores in use on the host.
+	A job asking for more cores than the budget is given the whole budget.
+	"""
+
+	def __init__(self, n_cpu):
+		self.total = max(1, int(n_cpu))
+		self.free = self.total
+		self.cond = threading.Condition()
+
+	def acquire(self, n_cpu):
+		n_cpu = self._bound(n_cpu)
+		with self.cond:
+			while self.free < n_cpu:
+				self.cond.wait()
+			self.free -= n_cpu
+		return n_cpu
+
+	def release(self, n_cpu):
+		with self.cond:
+			self.free += n_cpu
+			self.cond.notify_all()
+
+	def _bound(self, n_cpu):
+		try:
+			n_cpu = int(n_cpu)
+		except (TypeError, ValueError):
+			n_cpu = 1
+		return min(max(1, n_cpu), self.total)
+
+
+class LocalExecutor:
+	"""
+	Each submitted job is a list of shell commands run in order.
+	Jobs run concurrently as long as the sum of their n_cpu
+	stays under the core budget. The jobs and nodes of run_graph waiting
+	for a cluster job run apart, at most cluster_jobs at once, without
+	using the local cores.
+	"""
+
+	def __init__(self, n_cpu, dry_run=False, journal=None, resume=False, report=None, cluster_jobs=1):
+		self.budget = CoreBudget(n_cpu)
+		self.dry_run = dry_run
+		self.journal = journal
+		self.resume = resume
+		self.report = report
+		self.pool = ThreadPoolExecutor(max_workers=self.budget.total)
+		# creation of the modules of the nodes, apart from the jobs
+		self.prepare_pool = ThreadPoolExecutor(max_workers=self.budget.total)
+		self.cluster_pool = ThreadPoolExecutor(max_workers=max(1, int(cluster_jobs)))
+		self.jobs = []
+
+	def submit(self, name, cmds, n_cpu=1, done=None, cluster=False):
+		"""
+		Queue a command list, return a future giving the exit code
+		of the last command run. done(status) is called when the job ends.
+		The commands of a cluster job submit a job and wait for it, like
+		the cluster nodes of run_graph.
+		"""
+		cmds = list(cmds)
+		pool = self.pool
+		if cluster:
+			pool = self.cluster_pool
+		future = pool.submit(self._run_job, name, cmds, n_cpu, done, self.register(name, cmds), cluster)
+		self.jobs.append((name, future))
+		return future
+
+	def wait(self):
+		"""
+		Wait for every submitted job, return the names of failed jobs.
+		"""
+		failed = []
+		for name, future in self.jobs:
+			if future.result() != 0:
+				failed.append(name)
+		self.jobs = []
+		return failed
+
+	def run_graph(self, nodes):
+		"""
+		Run a list of (name, deps, prepare) nodes given in topological order.
+		prepare() is called once all deps succeeded and returns
+		the (commands, n_cpu, done, cluster) of the node or None if it can
+		not run, a node whose prepare() raises fails too. The commands of
+		a cluster node submit a job and wait for it: they are not charged
+		to the core budget.
+		Return the names of the failed or skipped nodes.
+		"""
+		status = {}
+		preparing = {}
+		running = {}
+		pending = list(nodes)
+		while pending or preparing or running:
+			waiting = []
+			for name, deps, prepare in pending:
+				if any(d in status and status[d] != 0 for d in deps):
+					log.critical(name + ' not launched, a dependency failed.')
+					status[name] = -1
+				elif all(d in status for d in deps):
+					preparing[self.prepare_pool.submit(prepare)] = name
+				else:
+					waiting.append((name, deps, prepare))
+			pending = waiting
+			if not preparing and not running:
+				for name, deps, prepare in pending:
+					log.critical(name + ' not launched, unknown dependency.')
+					status[name] = -1
+				break
+			done, not_done = wait(list(preparing) + list(running), return_when=FIRST_COMPLETED)
+			for future in done:
+				if future in running:
+					status[running.pop(future)] = future.result()
+					continue
+				name = preparing.pop(future)
+				try:
+					job = future.result()
+				except Exception as e:
+					# only the dependents of the node are skipped
+					log.critical(name + ' not launched: ' + repr(e))
+					job = None
+				if job is None:
+					status[name] = 1
+					continue
+				cmds, n_cpu, done_cb, cluster = job
+				cmds = list(cmds)
+				pool = self.pool
+				if cluster:
+					pool = self.cluster_pool
+				running[pool.submit(self._run_job, name, cmds, n_cpu, done_cb, self.register(name, cmds), cluster)] = name
+		return [name for name, deps, prepare in nodes if status[name] != 0]
+
+	def shutdown(self):
+		self.pool.shutdown(wait=True)
+		self.prepare_pool.shutdown(wait=True)
+		self.cluster_pool.shutdown(wait=True)
+
+	def register(self, name, cmds):
+		"""
+		Journal the commands of a job, return the index of the first one to run.
+		"""
+		if self.journal is None or self.dry_run:
+			return 0
+		first = self.journal.add(name, cmds, self.resume)
+		if first > 0:
+			log.info(name + ': ' + str(first) + ' command(s) already done, resuming.')
+		return first
+
+	def _run_job(self, name, cmds, n_cpu, done=None, first=0, cluster=False):
+		if cluster:
+			# the cores are used on the cluster
+			n_cpu = 1
+			log.debug(name + ' submitted to the cluster.')
+		else:
+			n_cpu = self.budget.acquire(n_cpu)
+			log.debug(name + ' started on ' + str(n_cpu) + ' core(s).')
+		status = 0
+		try:
+			for i in range(first, len(cmds)):
+				el = cmds[i]
+				log.debug(el)
+				if self.dry_run:
+					continue
+				if self.journal is not None:
+					self.journal.start(name, i)
+				status, usage = run_cmd(el)
+				if self.journal is not None:
+					self.journal.end(name, i, status)
+				if self.report is not None:
+					self.report.add(name, i, el, n_cpu, status, usage)
+				if status != 0:
+					log.critical(name + ' failed with exit code ' + str(status) + ': ' + el)
+					break
+		finally:
+			if not cluster:
+				self.budget.release(n_cpu)
+		log.debug(name + ' finished.')
+		if done is not None and not self.dry_run:
+			done(status)
+		return status
+
+
+def run_cmd(cmd):
+	"""
+	Run a shell command like os.system, return its exit code and the
+	resources used by the command and its children: wall, user and sys
+	time in seconds, peak RSS in KB, bytes read and written.
+	"""
+	start = time.time()
+	p = subprocess.Popen(cmd, shell=True)
+	if not hasattr(os, 'wait4'):
+		status = p.wait()
+		return status, {'wall': time.time() - start, 'user': 0, 'sys': 0, 'max_rss': 0, 'read_bytes': 0, 'write_bytes': 0}
+	pid, wait_status, rusage = os.wait4(p.pid, 0)
+	if os.WIFSIGNALED(wait_status):
+		status = -os.WTERMSIG(wait_status)
+	else:
+		status = os.WEXITSTATUS(wait_status)
+	p.returncode = status
+	# ru_inblock and ru_oublock are counted in 512 bytes blocks
+	return status, {'wall': round(time.time() - start, 3), 'user': round(rusage.ru_utime, 3), 'sys': round(rusage.ru_stime, 3),
+		'max_rss': rusage.ru_maxrss, 'read_bytes': rusage.ru_inblock * 512, 'write_bytes': rusage.ru_oublock * 512}
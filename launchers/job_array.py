@@ -0,0 +1,162 @@
+"""
+This module is a part of the virAnnot module
+Submit all the jobs of a step as a single SGE or SLURM job array.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+# to allow code to work with Python 2 and 3
+from __future__ import print_function   # print is a function in python3
+from __future__ import unicode_literals # avoid adding "u" to each string
+from __future__ import division # avoid writing float(x) when dividing by x
+
+import logging as log
+import os
+import re
+import subprocess
+
+JOB_REGEX = {'sge': r'Your job(?:-array)? (\d+)', 'slurm': r'Submitted batch job (\d+)'}
+
+
+class JobArray:
+	"""
+	Each task of the array reads its line in the task table
+	(working directory and command file), runs the command file and
+	writes its exit code in the command file name + .exit.
+	With a journal, the commands of each task are journaled as running
+	once the array is submitted, and ended with the exit code of their
+	task by collect, or by the next add of the task with resume when the
+	array was not waited for.
+	"""
+
+	def __init__(self, name, scheduler='sge', limit=None, journal=None, resume=False):
+		self.name = name
+		self.scheduler = scheduler
+		self.limit = limit
+		self.journal = journal
+		self.resume = resume
+		self.wd = os.getcwd()
+		self.table = self.wd + '/' + name + '_array_tasks.txt'
+		self.script = self.wd + '/' + name + '_array.sh'
+		self.tasks = []
+		self.n_cpu = 1
+
+	def add(self, wd, cmd_file, n_cpu, key=None, cmds=()):
+		"""
+		Add the task running cmd_file in wd. With a journal, the commands
+		cmds of the task are journaled under key. Return the index of the
+		first command to run, the task is not added when it is len(cmds).
+		"""
+		cmd_file = os.path.abspath(cmd_file)
+		first = 0
+		if self.journal is not None and key is not None:
+			if self.resume:
+				code = task_exit(cmd_file)
+				if code is not None:
+					# task of a previous array that was not waited for
+					self.journal.finish(key, code, os.path.getmtime(cmd_file + '.exit'))
+			first = self.journal.add(key, cmds, self.resume)
+			if first == len(cmds):
+				log.info(key + ': every command already done, not added to the array.')
+				return first
+			if first > 0:
+				log.info(key + ': ' + str(first) + ' command(s) already done, resuming.')
+		if os.path.exists(cmd_file + '.exit'):
+			os.remove(cmd_file + '.exit')
+		self.tasks.append((os.path.abspath(wd), cmd_file, key, list(range(first, len(cmds)))))
+		self.n_cpu = max(self.n_cpu, int(n_cpu))
+		return first
+
+	def write(self):
+		fw = open(self.table, mode='w')
+		for wd, cmd_file, key, positions in self.tasks:
+			fw.write(wd + "\t" + cmd_file + "\n")
+		fw.close()
+		if self.scheduler == 'sge':
+			task_id = '${SGE_TASK_ID}'
+		else:
+			task_id = '${SLURM_ARRAY_TASK_ID}'
+		script = '#!/bin/sh' + "\n"
+		script += 'LINE=$(sed -n "' + task_id + 'p" ' + self.table + ')' + "\n"
+		script += 'cd "$(echo "$LINE" | cut -f1)"' + "\n"
+		script += 'CMD_FILE="$(echo "$LINE" | cut -f2)"' + "\n"
+		script += 'sh "$CMD_FILE"' + "\n"
+		script += 'code=$?' + "\n"
+		script += 'echo $code > "$CMD_FILE.exit"' + "\n"
+		script += 'exit $code' + "\n"
+		fw = open(self.script, mode='w')
+		fw.write(script)
+		fw.close()
+
+	def submit_cmd(self):
+		"""
+		Return the qsub or sbatch call launching the array.
+		"""
+		n_tasks = str(len(self.tasks))
+		if self.scheduler == 'sge':
+			cmd = 'qsub -wd ' + self.wd + ' -V -N ' + self.name + ' -t 1-' + n_tasks
+			if self.limit is not None:
+				cmd += ' -tc ' + str(self.limit)
+			cmd += ' -pe multithread ' + str(self.n_cpu) + ' ' + self.script
+		else:
+			cmd = 'sbatch --export=ALL -J ' + self.name + ' -D ' + self.wd + ' --array=1-' + n_tasks
+			if self.limit is not None:
+				cmd += '%' + str(self.limit)
+			cmd += ' --cpus-per-task=' + str(self.n_cpu) + ' ' + self.script
+		return cmd
+
+	def submit(self, dry_run=False):
+		"""
+		Submit the array and return its job id (None for a dry run).
+		"""
+		if not self.tasks:
+			return None
+		self.write()
+		cmd = self.submit_cmd()
+		log.info(self.name + ': ' + str(len(self.tasks)) + ' tasks submitted as one array.')
+		log.debug(cmd)
+		if dry_run:
+			return None
+		pipes = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+		stdout = pipes.communicate()[0].decode('utf-8')
+		log.debug(stdout)
+		m = re.search(JOB_REGEX[self.scheduler], stdout)
+		if m is None:
+			log.critical(self.name + ': no job id in the submission output.')
+			return None
+		self.started()
+		return m.group(1)
+
+	def started(self):
+		"""
+		Journal the commands of the tasks as running.
+		"""
+		if self.journal is None:
+			return
+		for wd, cmd_file, key, positions in self.tasks:
+			for i in positions:
+				self.journal.start(key, i)
+
+	def collect(self):
+		"""
+		Once the array ended, journal the commands of each task with
+		its exit code, a task without exit code failed.
+		Return the keys of the failed tasks.
+		"""
+		failed = []
+		for wd, cmd_file, key, positions in self.tasks:
+			code = task_exit(cmd_file)
+			if code != 0:
+				failed.append(key)
+			if self.journal is not None and key is not None:
+				self.journal.finish(key, code)
+		return failed
+
+
+def task_exit(cmd_file):
+	"""
+	Exit code written by the task of cmd_file, None if not written.
+	"""
+	try:
+		with open(cmd_file + '.exit') as fh:
+			return int(fh.read().strip())
+	except (IOError, ValueError):
+		return None
@@ -0,0 +1,375 @@
+#!/usr/bin/python3.4
+"""
+This module is a part of the virAnnot module
+Follow the state of many scheduler jobs with one status query per interval.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+# to allow code to work with Python 2 and 3
+from __future__ import print_function   # print is a function in python3
+from __future__ import unicode_literals # avoid adding "u" to each string
+from __future__ import division # avoid writing float(x) when dividing by x
+
+import argparse
+import fcntl
+import getpass
+import json
+import logging as log
+import os
+import re
+import subprocess
+import sys
+import time
+
+STATES = ['submitted', 'pending', 'running', 'error', 'done']
+# queries a job is not listed in before asking the scheduler accounting whether it ended,
+# and queries a job that left the queue waits for its accounting record
+MISSES = 2
+# slurm states of a job that did not end
+SLURM_ACTIVE = ['PENDING', 'RUNNING', 'REQUEUED', 'REQUEUE_HOLD', 'REQUEUE_FED', 'RESIZING', 'SUSPENDED', 'CONFIGURING', 'COMPLETING']
+
+
+class JobMonitor:
+	"""
+	Track job ids (or job array ids) of a SGE or SLURM scheduler.
+	Each poll runs a single squeue --jobs a,b,c or qstat -u user
+	for all watched jobs. A job no longer listed is done or in error as
+	the accounting (qacct or sacct) says, done without accounting
+	record after MISSES queries. A job never listed is done or in error
+	once the accounting says it ended, it is still submitted otherwise.
+	The interval between two polls grows by factor while no job
+	changes its state, up to max_interval.
+	With shared, a directory, the monitors of all the processes using it
+	register their jobs there and share the last query: the scheduler is
+	queried at most once per interval for all of them.
+	command and accounting replace squeue or qstat and sacct or qacct,
+	to use fake scheduler scripts.
+	"""
+
+	def __init__(self, scheduler='sge', interval=20, max_interval=300, factor=2, command=None, user=None, shared=None, accounting=None):
+		self.scheduler = scheduler
+		self.interval = interval
+		self.max_interval = max_interval
+		self.factor = factor
+		if command is None:
+			if scheduler == 'sge':
+				command = 'qstat'
+			else:
+				command = 'squeue'
+		self.command = command
+		if accounting is None:
+			if scheduler == 'sge':
+				accounting = 'qacct'
+			else:
+				accounting = 'sacct'
+		self.accounting = accounting
+		if user is None:
+			user = getpass.getuser()
+		self.user = user
+		self.shared = shared
+		if shared is not None and not os.path.isdir(shared):
+			os.makedirs(shared)
+		# time of the last query whose result was read
+		self.last_query = None
+		self.ended = []
+		self.jobs = {}
+		self.misses = {}
+		self.callbacks = {}
+
+	def watch(self, jobid, callback=None):
+		"""
+		Follow jobid, callback(jobid, old_state, new_state) is
+		called on each state change.
+		"""
+		jobid = str(jobid)
+		self.jobs[jobid] = 'submitted'
+		self.misses[jobid] = 0
+		self.callbacks[jobid] = callback
+
+	def active(self):
+		return [j for j in self.jobs if self.jobs[j] not in ['done', 'error']]
+
+	def status_cmd(self, jobs=None):
+		if self.scheduler == 'sge':
+			return [self.command, '-u', self.user]
+		if jobs is None:
+			jobs = self.active()
+		return [self.command, '--noheader', '--format=%i %T', '--jobs', ','.join(jobs)]
+
+	def poll(self):
+		"""
+		Query the scheduler once, or read the query of another monitor
+		sharing the directory when it is recent enough, and update the
+		state of the active jobs.
+		Return the number of jobs that changed state, None if the query failed.
+		"""
+		if not self.active():
+			return 0
+		if self.shared is None:
+			listed = self.query(self.active())
+			queried = time.time()
+		else:
+			listed, queried = self._shared_query()
+		if listed is None:
+			return None
+		# a query read again does not count as a miss
+		new_query = queried != self.last_query
+		self.last_query = queried
+		changed = 0
+		for jobid in self.active():
+			if jobid in listed:
+				state = listed[jobid]
+				self.misses[jobid] = 0
+			elif self.jobs[jobid] != 'submitted':
+				# left the queue: the accounting tells whether it failed or was killed
+				state = self.finished(jobid)
+				if state is None:
+					if new_query:
+						self.misses[jobid] += 1
+					if self.misses[jobid] < MISSES:
+						continue
+					log.warning('job ' + jobid + ' left the queue without accounting record, considered done.')
+					state = 'done'
+			else:
+				if new_query:
+					self.misses[jobid] += 1
+				if self.misses[jobid] < MISSES:
+					continue
+				# never listed: ended before the first query or not known yet
+				state = self.finished(jobid)
+				if state is None:
+					continue
+			if state != self.jobs[jobid]:
+				changed += 1
+				self._change(jobid, state)
+		return changed
+
+	def query(self, jobs):
+		"""
+		Run the status command for jobs, return {jobid: state} of the
+		jobs listed, None if the query failed.
+		"""
+		cmd = self.status_cmd(jobs)
+		log.debug(cmd)
+		try:
+			pipes = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		except OSError as e:
+			log.warning('status query failed: ' + str(e))
+			return None
+		stdout, stderr = pipes.communicate()
+		stdout = stdout.decode('utf-8')
+		stderr = stderr.decode('utf-8')
+		if pipes.returncode != 0:
+			# squeue fails when none of the given jobs is known anymore
+			if self.scheduler != 'sge' and 'Invalid job id' in stderr:
+				stdout = ''
+			else:
+				log.warning('status query failed: ' + stderr.strip())
+				return None
+		if self.scheduler == 'sge':
+			return parse_qstat(stdout)
+		return parse_squeue(stdout)
+
+	def finished(self, jobid):
+		"""
+		State of a job from the scheduler accounting: done or error
+		once every task ended, None while it is not known there.
+		"""
+		if self.scheduler == 'sge':
+			cmd = [self.accounting, '-j', jobid]
+		else:
+			cmd = [self.accounting, '--noheader', '--allocations', '--format=State', '--jobs', jobid]
+		log.debug(cmd)
+		try:
+			pipes = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		except OSError as e:
+			log.warning('accounting query failed: ' + str(e))
+			return None
+		stdout = pipes.communicate()[0].decode('utf-8')
+		if pipes.returncode != 0:
+			return None
+		if self.scheduler == 'sge':
+			return parse_qacct(stdout)
+		return parse_sacct(stdout)
+
+	def wait(self, timeout=None):
+		"""
+		Poll until every watched job is done or in error.
+		Return {jobid: state}.
+		"""
+		start = time.time()
+		interval = self.interval
+		while True:
+			changed = self.poll()
+			if not self.active():
+				break
+			if timeout is not None and time.time() - start > timeout:
+				log.warning(str(len(self.active())) + ' jobs still active after ' + str(timeout) + ' seconds.')
+				break
+			if changed:
+				interval = self.interval
+			else:
+				interval = min(interval * self.factor, self.max_interval)
+			log.debug(str(len(self.active())) + ' jobs still active, next query in ' + str(interval) + ' seconds.')
+			time.sleep(interval)
+		if self.shared is not None and self.ended:
+			self._shared_query(False)
+		return dict(self.jobs)
+
+	def _shared_query(self, query=True):
+		"""
+		Register the active jobs in the shared state, forget the ones
+		that ended, and return the last query of the jobs of every
+		monitor ({jobid: state}, time of the query). The scheduler is
+		queried again when the last query is older than interval or
+		does not cover the active jobs.
+		"""
+		path = os.path.join(self.shared, 'state_' + self.scheduler + '.json')
+		lock = open(os.path.join(self.shared, 'lock'), 'a')
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		try:
+			try:
+				with open(path) as fh:
+					state = json.load(fh)
+			except (IOError, ValueError):
+				state = {'jobs': {}, 'time': 0, 'listed': {}, 'queried': []}
+			now = time.time()
+			for jobid in self.ended:
+				state['jobs'].pop(jobid, None)
+			self.ended = []
+			for jobid in self.active():
+				state['jobs'][jobid] = now
+			# jobs of a monitor that stopped polling
+			for jobid in [j for j in state['jobs'] if state['jobs'][j] < now - 2 * self.max_interval]:
+				del state['jobs'][jobid]
+			stale = now - state['time'] >= self.interval or [j for j in self.active() if j not in state['queried']]
+			if query and stale and state['jobs']:
+				listed = self.query(sorted(state['jobs']))
+				if listed is None:
+					return None, None
+				state.update({'time': now, 'listed': listed, 'queried': sorted(state['jobs'])})
+			tmp = path + '.' + str(os.getpid())
+			with open(tmp, 'w') as fh:
+				json.dump(state, fh)
+			os.rename(tmp, path)
+		finally:
+			fcntl.flock(lock, fcntl.LOCK_UN)
+			lock.close()
+		return state['listed'], state['time']
+
+	def _change(self, jobid, state):
+		old = self.jobs[jobid]
+		self.jobs[jobid] = state
+		log.info('job ' + jobid + ' ' + old + ' -> ' + state)
+		if state in ['done', 'error']:
+			self.ended.append(jobid)
+		if self.callbacks[jobid] is not None:
+			self.callbacks[jobid](jobid, old, state)
+
+
+def parse_squeue(output):
+	"""
+	Lines of squeue --format="%i %T", array tasks (123_4, 123_[5-10])
+	are grouped under the array job id.
+	"""
+	states = {}
+	for line in output.splitlines():
+		fields = line.split()
+		if len(fields) < 2:
+			continue
+		m = re.match(r'(\d+)', fields[0])
+		if m is None:
+			continue
+		if fields[1] in ['PENDING', 'CONFIGURING', 'REQUEUED', 'REQUEUE_HOLD']:
+			state = 'pending'
+		else:
+			state = 'running'
+		_merge_state(states, m.group(1), state)
+	return states
+
+
+def parse_qstat(output):
+	"""
+	Lines of qstat -u user: job-ID prior name user state ...
+	"""
+	states = {}
+	for line in output.splitlines():
+		fields = line.split()
+		if len(fields) < 5 or not fields[0].isdigit():
+			continue
+		if 'E' in fields[4]:
+			state = 'error'
+		elif re.search('[rtRsSTd]', fields[4]):
+			state = 'running'
+		else:
+			state = 'pending'
+		_merge_state(states, fields[0], state)
+	return states
+
+
+def parse_qacct(output):
+	"""
+	Output of qacct -j jobid, one block per task: error if a task
+	failed or exited with a code other than 0, done otherwise.
+	"""
+	codes = re.findall(r'^(?:failed|exit_status)\s+(\d+)', output, re.M)
+	if not codes:
+		return None
+	if [c for c in codes if c != '0']:
+		return 'error'
+	return 'done'
+
+
+def parse_sacct(output):
+	"""
+	Lines of sacct --allocations --format=State, one per task:
+	None while a task did not end, error if one did not complete.
+	"""
+	states = [line.split()[0] for line in output.splitlines() if line.strip()]
+	if not states or [s for s in states if s.rstrip('+') in SLURM_ACTIVE]:
+		return None
+	if [s for s in states if s != 'COMPLETED']:
+		return 'error'
+	return 'done'
+
+
+def _merge_state(states, jobid, state):
+	# a job array is in error if one task is, running if one task runs
+	order = ['pending', 'running', 'error']
+	if jobid not in states or order.index(state) > order.index(states[jobid]):
+		states[jobid] = state
+
+
+def main():
+	args = _set_options()
+	log_format = '%(asctime)s %(levelname)-8s %(message)s'
+	if args.verbosity == 3:
+		log.basicConfig(level=log.DEBUG, format=log_format)
+	else:
+		log.basicConfig(level=log.INFO, format=log_format)
+	monitor = JobMonitor(args.scheduler, args.interval, args.max_interval, command=args.command, shared=args.shared, accounting=args.accounting)
+	for jobid in args.jobs:
+		monitor.watch(jobid)
+	states = monitor.wait(args.timeout)
+	for jobid in args.jobs:
+		print(jobid + "\t" + states[jobid])
+	if [j for j in states if states[j] != 'done']:
+		sys.exit(1)
+
+
+def _set_options():
+	parser = argparse.ArgumentParser(description='Wait for scheduler jobs to finish.')
+	parser.add_argument('jobs', help='Job ids.', nargs='+')
+	parser.add_argument('-s', '--scheduler', help='The scheduler.', action='store', type=str, default='sge', choices=['sge', 'slurm'])
+	parser.add_argument('-i', '--interval', help='First interval between two queries (seconds).', action='store', type=float, default=20)
+	parser.add_argument('-m', '--max_interval', help='Maximum interval between two queries (seconds).', action='store', type=float, default=300)
+	parser.add_argument('-t', '--timeout', help='Stop waiting after this number of seconds.', action='store', type=float, default=None)
+	parser.add_argument('--command', help='Status command replacing qstat or squeue.', action='store', type=str, default=None)
+	parser.add_argument('--accounting', help='Accounting command replacing qacct or sacct.', action='store', type=str, default=None)
+	parser.add_argument('--shared', help='Directory shared with the other monitors of the user, the scheduler is queried once for all of them.', action='store', type=str, default=None)
+	parser.add_argument('-v', '--verbosity', help='Verbose level', action='store', type=int, choices=[1, 2, 3, 4], default=1)
+	args = parser.parse_args()
+	return args
+
+
+if __name__ == "__main__":
+	main()
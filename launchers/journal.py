@@ -0,0 +1,106 @@
+"""
+This module is a part of the virAnnot module
+SQLite journal of the commands launched by virAnnot.py.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+# to allow code to work with Python 2 and 3
+from __future__ import print_function   # print is a function in python3
+from __future__ import unicode_literals # avoid adding "u" to each string
+from __future__ import division # avoid writing float(x) when dividing by x
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+STATES = ['pending', 'running', 'done', 'failed']
+
+
+class Journal:
+	"""
+	One row per command of each job with its state
+	(pending, running, done or failed), exit code, start
+	and end times and the host it ran on.
+	Every change is committed so the journal survives a killed driver.
+	"""
+
+	def __init__(self, path):
+		if not os.path.exists(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		self.lock = threading.Lock()
+		self.host = socket.gethostname()
+		self.conn = sqlite3.connect(path, check_same_thread=False)
+		self.conn.execute('PRAGMA journal_mode=WAL')
+		self.conn.execute('CREATE TABLE IF NOT EXISTS command (job TEXT, step TEXT, position INTEGER, cmd TEXT, state TEXT, ' +
+			'exit_code INTEGER, start REAL, end REAL, host TEXT, PRIMARY KEY (job, position))')
+		self.conn.commit()
+
+	def add(self, job, cmds, resume=False):
+		"""
+		Register the commands of a job as pending.
+		With resume, the leading commands already done are kept
+		and their number is returned.
+		"""
+		with self.lock:
+			first = 0
+			if resume:
+				rows = {}
+				for position, cmd, state in self.conn.execute('SELECT position, cmd, state FROM command WHERE job = ?', (job,)):
+					rows[position] = (cmd, state)
+				while first < len(cmds) and rows.get(first) == (cmds[first], 'done'):
+					first += 1
+			self.conn.execute('DELETE FROM command WHERE job = ? AND position >= ?', (job, first))
+			for i in range(first, len(cmds)):
+				self.conn.execute('INSERT INTO command (job, step, position, cmd, state) VALUES (?, ?, ?, ?, ?)',
+					(job, job.split('/')[0], i, cmds[i], 'pending'))
+			self.conn.commit()
+		return first
+
+	def start(self, job, position):
+		with self.lock:
+			self.conn.execute('UPDATE command SET state = ?, start = ?, host = ? WHERE job = ? AND position = ?',
+				('running', time.time(), self.host, job, position))
+			self.conn.commit()
+
+	def end(self, job, position, exit_code):
+		if exit_code == 0:
+			state = 'done'
+		else:
+			state = 'failed'
+		with self.lock:
+			self.conn.execute('UPDATE command SET state = ?, exit_code = ?, end = ? WHERE job = ? AND position = ?',
+				(state, exit_code, time.time(), job, position))
+			self.conn.commit()
+
+	def finish(self, job, exit_code, before=None):
+		"""
+		End the running commands of a job, run by a task followed apart
+		(a job array task), with its exit code. With before, only the
+		commands started before this time are ended.
+		"""
+		if exit_code == 0:
+			state = 'done'
+		else:
+			state = 'failed'
+		if before is None:
+			before = time.time()
+		with self.lock:
+			self.conn.execute('UPDATE command SET state = ?, exit_code = ?, end = ? WHERE job = ? AND state = ? AND start <= ?',
+				(state, exit_code, time.time(), job, 'running', before))
+			self.conn.commit()
+
+	def progress(self):
+		"""
+		Return {step: {state: number of commands}}.
+		"""
+		progress = {}
+		with self.lock:
+			for step, state, count in self.conn.execute('SELECT step, state, COUNT(*) FROM command GROUP BY step, state'):
+				if step not in progress:
+					progress[step] = dict((s, 0) for s in STATES)
+				progress[step][state] = count
+		return progress
+
+	def close(self):
+		self.conn.close()
@@ -0,0 +1,95 @@
+"""
+This module is a part of the virAnnot module
+Keep a manifest of each (step, sample) run to skip the ones already up to date.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+# to allow code to work with Python 2 and 3
+from __future__ import print_function   # print is a function in python3
+from __future__ import unicode_literals # avoid adding "u" to each string
+from __future__ import division # avoid writing float(x) when dividing by x
+
+import hashlib
+import json
+import logging as log
+import os
+import time
+
+
+class Manifest:
+	"""
+	One json file per (step, unit) storing the commands, the
+	size and mtime (or md5) of the input files and the output paths.
+	Jobs submitted to SGE are recorded as pending and validated on the
+	next run if all their outputs were written after the submission.
+	"""
+
+	def __init__(self, directory, mode='mtime'):
+		self.directory = directory
+		self.mode = mode
+
+	def entry(self, cmds, inputs, outputs):
+		files = {}
+		for f in sorted(inputs):
+			files[f] = self._signature(f)
+		return {'cmd': list(cmds), 'inputs': files, 'outputs': sorted(outputs), 'time': time.time()}
+
+	def is_up_to_date(self, key, entry):
+		if not entry['outputs']:
+			return False
+		for f in entry['outputs']:
+			if not os.path.exists(f):
+				return False
+		old = self._load(key)
+		if old is None:
+			return False
+		return old['cmd'] == entry['cmd'] and old['inputs'] == entry['inputs'] and old['outputs'] == entry['outputs']
+
+	def record(self, key, entry, pending=False):
+		path = self._path(key, pending)
+		if not os.path.exists(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		tmp = path + '.tmp'
+		fw = open(tmp, mode='w')
+		json.dump(entry, fw)
+		fw.close()
+		os.rename(tmp, path)
+		if not pending and os.path.exists(self._path(key, True)):
+			os.remove(self._path(key, True))
+
+	def _load(self, key):
+		path = self._path(key)
+		if os.path.exists(path):
+			return self._read(path)
+		pending = self._path(key, True)
+		if os.path.exists(pending):
+			entry = self._read(pending)
+			for f in entry['outputs']:
+				if not os.path.exists(f) or os.path.getmtime(f) < entry['time']:
+					return None
+			log.debug(key + ' SGE job completed, manifest validated.')
+			self.record(key, entry)
+			return entry
+		return None
+
+	def _read(self, path):
+		fh = open(path)
+		entry = json.load(fh)
+		fh.close()
+		return entry
+
+	def _path(self, key, pending=False):
+		path = os.path.join(self.directory, key)
+		if pending:
+			return path + '.pending.json'
+		return path + '.json'
+
+	def _signature(self, f):
+		if self.mode == 'hash':
+			md5 = hashlib.md5()
+			fh = open(f, 'rb')
+			for block in iter(lambda: fh.read(1 << 20), b''):
+				md5.update(block)
+			fh.close()
+			return md5.hexdigest()
+		stat = os.stat(f)
+		return [stat.st_size, int(stat.st_mtime)]
@@ -0,0 +1,277 @@
+"""
+This module is a part of the virAnnot module
+Estimate the CPU time, memory and disk needed by a run from its input
+sizes and the throughput observed in previous run reports.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+# to allow code to work with Python 2 and 3
+from __future__ import print_function   # print is a function in python3
+from __future__ import unicode_literals # avoid adding "u" to each string
+from __future__ import division # avoid writing float(x) when dividing by x
+
+import glob
+import gzip
+import json
+import math
+import os
+
+SEQ_FORMATS = {'.fa': 'fasta', '.fna': 'fasta', '.faa': 'fasta', '.fasta': 'fasta', '.fq': 'fastq', '.fastq': 'fastq'}
+# reads read in a fastq file before extrapolating from the file size
+FASTQ_SAMPLE = 100000
+COLUMNS = ['step', 'jobs', 'reads', 'sequences', 'bases', 'core_h', 'wall_h', 'mem_gb', 'disk_gb', 'num_chunk', 'tc', 'n_cpu', 'chunks', 'bases_per_chunk', 'unmeasured', 'history']
+
+
+def seq_format(path):
+	name = path
+	if name.endswith('.gz'):
+		name = name[:-3]
+	return SEQ_FORMATS.get(os.path.splitext(name)[1])
+
+
+def measure(path):
+	"""
+	Size of a file: bytes, and for fasta and fastq files,
+	number of reads (fastq) or sequences (fasta) and total bases.
+	Fastq files are extrapolated from their first FASTQ_SAMPLE reads.
+	"""
+	size = {'bytes': os.path.getsize(path), 'reads': 0, 'sequences': 0, 'bases': 0}
+	fmt = seq_format(path)
+	if fmt is None:
+		return size
+	if path.endswith('.gz'):
+		fh = gzip.open(path, 'rb')
+		raw = fh.fileobj
+	else:
+		fh = open(path, 'rb')
+		raw = fh
+	if fmt == 'fasta':
+		for line in fh:
+			if line.startswith(b'>'):
+				size['sequences'] += 1
+			else:
+				size['bases'] += len(line.strip())
+	else:
+		complete = True
+		for i, line in enumerate(fh):
+			if i % 4 == 1:
+				size['reads'] += 1
+				size['bases'] += len(line.strip())
+				if size['reads'] == FASTQ_SAMPLE:
+					complete = False
+					break
+		if not complete:
+			read = raw.tell()
+			raw.seek(0, os.SEEK_END)
+			ratio = raw.tell() / read
+			size['reads'] = int(size['reads'] * ratio)
+			size['bases'] = int(size['bases'] * ratio)
+	fh.close()
+	return size
+
+
+def load_history(directory):
+	"""
+	Jobs of the previous run reports, the latest run of a job
+	wins and only jobs whose commands all succeeded are kept.
+	Return {job: {'wall', 'cpu', 'max_rss', 'size'}}, size being the
+	sizes and settings recorded with the job (see RunReport.job_sizes),
+	None in the reports written before they were recorded.
+	"""
+	history = {}
+	for report in sorted(glob.glob(directory + '/run_*.json')):
+		with open(report) as fh:
+			content = json.load(fh)
+		sizes = content.get('jobs', {})
+		jobs = {}
+		for c in content['commands']:
+			if c['job'] not in jobs:
+				jobs[c['job']] = {'wall': 0, 'cpu': 0, 'max_rss': 0, 'failed': False, 'size': sizes.get(c['job'])}
+			j = jobs[c['job']]
+			j['wall'] += c['wall']
+			j['cpu'] += c['user'] + c['sys']
+			j['max_rss'] = max(j['max_rss'], c['max_rss'])
+			j['failed'] = j['failed'] or c['exit_code'] != 0
+		for job in jobs:
+			if not jobs[job]['failed']:
+				del jobs[job]['failed']
+				history[job] = jobs[job]
+	return history
+
+
+class Planner:
+	"""
+	Jobs of the planned run are added with their input files and settings.
+	The jobs of the history give the throughput of their step and module,
+	whatever their samples: core seconds, output bytes per input base (or
+	byte when the job has no sequence input) and peak memory, from the
+	sizes recorded in their report. Jobs of older reports, without sizes,
+	are only used when the planned run has the same job with its inputs.
+	Steps without history use the jobs of the same module.
+	Jobs sent to a scheduler (sge or BLAST chunks) are seen by the report as
+	the wall time of the submission, their core time is wall * reserved cores.
+	"""
+
+	def __init__(self, history):
+		self.history = history
+		self.jobs = []
+		self.sizes = {}
+
+	def add(self, step, module_name, key, inputs, outputs, settings):
+		"""
+		inputs and outputs are paths, settings has n_cpu, sge and for
+		jobs launched through blast_launch.py num_chunk (sequences per chunk,
+		'auto' when blast_launch.py chooses it), tc and chunk_cpu (cores of
+		each chunk), None otherwise.
+		Inputs not produced yet are given as None.
+		"""
+		job = {'step': step, 'module': module_name, 'key': key, 'reads': 0, 'sequences': 0, 'bases': 0, 'bytes': 0,
+			'missing': None in inputs, 'output_bytes': 0, 'split_bytes': 0}
+		job.update(settings)
+		for f in inputs:
+			if f is None:
+				continue
+			size = self._measure(f)
+			for k in ['reads', 'sequences', 'bases', 'bytes']:
+				job[k] += size[k]
+			if job['num_chunk'] is not None and seq_format(f) == 'fasta':
+				job['split_bytes'] += size['bytes']
+		for f in outputs:
+			if os.path.isfile(f):
+				job['output_bytes'] += os.path.getsize(f)
+		job['chunks'], job['cores'] = reserved(job)
+		self.jobs.append(job)
+
+	def table(self):
+		"""
+		One row per step with the summed estimates of the jobs whose inputs
+		exist (None when a job of the step has no history for its unit),
+		unmeasured counts the others.
+		"""
+		coefficients = self._learn()
+		rows = []
+		steps = []
+		for job in self.jobs:
+			if job['step'] not in steps:
+				steps.append(job['step'])
+		for step in steps:
+			jobs = [j for j in self.jobs if j['step'] == step]
+			first = jobs[0]
+			row = {'step': step, 'jobs': len(jobs), 'num_chunk': first['num_chunk'], 'tc': first['tc'], 'n_cpu': first['n_cpu'],
+				'unmeasured': len([j for j in jobs if j['missing']])}
+			jobs = [j for j in jobs if not j['missing']]
+			for k in ['reads', 'sequences', 'bases']:
+				row[k] = sum([j[k] for j in jobs])
+			if first['num_chunk'] not in [None, 'auto'] and jobs:
+				row['chunks'] = sum([j['chunks'] for j in jobs])
+				row['bases_per_chunk'] = row['bases'] // row['chunks']
+			else:
+				row['chunks'] = None
+				row['bases_per_chunk'] = None
+			coefs = [coefficients.get((step, _unit(j)), coefficients.get((first['module'], _unit(j)))) for j in jobs]
+			if not jobs or None in coefs:
+				row.update({'core_h': None, 'wall_h': None, 'mem_gb': None, 'disk_gb': None, 'history': 0})
+			else:
+				core_s = 0
+				wall_s = 0
+				disk = 0
+				for j, coef in zip(jobs, coefs):
+					size = j[coef['unit']]
+					core_s += coef['core_s'] * size
+					wall_s = max(wall_s, coef['core_s'] * size / _cores(j))
+					disk += (coef['output_bytes'] or 0) * size + j['split_bytes']
+				row['core_h'] = round(core_s / 3600, 2)
+				row['wall_h'] = round(wall_s / 3600, 2)
+				max_rss = max([coef['max_rss'] for coef in coefs])
+				if max_rss:
+					row['mem_gb'] = round(max_rss / 1024 / 1024, 2)
+				else:
+					row['mem_gb'] = None
+				row['disk_gb'] = round(disk / 1024 ** 3, 2)
+				row['history'] = max([coef['jobs'] for coef in coefs])
+			rows.append(row)
+		return rows
+
+	def _learn(self):
+		"""
+		Throughput of each (step or module, unit) summed over the jobs
+		of the history.
+		"""
+		planned = dict([(j['key'], j) for j in self.jobs if not j['missing']])
+		samples = {}
+		for key in self.history:
+			h = self.history[key]
+			size = h.get('size')
+			if size is None:
+				# report without sizes: the planned job gives them
+				if key not in planned:
+					continue
+				size = planned[key]
+			cores = reserved(size)[1]
+			if cores is None:
+				core_s = h['cpu']
+				max_rss = h['max_rss']
+			else:
+				core_s = h['wall'] * cores
+				# the report only sees the submission
+				max_rss = 0
+			unit = _unit(size)
+			if size[unit] == 0:
+				continue
+			for name in [size['step'], size['module']]:
+				samples.setdefault((name, unit), []).append((size[unit], core_s, size['output_bytes'], max_rss))
+		coefficients = {}
+		for name, unit in samples:
+			s = samples[(name, unit)]
+			measured = [x for x in s if x[2] is not None]
+			output_bytes = None
+			if measured:
+				output_bytes = sum([x[2] for x in measured]) / sum([x[0] for x in measured])
+			coefficients[(name, unit)] = {'unit': unit, 'jobs': len(s), 'core_s': sum([x[1] for x in s]) / sum([x[0] for x in s]),
+				'output_bytes': output_bytes, 'max_rss': max([x[3] for x in s])}
+		return coefficients
+
+	def _measure(self, path):
+		if path not in self.sizes:
+			self.sizes[path] = measure(path)
+		return self.sizes[path]
+
+
+def reserved(job):
+	"""
+	Number of chunks (None when unknown) and cores reserved on a
+	scheduler by a job from its settings and number of sequences,
+	None for the cores of a local job (its CPU time is measured).
+	"""
+	if job['num_chunk'] == 'auto':
+		# the number of chunks is unknown, at most tc of them run at once
+		return None, int(job['tc']) * int(job['chunk_cpu'])
+	if job['num_chunk'] is not None:
+		chunks = max(1, int(math.ceil(job['sequences'] / int(job['num_chunk']))))
+		return chunks, min(int(job['tc']), chunks) * int(job['chunk_cpu'])
+	if job['sge']:
+		return None, int(job['n_cpu'])
+	return None, None
+
+
+def _unit(job):
+	if job['bases'] > 0:
+		return 'bases'
+	return 'bytes'
+
+
+def _cores(job):
+	if job['cores'] is not None:
+		return job['cores']
+	return int(job['n_cpu'])
+
+
+def print_table(rows):
+	print("\t".join(['#' + COLUMNS[0]] + COLUMNS[1:]))
+	for row in rows:
+		print("\t".join([_format(row[c]) for c in COLUMNS]))
+
+
+def _format(value):
+	if value is None:
+		return '-'
+	return str(value)
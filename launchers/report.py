@@ -0,0 +1,118 @@
+"""
+This module is a part of the virAnnot module
+Collect the resources used by each command and write the run performance report.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+# to allow code to work with Python 2 and 3
+from __future__ import print_function   # print is a function in python3
+from __future__ import unicode_literals # avoid adding "u" to each string
+from __future__ import division # avoid writing float(x) when dividing by x
+
+import json
+import os
+import threading
+
+COLUMNS = ['job', 'step', 'position', 'program', 'n_cpu', 'exit_code', 'wall', 'user', 'sys', 'max_rss', 'read_bytes', 'write_bytes', 'cmd']
+TOTALS = ['wall', 'user', 'sys', 'read_bytes', 'write_bytes']
+
+
+class RunReport:
+	"""
+	One record per command: wall time, user and system CPU time (seconds),
+	peak RSS (KB) and bytes read and written, as given by os.wait4.
+	Jobs are recorded with their module, input and output files and
+	settings, the sizes of the files being measured when the report is
+	written so --plan learns the throughput of each step from them.
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.records = []
+		self.jobs = {}
+
+	def add(self, job, position, cmd, n_cpu, exit_code, usage):
+		record = {'job': job, 'step': job.split('/')[0], 'position': position, 'program': program_name(cmd),
+			'n_cpu': int(n_cpu), 'exit_code': exit_code, 'cmd': cmd}
+		record.update(usage)
+		with self.lock:
+			self.records.append(record)
+
+	def add_job(self, job, module, inputs, outputs, settings):
+		with self.lock:
+			self.jobs[job] = {'step': job.split('/')[0], 'module': module, 'inputs': sorted(inputs), 'outputs': sorted(outputs), 'settings': settings}
+
+	def job_sizes(self):
+		"""
+		Jobs having commands in the report with the sizes of their inputs
+		(reads, sequences, bases and bytes, see planner.measure) and the
+		bytes of their outputs, None when one of them is missing.
+		"""
+		from planner import measure
+		ran = set([r['job'] for r in self.records])
+		jobs = {}
+		for job in self.jobs:
+			if job not in ran:
+				continue
+			j = self.jobs[job]
+			size = {'step': j['step'], 'module': j['module'], 'reads': 0, 'sequences': 0, 'bases': 0, 'bytes': 0, 'output_bytes': 0}
+			for f in j['inputs']:
+				if os.path.isfile(f):
+					m = measure(f)
+					for k in ['reads', 'sequences', 'bases', 'bytes']:
+						size[k] += m[k]
+			for f in j['outputs']:
+				if size['output_bytes'] is None or not os.path.isfile(f):
+					size['output_bytes'] = None
+				else:
+					size['output_bytes'] += os.path.getsize(f)
+			size.update(j['settings'])
+			jobs[job] = size
+		return jobs
+
+	def summary(self, key='step'):
+		"""
+		Aggregate the records by step (or program): number of commands,
+		summed times and bytes, peak RSS and CPU efficiency.
+		"""
+		summary = {}
+		for r in self.records:
+			if r[key] not in summary:
+				summary[r[key]] = dict((c, 0) for c in TOTALS)
+				summary[r[key]].update({'commands': 0, 'max_rss': 0, 'cpu_reserved': 0})
+			s = summary[r[key]]
+			s['commands'] += 1
+			for c in TOTALS:
+				s[c] += r[c]
+			s['max_rss'] = max(s['max_rss'], r['max_rss'])
+			s['cpu_reserved'] += r['wall'] * r['n_cpu']
+		for k in summary:
+			s = summary[k]
+			if s['cpu_reserved'] > 0:
+				s['cpu_efficiency'] = round((s['user'] + s['sys']) / s['cpu_reserved'], 3)
+			else:
+				s['cpu_efficiency'] = 0
+			del s['cpu_reserved']
+		return summary
+
+	def write(self, prefix):
+		"""
+		Write prefix.tsv (one line per command) and prefix.json
+		(commands, per step and per program summaries, job sizes).
+		"""
+		if not os.path.exists(os.path.dirname(prefix)):
+			os.makedirs(os.path.dirname(prefix))
+		fw = open(prefix + '.tsv', mode='w')
+		fw.write('#' + "\t".join(COLUMNS) + "\n")
+		for r in self.records:
+			fw.write("\t".join([str(r[c]) for c in COLUMNS]) + "\n")
+		fw.close()
+		fw = open(prefix + '.json', mode='w')
+		json.dump({'commands': self.records, 'steps': self.summary('step'), 'programs': self.summary('program'), 'jobs': self.job_sizes()}, fw, indent=1)
+		fw.close()
+
+
+def program_name(cmd):
+	words = cmd.split()
+	if not words:
+		return ''
+	return os.path.basename(words[0])
@@ -0,0 +1,105 @@
+"""
+This module is a part of the virAnnot module
+Compact map file representation and precompiled step templates.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+# to allow code to work with Python 2 and 3
+from __future__ import print_function   # print is a function in python3
+from __future__ import unicode_literals # avoid adding "u" to each string
+from __future__ import division # avoid writing float(x) when dividing by x
+
+import csv
+import re
+import sys
+
+FIELD = re.compile(r'\((\w+)\)')
+
+
+class SampleMap:
+	"""
+	Map file stored as one list per column, keyed by header.
+	map[i] returns a read only view of the line i.
+	"""
+
+	def __init__(self, headers):
+		self.headers = headers
+		self.columns = dict((h, []) for h in headers)
+		self.size = 0
+
+	def append(self, line):
+		for j in range(0, len(self.headers)):
+			self.columns[self.headers[j]].append(line[j])
+		self.size += 1
+
+	def __len__(self):
+		return self.size
+
+	def __getitem__(self, i):
+		if i < 0 or i >= self.size:
+			raise IndexError(i)
+		return SampleRow(self, i)
+
+
+class SampleRow:
+	"""
+	A line of the map file, used like a dict.
+	"""
+	__slots__ = ['sample_map', 'index']
+
+	def __init__(self, sample_map, index):
+		self.sample_map = sample_map
+		self.index = index
+
+	def __getitem__(self, key):
+		return self.sample_map.columns[key][self.index]
+
+	def __contains__(self, key):
+		return key in self.sample_map.columns
+
+	def keys(self):
+		return list(self.sample_map.headers)
+
+
+class StepTemplate:
+	"""
+	Step arguments compiled once: each string containing (column)
+	fields is split in literal parts and column names.
+	"""
+
+	def __init__(self, step_args):
+		self.items = []
+		for k in step_args:
+			if isinstance(step_args[k], str) and FIELD.search(step_args[k]):
+				# split gives literal, column, literal, column, ..., literal
+				self.items.append((k, True, FIELD.split(step_args[k])))
+			else:
+				self.items.append((k, False, step_args[k]))
+
+	def expand(self, row):
+		"""
+		Return the step arguments with fields replaced by the row values.
+		"""
+		args = {}
+		for k, template, value in self.items:
+			if template:
+				parts = value[:]
+				for j in range(1, len(value), 2):
+					parts[j] = row[value[j]]
+				args[k] = ''.join(parts)
+			else:
+				args[k] = value
+		return args
+
+
+def read_map_file(f):
+	reader = csv.reader(f, delimiter="\t")
+	headers = next(reader)
+	headers[0] = headers[0][1:]
+	sample_map = SampleMap(headers)
+	for line in reader:
+		if len(line) != len(headers):
+			print(line)
+			print(headers)
+			sys.exit('line and headers not the same length.')
+		sample_map.append(line)
+	return sample_map
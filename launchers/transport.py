@@ -0,0 +1,261 @@
+"""
+This module is a part of the virAnnot module
+Commands sending files to the servers of the Blast steps, running scripts
+on them and fetching their results.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+# to allow code to work with Python 2 and 3
+from __future__ import print_function   # print is a function in python3
+from __future__ import unicode_literals # avoid adding "u" to each string
+from __future__ import division # avoid writing float(x) when dividing by x
+
+import functools
+import hashlib
+import logging as log
+import os
+import subprocess
+
+# seconds a shared ssh connection stays open after its last session
+CONTROL_PERSIST = 600
+
+
+class SshTransport:
+	"""
+	Reach a server through ssh. The commands of all the jobs go through
+	one master connection per server and user (ControlMaster), opened by
+	the first command and kept CONTROL_PERSIST seconds after the last one,
+	so only the first command pays the handshake and the authentication.
+	The files of an upload go in one tar stream, gzipped with compress.
+	"""
+
+	def __init__(self, server, username, adress, scratch, compress=False):
+		self.server = server
+		self.host = username + '@' + adress
+		self.scratch = scratch
+		self.compress = compress
+		control_dir = os.path.expanduser('~/.ssh')
+		if not os.path.isdir(control_dir):
+			os.makedirs(control_dir, 0o700)
+		self.options = ' -o ControlMaster=auto -o ControlPath=' + control_dir + '/virannot-%r@%h:%p -o ControlPersist=' + str(CONTROL_PERSIST)
+		# jobs with the same key can share an upload
+		self.key = ('ssh', self.host, scratch, compress)
+
+	def send(self, files):
+		"""
+		Command copying files in the scratch directory.
+		"""
+		return _tar(files, self.compress) + ' | ssh' + self.options + ' ' + self.host + " 'tar -x" + _tar_gzip(self.compress) + ' -C ' + self.scratch + "'"
+
+	def run(self, script):
+		"""
+		Command running the local file script on the server.
+		"""
+		return 'ssh' + self.options + ' ' + self.host + ' \'bash -s\' < ' + script
+
+	def fetch(self, path, directory):
+		"""
+		Command copying path, relative to the scratch directory, in directory.
+		"""
+		return 'scp' + self.options + ' ' + self.host + ':' + self.scratch + '/' + path + ' ' + directory
+
+	def exists(self, path):
+		"""
+		Command succeeding if the file path exists on the server.
+		"""
+		return 'ssh' + self.options + ' ' + self.host + " 'test -f " + path + "'"
+
+	def missing(self, paths):
+		"""
+		Command printing the paths not found on the server.
+		"""
+		return 'ssh' + self.options + ' ' + self.host + " '" + _missing(paths) + "'"
+
+
+class LocalTransport:
+	"""
+	Reach a server whose scratch directory is on this host, the host itself
+	or a shared file system: files are copied and scripts run by bash.
+	With a server running blast_launch.py -c local, the Blast steps run
+	without cluster nor network.
+	"""
+
+	def __init__(self, server, scratch, compress=False):
+		self.server = server
+		self.scratch = scratch
+		self.compress = compress
+		self.key = ('local', scratch)
+
+	def send(self, files):
+		return 'mkdir -p ' + self.scratch + ' && cp ' + ' '.join(files) + ' ' + self.scratch
+
+	def run(self, script):
+		return 'bash -s < ' + script
+
+	def fetch(self, path, directory):
+		return 'cp ' + self.scratch + '/' + path + ' ' + directory
+
+	def exists(self, path):
+		return 'test -f ' + path
+
+	def missing(self, paths):
+		return _missing(paths)
+
+
+def get_transport(params, server, compress=False):
+	"""
+	Transport of server from its transport parameter: ssh (default) or local.
+	"""
+	conf = params['servers'][server]
+	if conf.get('transport', 'ssh') == 'local':
+		return LocalTransport(server, conf['scratch'], compress)
+	return SshTransport(server, conf['username'], conf['adress'], conf['scratch'], compress)
+
+
+def store_dir(params, server):
+	"""
+	Directory of the server keeping the uploaded query files by content,
+	the store parameter of the server or virannot_store in its scratch.
+	"""
+	conf = params['servers'][server]
+	return conf.get('store', conf['scratch'] + '/virannot_store')
+
+
+def content_hash(f):
+	"""
+	md5 of the content of f, read once per path, size and mtime.
+	"""
+	f = os.path.abspath(f)
+	return _content_hash(f, os.path.getsize(f), os.path.getmtime(f))
+
+
+def upload(transport, files, stored=None):
+	"""
+	Command sending files in the scratch directory of transport, unless a
+	batch (see send_batches) sent them since they were modified: the stamp
+	of the batch is then removed so the next run sends them again.
+	The files with a path in the store (stored) are only sent if the
+	server does not have them yet.
+	"""
+	stamp = _stamp(files)
+	sent = ' && '.join(['[ ' + stamp + ' -nt ' + f + ' ]' for f in files])
+	if stored is None:
+		stored = {}
+	steps = ['{ ' + transport.exists(stored[f]) + ' || { ' + transport.send([f]) + '; }; }' for f in files if f in stored]
+	others = [f for f in files if f not in stored]
+	if others:
+		steps.append(transport.send(others))
+	return sent + ' && rm -f ' + stamp + ' || { ' + ' && '.join(steps) + '; }'
+
+
+def link_stored(files, stored, directory):
+	"""
+	Remote commands, run in the scratch directory, linking each file in
+	directory from its path in the store. Files already in the store are
+	only linked, whatever is left in the scratch directory under their
+	name. The others were just sent: they are moved to the store once
+	their content is checked. The script exits with 1 when a file sent is
+	corrupted or cut short, or when a file is neither sent nor in the store.
+	"""
+	cmd = ''
+	for f in files:
+		name = os.path.basename(f)
+		path = stored[f]
+		cmd += 'mkdir -p ' + os.path.dirname(path) + "\n"
+		cmd += 'if [ ! -f ' + path + ' ]; then' + "\n"
+		cmd += 'if [ ! -f ' + name + ' ]; then echo "' + name + ': neither sent nor in the store ' + os.path.dirname(path) + '." >&2; exit 1; fi' + "\n"
+		cmd += 'if [ "$(md5sum < ' + name + ' | cut -c1-32)" != ' + os.path.basename(path) + ' ]; then echo "' + name + ': content does not match the file sent, upload corrupted or incomplete." >&2; exit 1; fi' + "\n"
+		cmd += 'mv ' + name + ' ' + path + "\n"
+		cmd += 'fi' + "\n"
+		# the access time tells which files of the store are still used
+		cmd += 'touch -a -c ' + path + "\n"
+		cmd += 'ln -sf ' + path + ' ' + directory + '/' + name + "\n"
+	return cmd
+
+
+def send_batches(modules):
+	"""
+	Send the uploads of the modules in one transfer per server before their
+	commands run, and stamp them so the upload command of each module does
+	not send them again. A single module with several files (the contigs of
+	a pooled Blast step) sends them at once too. Files of different modules
+	with the same name are left to their modules, as is everything after a
+	failed transfer.
+	"""
+	batches = {}
+	for module in modules:
+		if getattr(module, 'uploads', None):
+			batches.setdefault(module.transport.key, []).append(module)
+	for key in batches:
+		names = {}
+		for module in batches[key]:
+			for f in module.uploads:
+				names.setdefault(os.path.basename(f), set()).add(f)
+		group = [m for m in batches[key] if all([len(names[os.path.basename(f)]) == 1 for f in m.uploads])]
+		if sum([len(m.uploads) for m in group]) < 2:
+			continue
+		files = []
+		stored = {}
+		for module in group:
+			files += [f for f in module.uploads if f not in files]
+			stored.update(getattr(module, 'stored', {}))
+		transport = group[0].transport
+		if stored:
+			# files already in the store of the server are not sent again
+			missing = _missing_paths(transport, [stored[f] for f in files if f in stored])
+			files = [f for f in files if f not in stored or stored[f] in missing]
+		if files:
+			cmd = transport.send(files)
+			log.info('sending the ' + str(len(files)) + ' files of ' + str(len(group)) + ' jobs to ' + transport.server + ' at once.')
+			log.debug(cmd)
+			if subprocess.call(cmd, shell=True) != 0:
+				log.warning('sending the files to ' + transport.server + ' at once failed, each job sends its own.')
+				continue
+		for module in group:
+			open(_stamp(module.uploads), 'w').close()
+
+
+def _stamp(files):
+	return files[0] + '.sent'
+
+
+@functools.lru_cache(maxsize=None)
+def _content_hash(path, size, mtime):
+	md5 = hashlib.md5()
+	fh = open(path, 'rb')
+	for block in iter(lambda: fh.read(1 << 20), b''):
+		md5.update(block)
+	fh.close()
+	return md5.hexdigest()
+
+
+def _missing(paths):
+	return 'for f in ' + ' '.join(paths) + '; do [ -f $f ] || echo $f; done'
+
+
+def _missing_paths(transport, paths):
+	"""
+	The paths not found on the server of transport, all of them if it can
+	not be reached.
+	"""
+	cmd = transport.missing(paths)
+	log.debug(cmd)
+	try:
+		return set(subprocess.check_output(cmd, shell=True).decode('utf-8').split())
+	except subprocess.CalledProcessError:
+		return set(paths)
+
+
+def _tar(files, compress):
+	"""
+	Command writing files as a tar stream on its output.
+	"""
+	cmd = 'tar -c' + _tar_gzip(compress)
+	for f in files:
+		cmd += ' -C ' + os.path.dirname(os.path.abspath(f)) + ' ' + os.path.basename(f)
+	return cmd
+
+
+def _tar_gzip(compress):
+	if compress:
+		return 'z'
+	return ''
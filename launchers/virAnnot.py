@@ -6,13 +6,15 @@ from __future__ import division # avoid writing float(x) when dividing by x
 
 import argparse
 import logging as log
-import csv
+import functools
 import importlib
-import re
 import sys
 import os, shutil
 import time
 import yaml
+from sample_map import StepTemplate, read_map_file
+
+OUTPUT_KEYS = ['out', 'o1', 'o2', 'bam', 'rn']
 
 
 """
@@ -24,17 +26,104 @@ def main():
 
 	params = _read_yaml_file(args.param)
 	steps = _read_yaml_file(args.step)
-	maps = _read_map_file(args.map)
-	if args.name_step == 'init':
+	maps = read_map_file(args.map)
+	dry_run = log.getLogger().getEffectiveLevel() != 20
+	report = None
+	journal = None
+	ex = None
+	# init, --plan and dry runs do not write anything in .virAnnot
+	if not args.plan and args.name_step != 'init' and (args.name_step in ['status', 'collect', 'all'] or args.name_step in steps or args.until is not None):
+		if args.name_step == 'status' or not dry_run:
+			from journal import Journal
+			journal = Journal(os.getcwd() + '/.virAnnot/journal.sqlite')
+		if args.name_step != 'status':
+			from executor import LocalExecutor
+			from report import RunReport
+			report = RunReport()
+		if args.name_step == 'collect':
+			# the downloads do not use the local cores
+			ex = LocalExecutor(args.fetch_jobs, dry_run, journal, args.resume, report)
+		elif args.name_step != 'status':
+			ex = LocalExecutor(args.cpu, dry_run, journal, args.resume, report, args.cluster_jobs)
+	mf = None
+	if args.incremental is not None:
+		from manifest import Manifest
+		mf = Manifest(os.getcwd() + '/.virAnnot/manifest', args.incremental)
+	if args.plan:
+		if args.name_step in steps:
+			step_names = [args.name_step]
+		else:
+			step_names = _select_steps(steps,args.until)
+		_plan(step_names,steps,maps,params)
+	elif args.name_step == 'init':
 		log.info('Init directory and move files...')
 		_create_folders(maps)
+	elif args.name_step == 'status':
+		_print_progress(journal)
+	elif args.name_step == 'collect':
+		from detached import collect
+		collect(params,ex)
 	elif(args.name_step in steps):
 		log.info('Launching step ' + args.name_step)
 		start_time = time.time()
-		_launch_step(args.name_step,steps,maps,params)
+		arr = None
+		if args.array is not None:
+			# the tasks are journaled once submitted, not in a dry run
+			from job_array import JobArray
+			arr = JobArray(args.name_step, args.array, args.array_limit, journal, args.resume)
+		_launch_step(args.name_step,steps,maps,params,ex,mf,arr)
+		if arr is not None:
+			jobid = arr.submit(log.getLogger().getEffectiveLevel() != 20)
+			if jobid is not None and args.wait:
+				from job_monitor import JobMonitor
+				monitor = JobMonitor(args.array)
+				monitor.watch(jobid)
+				if monitor.wait()[jobid] != 'done':
+					log.critical('Job array ' + jobid + ' ended in error.')
+				failed_tasks = arr.collect()
+				if failed_tasks:
+					log.critical('Failed array tasks: ' + ', '.join(failed_tasks))
+		failed = ex.wait()
+		if failed:
+			log.critical('Failed jobs: ' + ', '.join(failed))
+		log.info("--- %s seconds ---" %(time.time() - start_time))
+	elif args.name_step == 'all' or args.until is not None:
+		if args.until is not None and args.until not in steps:
+			log.critical(args.until + ' is not present in the step file.')
+			sys.exit(1)
+		step_names = _select_steps(steps,args.until)
+		if args.array is not None:
+			log.warning('-a is ignored with -n all and --until: each sge job is submitted with qsub -sync y, --cluster_jobs at once.')
+		log.info('Launching steps ' + ', '.join(step_names))
+		start_time = time.time()
+		failed = _launch_all(step_names,steps,maps,params,ex,mf)
+		if failed:
+			log.critical('Failed jobs: ' + ', '.join(failed))
 		log.info("--- %s seconds ---" %(time.time() - start_time))
 	else:
 		log.critical('This step is not present in the step file.')
+	if ex is not None:
+		ex.shutdown()
+	if journal is not None:
+		journal.close()
+	if report is not None and report.records:
+		_write_report(report)
+
+def _print_progress(journal):
+	from journal import STATES
+	progress = journal.progress()
+	print("\t".join(['#step'] + STATES))
+	for step in sorted(progress):
+		print("\t".join([step] + [str(progress[step][state]) for state in STATES]))
+
+def _write_report(report):
+	prefix = os.getcwd() + '/.virAnnot/reports/run_' + time.strftime('%Y%m%d_%H%M%S')
+	report.write(prefix)
+	summary = report.summary()
+	for step in sorted(summary):
+		log.info(step + ': ' + str(summary[step]['commands']) + ' commands, ' + str(round(summary[step]['wall'])) + ' s wall, ' +
+			str(round(summary[step]['user'] + summary[step]['sys'])) + ' s CPU, ' + str(summary[step]['max_rss'] // 1024) + ' MB peak RSS.')
+	log.info('Run report written in ' + prefix + '.tsv and ' + prefix + '.json')
 
 def _set_log_level(verbosity):
 	if verbosity == 1:
@@ -75,31 +164,273 @@ def _create_folders(maps):
 			sys.exit(1)
 
 
-def _launch_step(s_n,s,m,p):
+def _launch_step(s_n,s,m,p,ex,mf,arr=None):
+	"""
+	Create the module of each unit of the step, send the files they upload
+	to a same server at once (not in a dry run), then launch them.
+	"""
 	module_name = s_n.split('_')[0]
+	jobs = []
+	for unit, args in _step_args(s_n,s,m,p,module_name):
+		key = _node_key(s_n,unit)
+		module = _create_module(module_name,args)
+		entry = None
+		if mf is not None and module is not None and module.execution == 1:
+			entry = _manifest_entry(mf,module,args)
+		jobs.append((args,key,module,entry))
+	# a dry run does not touch the servers
+	if not ex.dry_run:
+		from transport import send_batches
+		send_batches([module for args, key, module, entry in jobs if module is not None and module.execution == 1 and (entry is None or not mf.is_up_to_date(key,entry))])
+	for args, key, module, entry in jobs:
+		_launch_module(args,module_name,ex,mf,key,arr,module,entry)
+
+
+def _launch_all(step_names,s,m,p,ex,mf):
+	"""
+	Launch every (sample, step) of the listed steps.
+	A node waits for the nodes of previous steps producing one of its inputs.
+	Only the OUTPUT_KEYS files are known as produced: the inputs of a later
+	step a previous one may write under other names are warned about.
+	"""
+	nodes = []
+	producers = {}
+	# nodes with dependents, filled while the nodes are listed
+	needed = set()
+	for s_n in step_names:
+		module_name = s_n.split('_')[0]
+		outputs = {}
+		undeclared = set()
+		for unit, args in _step_args(s_n,s,m,p,module_name):
+			name = _node_key(s_n,unit)
+			inputs, produced = _node_files(args)
+			# an output key naming a file of a previous step is an input (e.g. rn of Blast2ecsv)
+			inputs.update([f for f in produced if f in producers])
+			outputs[name] = [f for f in produced if f not in producers]
+			deps = set()
+			for f in inputs:
+				if f in producers:
+					deps.update(producers[f])
+			needed.update(deps)
+			if not deps and s_n != step_names[0]:
+				undeclared.update(_undeclared_inputs(args,inputs))
+			nodes.append((name, sorted(deps), functools.partial(_prepare_node,args,module_name,mf,name,needed,ex.report)))
+		if undeclared:
+			log.warning(s_n + ' does not wait for the previous steps: no ' + '/'.join(OUTPUT_KEYS) + ' of them names ' + ', '.join(sorted(undeclared)) +
+				'. If a previous step writes them under other keys (e.g. Demultiplex), launch ' + s_n + ' with -n once it is done.')
+		for name in outputs:
+			for f in outputs[name]:
+				producers.setdefault(f, []).append(name)
+	log.info(str(len(nodes)) + ' jobs to launch for ' + str(len(step_names)) + ' steps.')
+	return ex.run_graph(nodes)
+
+
+def _undeclared_inputs(args,inputs):
+	"""
+	Inputs of a node without dependencies that a previous step may write:
+	files of the sample directory, or sequence files not there yet.
+	"""
+	from planner import seq_format
+	files = []
+	for f in inputs:
+		if os.path.isabs(f):
+			continue
+		path = _plan_path(args,f)
+		if os.path.isfile(path) and os.path.dirname(path) != os.getcwd():
+			files.append(f)
+		elif not os.path.exists(path) and seq_format(f) is not None:
+			files.append(f)
+	return files
+
+
+def _plan(step_names,s,m,p):
+	"""
+	Print the estimated resources of each step from the input sizes
+	and the previous run reports.
+	"""
+	from planner import Planner, load_history, print_table, seq_format
+	planner = Planner(load_history(os.getcwd() + '/.virAnnot/reports'))
+	producers = set()
+	for s_n in step_names:
+		module_name = s_n.split('_')[0]
+		produced = set()
+		for unit, args in _step_args(s_n,s,m,p,module_name):
+			inputs, outputs = _node_files(args)
+			inputs.update([f for f in outputs if f in producers])
+			outputs = [f for f in outputs if f not in producers]
+			produced.update(outputs)
+			paths = []
+			for f in inputs:
+				path = _plan_path(args,f)
+				if os.path.isfile(path):
+					paths.append(path)
+				elif f in producers or seq_format(f) is not None:
+					# not produced yet
+					paths.append(None)
+			planner.add(s_n,module_name,_node_key(s_n,unit),paths,[_plan_path(args,f) for f in outputs],_plan_settings(module_name,args))
+		producers.update(produced)
+	print_table(planner.table())
+
+
+def _plan_path(args,f):
+	if os.path.isabs(f):
+		return f
+	if 'sample' in args and os.path.exists(os.path.join(os.getcwd(),args['sample'],f)):
+		return os.path.join(os.getcwd(),args['sample'],f)
+	return os.path.abspath(f)
+
+
+def _plan_settings(module_name,args):
+	"""
+	Settings of a job as the module would use them (same defaults).
+	"""
+	settings = {'n_cpu': args.get('n_cpu',1), 'sge': bool(args.get('sge',False)), 'num_chunk': None, 'tc': None, 'chunk_cpu': None}
+	if module_name in ['Blast', 'Rps2blast', 'Diamond2blast']:
+		# without num_chunk, blast_launch.py chooses it on the server from its own history
+		settings['num_chunk'] = args.get('num_chunk','auto')
+		settings['tc'] = args.get('tc',5)
+		# blast_launch.py runs each chunk on 8 cores, Diamond2blast on n_cpu
+		if module_name == 'Diamond2blast':
+			settings['chunk_cpu'] = settings['n_cpu']
+		else:
+			settings['chunk_cpu'] = 8
+	return settings
+
+
+def _node_files(args):
+	"""
+	Split the file names of a module arguments in inputs and outputs.
+	"""
+	inputs = set()
+	outputs = set()
+	for k in args:
+		if k in ['params', 'sample', 'library', 'iter']:
+			continue
+		if isinstance(args[k], dict):
+			i, o = _node_files(args[k])
+			inputs.update(i)
+			outputs.update(o)
+		elif isinstance(args[k], list):
+			inputs.update([f for f in args[k] if isinstance(f, str)])
+		elif isinstance(args[k], str):
+			if k in OUTPUT_KEYS:
+				outputs.add(args[k])
+			else:
+				inputs.add(args[k])
+	return inputs, outputs
+
+
+def _prepare_node(args,module_name,mf,key,needed=(),report=None):
+	"""
+	Create the module once its dependencies are done, return its
+	commands, number of cpu, completion callback and whether it runs on
+	the cluster. SGE jobs are submitted synchronously so the node ends
+	with the job. A module skipping its execution gives a node without
+	commands, done for the next steps. A detached node ends before its
+	results exist, so it is refused when other nodes of needed wait for it.
+	"""
+	module = _create_module(module_name,args)
+	if module is None:
+		return None
+	if module.execution != 1:
+		log.critical('Skip execution.')
+		return [], '1', None, False
+	if getattr(module,'detach',False) and key in needed:
+		log.critical(key + ' not launched: detach does not wait for the results the next steps need. Launch the step with -n then -n collect.')
+		return None
+	done = None
+	if mf is not None:
+		entry = _manifest_entry(mf,module,args)
+		if mf.is_up_to_date(key,entry):
+			log.info(key + ' is up to date, skip execution.')
+			return [], '1', None, False
+		done = functools.partial(_record_manifest,mf,key,entry)
+	_report_job(report,key,module_name,module,args)
+	if module.sge:
+		_write_cmd_file(module)
+		return [_qsub_call(module,module_name,True)], _module_cpu(module), done, True
+	return module.cmd, _module_cpu(module), done, False
+
+
+def _node_key(s_n,unit):
+	if unit is None:
+		return s_n + '/global'
+	return s_n + '/' + unit
+
+
+def _manifest_entry(mf,module,args):
+	inputs, outputs = _node_files(args)
+	inputs = [_module_path(module,f) for f in inputs]
+	outputs = [_module_path(module,f) for f in outputs]
+	return mf.entry(module.cmd, [f for f in inputs if os.path.isfile(f)], outputs)
+
+
+def _module_path(module,f):
+	"""
+	Step files are relative to the module working directory or to the current directory.
+	"""
+	if os.path.isabs(f):
+		return f
+	if hasattr(module,'wd') and os.path.exists(os.path.join(module.wd,f)):
+		return os.path.join(module.wd,f)
+	if os.path.exists(f) or not hasattr(module,'wd'):
+		return os.path.abspath(f)
+	return os.path.join(module.wd,f)
+
+
+def _report_job(report,key,module_name,module,args):
+	"""
+	Record the files and settings of a job in the run report, the
+	history of --plan.
+	"""
+	if report is None:
+		return
+	inputs, outputs = _node_files(args)
+	report.add_job(key, module_name, [_module_path(module,f) for f in inputs], [_module_path(module,f) for f in outputs], _plan_settings(module_name,args))
+
+
+def _record_manifest(mf,key,entry,status):
+	if status == 0:
+		mf.record(key,entry)
+
+
+def _select_steps(s,until):
+	step_names = list(s.keys())
+	if until is not None:
+		step_names = step_names[:step_names.index(until) + 1]
+	return step_names
+
+
+def _step_args(s_n,s,m,p,module_name):
+	"""
+	Return the (unit, arguments) of each module to create for a step,
+	unit being the SampleID, the library or None for global steps.
+	"""
 	if module_name == 'Getresults':
-		_launch_getresults(s_n,s,m,p,module_name)
+		return _getresults_args(s_n,s,m,p)
 	else:
 		if('iter' in s[s_n]):
 			if(s[s_n]['iter'] == 'library'):
-				 _launch_by_library(s_n,s,m,p,module_name)
+				return _args_by_library(s_n,s,m,p)
 			elif(s[s_n]['iter'] == 'sample'):
-				_launch_by_sample_id(s_n,s,m,p,module_name)
+				return _args_by_sample_id(s_n,s,m,p)
 			elif(s[s_n]['iter'] == 'global'):
-				_launch_global(s_n,s,m,p,module_name)
+				return _global_args(s_n,s,m,p,module_name)
 			else:
 				log.critical('iter options must be library, sample or global')
 				sys.exit(1)
 		else:
-			_launch_by_sample_id(s_n,s,m,p,module_name)
+			return _args_by_sample_id(s_n,s,m,p)
 
 
-def _launch_getresults(s_n,s,m,p,module_name):
+def _getresults_args(s_n,s,m,p):
 	args={}
 	args['global_dir']=[]
 	args['sample_dir']={}
 	args['global_files']=[]
 	args['sample_files']={}
+	tpl = StepTemplate(s[s_n])
+	expanded = None
 	for key in s[s_n]:
 		if 'global_dir' in key:
 			args['global_dir'].append(s[s_n][key])
@@ -108,8 +439,10 @@ def _launch_getresults(s_n,s,m,p,module_name):
 		if key == 'out':
 			args['out'] = s[s_n][key]
 		if 'sample' in key:
+			if expanded is None:
+				expanded = [tpl.expand(m[i]) for i in range(0,len(m))]
 			for i in range(0,len(m)):
-				tmp = _replace_sample_name(s[s_n],m[i])
+				tmp = expanded[i]
 				if 'dir' in key:
 					if m[i]['SampleID'] not in args['sample_dir']:
 						args['sample_dir'][m[i]['SampleID']]=[]
@@ -118,16 +451,21 @@ def _launch_getresults(s_n,s,m,p,module_name):
 					if m[i]['SampleID'] not in args['sample_files']:
 						args['sample_files'][m[i]['SampleID']]=[]
 					args['sample_files'][m[i]['SampleID']].append(tmp[key])
-	_launch_module(args,module_name)
+	return [(None, args)]
 
-def _launch_global(s_n,s,m,p,module_name):
+def _global_args(s_n,s,m,p,module_name=None):
 	global_input = {}
 	global_input['args'] = {}
+	tpl = StepTemplate(s[s_n])
 	for i in range(0,len(m)):
-		tmp = _replace_sample_name(s[s_n],m[i])
-		global_input['args'][m[i]['SampleID']] = {}
+		row = m[i]
+		tmp = tpl.expand(row)
+		global_input['args'][row['SampleID']] = {}
 		for j in tmp:
 			if j == 'out':
+				# each sample of a pooled Blast step keeps its own out, the step fans out to them
+				if module_name == 'Blast':
+					global_input['args'][row['SampleID']]['out'] = tmp[j]
 				if 'out' not in global_input:
 					global_input['out'] = tmp[j]
 					continue
@@ -180,105 +518,139 @@ def _launch_global(s_n,s,m,p,module_name):
 					global_input['rps_folder'] = tmp[j]
 					continue
 			else:
-				global_input['args'][m[i]['SampleID']][j] = tmp[j]
+				global_input['args'][row['SampleID']][j] = tmp[j]
 	global_input['params'] = p
-	_launch_module(global_input,module_name)
+	return [(None, global_input)]
 
 
-def _launch_by_sample_id(s_n,s,m,p,module_name):
+def _args_by_sample_id(s_n,s,m,p):
+	sample_args = []
+	tpl = StepTemplate(s[s_n])
 	for i in range(0,len(m)):
-		tmp = _replace_sample_name(s[s_n],m[i])
-		tmp['sample'] = m[i]['SampleID']
+		row = m[i]
+		tmp = tpl.expand(row)
+		tmp['sample'] = row['SampleID']
 		tmp['params'] = p
-		_launch_module(tmp,module_name)
+		sample_args.append((row['SampleID'], tmp))
+	return sample_args
 
 
-def _launch_by_library(s_n,s,m,p,module_name):
+def _args_by_library(s_n,s,m,p):
 	args = {}
+	tpl = StepTemplate(s[s_n])
 	for i in range(0,len(m)):
-		tmp = _replace_sample_name(s[s_n],m[i])
-		if(m[i]['library'] not in args):
-			args[m[i]['library']] = {}
-		if('file1' not in args[m[i]['library']] and 'i1' not in s[s_n]):
-			args[m[i]['library']]['i1'] = m[i]['file1']
+		row = m[i]
+		tmp = tpl.expand(row)
+		if(row['library'] not in args):
+			args[row['library']] = {}
+		if('file1' not in args[row['library']] and 'i1' not in s[s_n]):
+			args[row['library']]['i1'] = row['file1']
 		else:
-			args[m[i]['library']]['i1'] = tmp['i1']
-		if('file2' not in args[m[i]['library']] and 'i2' not in s[s_n]):
-			args[m[i]['library']]['i2'] = m[i]['file2']
+			args[row['library']]['i1'] = tmp['i1']
+		if('file2' not in args[row['library']] and 'i2' not in s[s_n]):
+			args[row['library']]['i2'] = row['file2']
 		else:
-			args[m[i]['library']]['i2'] = tmp['i2']
+			args[row['library']]['i2'] = tmp['i2']
 		if(s_n == 'Demultiplex'):
-			if('mid' not in args[m[i]['library']]):
-				args[m[i]['library']]['mid'] = {}
-			args[m[i]['library']]['mid'][m[i]['SampleID']] = m[i]['mid']
-			args[m[i]['library']]['common'] = m[i]['common']
+			if('mid' not in args[row['library']]):
+				args[row['library']]['mid'] = {}
+			args[row['library']]['mid'][row['SampleID']] = row['mid']
+			args[row['library']]['common'] = row['common']
 		for k in tmp:
-			if(k not in args[m[i]['library']]):
-				args[m[i]['library']][k] = tmp[k]
+			if(k not in args[row['library']]):
+				args[row['library']][k] = tmp[k]
+	library_args = []
 	for library in args:
 		args[library]['params'] = p
 		args[library]['library'] = library
-		_launch_module(args[library],module_name)
+		library_args.append((library, args[library]))
+	return library_args
 
 
-def _launch_module(args,module_name):
-	module = _create_module(module_name,args)
+def _launch_module(args,module_name,ex,mf,key,arr=None,module=None,entry=None):
+	if module is None:
+		module = _create_module(module_name,args)
 	if module.execution == 1:
-		_exec(module,module_name)
+		_report_job(ex.report,key,module_name,module,args)
+		if mf is None:
+			_exec(module,module_name,ex,key,arr=arr)
+			return
+		if entry is None:
+			entry = _manifest_entry(mf,module,args)
+		if mf.is_up_to_date(key,entry):
+			log.info(key + ' is up to date, skip execution.')
+		elif module.sge and arr is not None:
+			_exec(module,module_name,ex,key,arr=arr)
+			if log.getLogger().getEffectiveLevel() == 20:
+				mf.record(key,entry,True)
+		else:
+			_exec(module,module_name,ex,key,functools.partial(_record_manifest,mf,key,entry))
 	else:
 		log.critical('Skip execution.')
 
-def _exec(module,name):
+def _exec(module,name,ex,key,done=None,arr=None):
+	"""
+	Run the commands of a module locally or in a sge job. The sge job is
+	submitted with qsub -sync y so the journal gets its exit code, the
+	array tasks are journaled by the job array.
+	"""
 	if not module.sge:
-		for el in module.cmd:
-			log.debug(el)
-			if log.getLogger().getEffectiveLevel() == 20:
-				os.system(el)
+		ex.submit(key, module.cmd, _module_cpu(module), done)
+	elif arr is not None:
+		first = arr.add(module.wd, module.cmd_file, _module_cpu(module), key, module.cmd)
+		if first < len(module.cmd):
+			_write_cmd_file(module, first)
 	else:
-		fw =  open(module.cmd_file, mode='w')
-		for el in module.cmd:
-			fw.write(el + "\n")
-		fw.close()
-		qsub_call=''
-		if hasattr(module,'iter'):
-			if module.iter == 'sample':
-				qsub_call = "qsub -wd " + module.wd + " -V -N " + module.sample + '_' + name + ' -pe multithread ' + module.n_cpu + ' ' + module.cmd_file
-			elif module.iter == 'library':
-				qsub_call = "qsub -wd " + module.wd + " -V -N " + module.library + '_' + name + ' -pe multithread ' + module.n_cpu + ' ' + module.cmd_file
-			elif module.iter == 'global':
-				qsub_call = "qsub -wd " + module.wd + " -V -N " + name + ' -pe multithread ' + module.n_cpu + ' ' + module.cmd_file
-		else:
-			if name == 'Blast':
-				qsub_call = "qsub -wd " + module.wd + " -V -N " + module.sample + '_' + name + '_' + module.type + ' ' + module.cmd_file
-			else:
-				qsub_call = qsub_call = "qsub -wd " + module.wd + " -V -N " + module.sample + '_' + name + ' ' + ' -pe multithread ' + module.n_cpu + ' ' + module.cmd_file
-		log.debug(qsub_call)
-		if log.getLogger().getEffectiveLevel() == 20:
-			os.system(qsub_call)
+		_write_cmd_file(module)
+		ex.submit(key, [_qsub_call(module,name,True)], done=done, cluster=True)
 
 
-def _replace_sample_name(step_args,sample_map):
-	args = {}
-	for k in step_args:
-		if(isinstance(step_args[k], str)):
-			if(re.search('\(\w+\)',step_args[k])):
-				matches = re.findall('\((\w+)\)',step_args[k])
-				string = step_args[k]
-				for m in matches:
-					string = string.replace('('+m+')',sample_map[m])
-				args[k] = string
-			else:
-				args[k] = step_args[k]
+def _write_cmd_file(module,first=0):
+	fw =  open(module.cmd_file, mode='w')
+	for el in module.cmd[first:]:
+		fw.write(el + "\n")
+	fw.close()
+
+
+def _qsub_call(module,name,sync=False):
+	qsub = "qsub -wd " + module.wd + " -V"
+	if sync:
+		qsub += " -sync y"
+	qsub_call=''
+	if hasattr(module,'iter'):
+		if module.iter == 'sample':
+			qsub_call = qsub + " -N " + module.sample + '_' + name + ' -pe multithread ' + module.n_cpu + ' ' + module.cmd_file
+		elif module.iter == 'library':
+			qsub_call = qsub + " -N " + module.library + '_' + name + ' -pe multithread ' + module.n_cpu + ' ' + module.cmd_file
+		elif module.iter == 'global':
+			qsub_call = qsub + " -N " + name + ' -pe multithread ' + module.n_cpu + ' ' + module.cmd_file
+	else:
+		if name == 'Blast':
+			qsub_call = qsub + " -N " + module.sample + '_' + name + '_' + module.type + ' ' + module.cmd_file
 		else:
-			args[k] = step_args[k]
-	return args
+			qsub_call = qsub + " -N " + module.sample + '_' + name + ' ' + ' -pe multithread ' + module.n_cpu + ' ' + module.cmd_file
+	return qsub_call
+
+
+def _module_cpu(module):
+	if hasattr(module,'n_cpu'):
+		return module.n_cpu
+	return '1'
+
+
+@functools.lru_cache(maxsize=None)
+def _module_class(name):
+	"""
+	Launcher class of a module, imported once for all the samples.
+	"""
+	return getattr(importlib.import_module(name),name)
 
 
 def _create_module(name,param):
 	if '_' in name:
 		name = name.split('_')[0]
 	try:
-		_class = getattr(importlib.import_module(name),name)
+		_class = _module_class(name)
 		instance = _class(param)
 		return instance
 	except Exception as e:
@@ -286,24 +658,6 @@ def _create_module(name,param):
 		print(str(e))
 
 
-def _read_map_file(f):
-	reader = csv.reader(f,delimiter="\t")
-	data = list(reader)
-	headers = data[0]
-	headers[0] = headers[0][1:]
-	map_obj = []
-	for i in range(1,len(data)):
-		dict={}
-		if len(data[i]) != len(headers):
-			print(data[i])
-			print(headers)
-			sys.exit('line and headers not the same length.')
-		for j in range(0,len(headers)):
-			dict[headers[j]] = data[i][j]
-		map_obj.append(dict)
-	return map_obj
-
-
 def _read_yaml_file(f):
 	return yaml.safe_load(f)
 
@@ -312,8 +666,18 @@ def _set_options():
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-m','--map',help='The map file.',action='store',type=argparse.FileType('r'),required=True)
 	parser.add_argument('-s','--step',help='The step file.',action='store',type=argparse.FileType('r'),required=True)
-	parser.add_argument('-n','--name_step',dest='name_step',help='The specified step to launch.',action='store',type=str)
+	parser.add_argument('-n','--name_step',dest='name_step',help='The specified step to launch, all to launch every step, status to print the progress of the commands, collect to fetch the results of the detached Blast runs that ended.',action='store',type=str)
 	parser.add_argument('-p','--param',help='The global parameter file.',action='store',type=argparse.FileType('r'))
+	parser.add_argument('--plan',help='Print the estimated core hours, memory and disk of the steps (-n) instead of launching them.',action='store_true')
+	parser.add_argument('--until',help='With -n all, stop after this step.',action='store',type=str)
+	parser.add_argument('-i','--incremental',help='Skip the samples whose command, input files and outputs did not change since the last run. hash compares file contents instead of size and mtime.',action='store',nargs='?',const='mtime',choices=['mtime','hash'])
+	parser.add_argument('-a','--array',help='Submit the sge jobs of the step as a single job array.',action='store',nargs='?',const='sge',choices=['sge','slurm'])
+	parser.add_argument('--wait',help='With --array, wait for the job array to finish.',action='store_true')
+	parser.add_argument('--array_limit',help='Maximum number of array tasks running at the same time.',action='store',type=int)
+	parser.add_argument('-r','--resume',help='Do not run again the commands of each job already done according to the run journal.',action='store_true')
+	parser.add_argument('-c','--cpu',help='Number of cores available to run local (sge: False) jobs concurrently.',action='store',type=int,default=1)
+	parser.add_argument('--fetch_jobs',help='With -n collect, number of results fetched at the same time.',action='store',type=int,default=4)
+	parser.add_argument('--cluster_jobs',help='Number of sge jobs (without --array) submitted and waited for at the same time, besides the local jobs.',action='store',type=int,default=10)
 	parser.add_argument('-v','--verbosity',help='Verbose level', action='store',type=int,choices=[1,2,3,4],default=1)
 	args = parser.parse_args()
 	return args
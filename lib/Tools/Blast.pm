@@ -988,7 +988,7 @@ sub _readInputFile {
 	my ($self, $taxonomyTools, $readsPerContigFile, $sequencesFile) = @_;
 	$logger->debug('Reading blast file: ' . $self->file);
 	$self->{_queryCounter} = 0;
-	$self->{_searchioObj} = Bio::SearchIO->new(   '-file'   => $self->file,
+	$self->{_searchioObj} = Bio::SearchIO->new(   '-file'   => _decompressed($self->file),
 	'-format' => $self->format);
 
 	my @matches;
@@ -1075,6 +1075,47 @@ sub _readInputFile {
 	return \@matches;
 }
 
+=head2 _decompressed
+
+=head2
+
+=head3 Description
+
+Open argument of a BLAST result file, a pipe through gzip or zstd when its name ends with .gz or .zst.
+
+=head3 Arguments
+
+=over 4
+
+=item
+
+A BLAST result file
+
+=back
+
+=head3 Returns
+
+=over 4
+
+=item
+
+The file name, or the decompressing command to read from
+
+=back
+
+=cut
+
+sub _decompressed {
+	my ($file) = @_;
+	if($file =~ /\.gz$/){
+		return 'gzip -dc ' . $file . ' |';
+	}
+	elsif($file =~ /\.zst$/){
+		return 'zstd -dc ' . $file . ' |';
+	}
+	return $file;
+}
+
 =head2 _parseGi
 
 =head2
@@ -0,0 +1,114 @@
+"""
+This module is a part of the virAnnot module
+Fake blastx and sample files shared by the tests.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+import os
+import random
+import re
+
+import pytest
+
+LAUNCHERS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'launchers')
+
+# one XML iteration per query, hits depending on the sequence length only.
+# As BLAST, with -parse_deflines the query ID is the first word of the
+# defline and the description the rest, the ID is Query_N otherwise.
+FAKE_BLASTX = r"""#!/bin/bash
+p=0
+while [ $# -gt 0 ]; do case $1 in -query) q=$2;; -out) o=$2;; -outfmt) f=$2;; -parse_deflines) p=1;; esac; shift; done
+if [ $f == 6 ]; then awk '/^>/{id=substr($1,2); next} {if (length($0)%3) print id"\thit"length($0)"\t99"; if (length($0)%5==0) print id"\thitb\t98"}' $q > $o; exit; fi
+{ echo '<?xml version="1.0"?>'; echo '<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">'; echo '<BlastOutput>'; echo '  <BlastOutput_iterations>';
+awk -v p=$p '/^>/{i++; d=substr($0,2); id="Query_"i; if (p) {id=$1; sub(/^>/, "", id); d=$0; sub(/^>[^ \t]*[ \t]*/, "", d); if (d == "") d="No definition line"}
+print "<Iteration>\n  <Iteration_iter-num>"i"</Iteration_iter-num>\n  <Iteration_query-ID>"id"</Iteration_query-ID>\n  <Iteration_query-def>"d"</Iteration_query-def>"; next} {print "  <Hit_len>"length($0)"</Hit_len>\n</Iteration>"}' $q
+echo '  </BlastOutput_iterations>'; echo '</BlastOutput>'; } > $o
+"""
+
+
+# prints the output prepared for its nth call, or the current one (out), and logs its arguments
+FAKE_SCHEDULER = r"""#!/bin/sh
+d=$(dirname $0)
+n=$(( $(cat $d/count 2>/dev/null || echo 0) + 1 ))
+echo $n > $d/count
+echo "$@" >> $d/calls
+cat $d/out_$n 2>/dev/null || cat $d/out 2>/dev/null
+exit 0
+"""
+
+# prints the accounting prepared for the job given last, fails for an unknown job
+FAKE_ACCOUNTING = r"""#!/bin/sh
+d=$(dirname $0)
+for job; do :; done
+echo "$@" >> $d/accounting_calls
+n=$(grep -c " $job\$" $d/accounting_calls)
+if [ -f $d/acct_${job}_$n ]; then cat $d/acct_${job}_$n; else cat $d/acct_$job 2>/dev/null; fi
+"""
+
+
+def fake_scheduler(directory, outputs, accounting=None):
+	"""
+	Write in directory a status command (squeue or qstat) printing the
+	nth of outputs for its nth call, and an accounting command (sacct or
+	qacct, directory/sacct) printing accounting[jobid + '_n'] for its nth
+	call for jobid if given, accounting[jobid] otherwise.
+	Return the path of the status command.
+	"""
+	script = directory / 'squeue'
+	script.write_text(FAKE_SCHEDULER)
+	script.chmod(0o755)
+	for i, output in enumerate(outputs):
+		(directory / ('out_%i' % (i + 1))).write_text(output)
+	acct = directory / 'sacct'
+	acct.write_text(FAKE_ACCOUNTING)
+	acct.chmod(0o755)
+	for jobid in accounting or {}:
+		(directory / ('acct_' + jobid)).write_text(accounting[jobid])
+	return str(script)
+
+
+@pytest.fixture
+def fake_bin(tmp_path, monkeypatch):
+	"""
+	Directory put first in PATH with the fake blastx and a blast_launch.py
+	running the one of the repository. HOME is the test directory, so the
+	fake timings do not go to the history of the user and no ~/.bashrc
+	changes PATH in the remote scripts.
+	"""
+	directory = tmp_path / 'bin'
+	directory.mkdir()
+	blastx = directory / 'blastx'
+	blastx.write_text(FAKE_BLASTX)
+	blastx.chmod(0o755)
+	launch = directory / 'blast_launch.py'
+	launch.write_text('#!/bin/sh\nexec python3 ' + os.path.join(LAUNCHERS, 'blast_launch.py') + ' "$@"\n')
+	launch.chmod(0o755)
+	monkeypatch.setenv('PATH', str(directory) + os.pathsep + os.environ['PATH'])
+	monkeypatch.setenv('HOME', str(tmp_path))
+	return directory
+
+
+def write_samples(directory, paths):
+	"""
+	Write 40 contigs in each fasta of paths, relative to directory, with
+	the same names in all of them and the first ten sequences shared.
+	"""
+	rand = random.Random(3)
+	shared = [_sequence(rand) for i in range(10)]
+	for path in paths:
+		with open(os.path.join(str(directory), path), 'w') as fh:
+			for i in range(40):
+				seq = shared[i] if i < 10 else _sequence(rand)
+				fh.write('>contig-%i len=%i\n%s\n' % (i, len(seq), seq))
+
+
+def iterations(path):
+	"""
+	XML iterations of path without their number, automatic query IDs
+	(Query_N) being left out too.
+	"""
+	text = open(path).read()
+	return [re.sub(r'<Iteration_iter-num>[^<]*|<Iteration_query-ID>Query_[^<]*', '', i) for i in re.findall(r'<Iteration>.*?</Iteration>', text, re.S)]
+
+
+def _sequence(rand):
+	return ''.join([rand.choice('ACGT') for i in range(rand.randint(30, 400))])
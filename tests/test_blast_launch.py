@@ -0,0 +1,130 @@
+"""
+This module is a part of the virAnnot module
+Tests of the result cache of blast_launch.py, run with a fake blastx.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from conftest import LAUNCHERS, iterations, write_samples
+
+sys.path.insert(0, LAUNCHERS)
+
+import blast_launch
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch, fake_bin):
+	monkeypatch.chdir(tmp_path)
+	write_samples(tmp_path, ['a.fa', 'b.fa'])
+	return tmp_path
+
+
+def _launch(inputs, outs, outfmt, extra):
+	cmd = [sys.executable, os.path.join(LAUNCHERS, 'blast_launch.py'), '-c', 'local', '-s'] + inputs + ['-o'] + outs
+	cmd += ['--prefix', 'p', '-p', 'blastx', '-d', 'nr', '-n', '7', '--outfmt', str(outfmt), '-v', '2', '--history', 'history.tsv'] + extra
+	subprocess.check_call(cmd)
+
+
+def _reference(name, outfmt):
+	ref = 'ref_' + name + '.' + {5: 'xml', 6: 'm8'}[outfmt]
+	subprocess.check_call(['blastx', '-query', name + '.fa', '-out', ref, '-outfmt', str(outfmt), '-parse_deflines'])
+	return ref
+
+
+def test_cached_results_follow_their_queries(workdir):
+	# -r reorders the records between the chunks
+	_launch(['a.fa'], ['a.xml'], 5, ['-r', '--cache', 'cache.sqlite'])
+	_launch(['a.fa'], ['a.m8'], 6, ['-r', '--cache', 'cache.sqlite'])
+	assert iterations('a.xml') == iterations(_reference('a', 5))
+	assert open('a.m8').read() == open(_reference('a', 6)).read()
+
+
+@pytest.mark.parametrize('extra', [['-r'], []])
+def test_inputs_keep_their_own_results(workdir, extra):
+	# a.fa and b.fa use the same contig names for different sequences
+	_launch(['a.fa', 'b.fa'], ['a.xml', 'b.xml'], 5, extra)
+	_launch(['a.fa', 'b.fa'], ['a.m8', 'b.m8'], 6, extra)
+	for name in ['a', 'b']:
+		assert iterations(name + '.xml') == iterations(_reference(name, 5))
+		assert open(name + '.m8').read() == open(_reference(name, 6)).read()
+
+
+def test_cache_hits_keep_the_deflines_of_their_input(workdir):
+	_launch(['a.fa', 'b.fa'], ['a.m8', 'b.m8'], 6, ['-r', '--cache', 'cache.sqlite'])
+	os.remove('b.m8')
+	# every sequence is cached now
+	_launch(['b.fa', 'a.fa'], ['b.m8', 'a.m8'], 6, ['-r', '--cache', 'cache.sqlite'])
+	for name in ['a', 'b']:
+		assert open(name + '.m8').read() == open(_reference(name, 6)).read()
+
+
+def test_history_records_the_threads_used(workdir):
+	_launch(['a.fa'], ['a.m8'], 6, ['--n_cpu', '8', '--cores', '2'])
+	rows = [line.split('\t') for line in open('history.tsv')]
+	assert rows and all([row[3] == '2' for row in rows])
+
+
+def test_short_or_foreign_chunks_do_not_set_the_cost(tmp_path):
+	history = str(tmp_path / 'history.tsv')
+	rows = [['blastx', '/db/nr', 'here', '1', '1000', '0.01']] * 200
+	rows += [['blastx', '/db/nr', 'there', '1', '1000', '600']] * 10
+	rows += [['blastx', '/db/nr', 'here', '4', '100000', '600']] * 4
+	open(history, 'w').write(''.join(['\t'.join(row) + '\n' for row in rows]))
+	assert blast_launch._residue_cost(history, 'blastx', '/db/nr', 'here') == (blast_launch.DEFAULT_COST['blastx'], 'default')
+	open(history, 'a').write('blastx\t/db/nr\there\t4\t100000\t600\n')
+	assert blast_launch._residue_cost(history, 'blastx', '/db/nr', 'here')[0] == 4 * 600 / 100000
+
+
+def test_records_start_at_the_beginning_of_a_line(tmp_path):
+	fasta = tmp_path / 'gt.fa'
+	fasta.write_bytes(b'>a x>y\nAC>GT\nAA\n>b\nTT')
+	offsets, sizes, residues = blast_launch._index_fasta(str(fasta))
+	assert list(offsets) == [0, 16]
+	assert list(sizes) == [16, 5]
+	assert list(residues) == [7, 2]
+
+
+def test_cache_key_finds_the_database_in_blastdb(tmp_path, monkeypatch):
+	from blast_cache import search_settings
+	(tmp_path / 'db').mkdir()
+	(tmp_path / 'db' / 'nr.pal').write_text('')
+	monkeypatch.setenv('BLASTDB', str(tmp_path / 'db'))
+	keys = []
+	for run in ['run1', 'run2']:
+		(tmp_path / run).mkdir()
+		monkeypatch.chdir(tmp_path / run)
+		keys.append(search_settings('blastx', 'nr', 0.001, 5, 5))
+	assert keys[0] == keys[1]
+	assert keys[0].split('\t')[1] == str(tmp_path / 'db' / 'nr')
+	assert keys[0].split('\t')[2] != 'None'
+
+
+def _alive(pid):
+	try:
+		return open('/proc/%i/stat' % pid).read().split(')')[1].split()[0] != 'Z'
+	except IOError:
+		return False
+
+
+def test_stop_kills_the_children_of_the_commands(tmp_path):
+	# a BLAST reading its chunk through a pipe under sh
+	child = tmp_path / 'child'
+	runner = blast_launch.LocalRunner(1)
+	future = runner.submit(['/bin/sh', '-c', 'sleep 30 | cat & echo $! > ' + str(child) + '; wait'], str(tmp_path / 'log'))
+	for i in range(100):
+		if child.exists() and child.read_text().strip():
+			break
+		time.sleep(0.05)
+	pid = int(child.read_text())
+	runner.stop()
+	assert future.result() != 0
+	for i in range(100):
+		if not _alive(pid):
+			break
+		time.sleep(0.05)
+	assert not _alive(pid)
+	runner.shutdown()
@@ -0,0 +1,119 @@
+"""
+This module is a part of the virAnnot module
+End-to-end test of a pooled Blast step (iter: global) on a local server.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+import os
+import subprocess
+import sys
+
+from conftest import LAUNCHERS, iterations, write_samples
+
+sys.path.insert(0, LAUNCHERS)
+
+import virAnnot
+
+SAMPLES = ['S1', 'S2', 'S3']
+
+
+def _write_run(directory, pooled, compress):
+	open(os.path.join(directory, 'map.txt'), 'w').write('#SampleID\tfile\n' + ''.join([s + '\tx\n' for s in SAMPLES]))
+	open(os.path.join(directory, 'params.yaml'), 'w').write(
+		'servers:\n  local:\n    transport: local\n    scratch: ' + os.path.join(directory, 'scratch') + '\n    username: me\n    db:\n      nr: nr\n')
+	step = 'Blast_nr:\n'
+	if pooled:
+		step += '  iter: global\n'
+	step += '  type: blastx\n  contigs: (SampleID)_contigs.fa\n  db: nr\n  out: (SampleID)_bltx.xml\n  server: local\n  num_chunk: 7\n  sge: False\n'
+	if compress:
+		step += '  compress: True\n'
+	open(os.path.join(directory, 'step.yaml'), 'w').write(step)
+	# the contigs of the samples have the same names
+	for s in SAMPLES:
+		os.mkdir(os.path.join(directory, s))
+	write_samples(directory, [s + '/' + s + '_contigs.fa' for s in SAMPLES])
+
+
+def _run_step(directory):
+	subprocess.check_call([sys.executable, os.path.join(LAUNCHERS, 'virAnnot.py'), '-m', 'map.txt', '-s', 'step.yaml', '-p', 'params.yaml', '-n', 'Blast_nr'], cwd=directory)
+	return [iterations(os.path.join(directory, s, s + '_bltx.xml')) for s in SAMPLES]
+
+
+def test_pooled_step_gives_each_sample_its_results(tmp_path, fake_bin):
+	for compress in [False, True]:
+		runs = {}
+		for pooled in [False, True]:
+			directory = str(tmp_path / ('run_%s_%s' % (pooled, compress)))
+			os.mkdir(directory)
+			_write_run(directory, pooled, compress)
+			runs[pooled] = _run_step(directory)
+		# -r writes the results of a run per sample in chunk order
+		assert [sorted(r) for r in runs[True]] == [sorted(r) for r in runs[False]]
+		for s, results in zip(SAMPLES, runs[True]):
+			ref = str(tmp_path / 'ref.xml')
+			subprocess.check_call(['blastx', '-query', os.path.join(directory, s, s + '_contigs.fa'), '-out', ref, '-outfmt', '5', '-parse_deflines'])
+			assert results == iterations(ref)
+
+
+def test_dry_run_does_not_send_the_contigs(tmp_path, fake_bin):
+	directory = str(tmp_path)
+	_write_run(directory, False, False)
+	subprocess.check_call([sys.executable, os.path.join(LAUNCHERS, 'virAnnot.py'), '-m', 'map.txt', '-s', 'step.yaml', '-p', 'params.yaml', '-n', 'Blast_nr', '-v', '3'], cwd=directory)
+	subprocess.check_call([sys.executable, os.path.join(LAUNCHERS, 'virAnnot.py'), '-m', 'map.txt', '-s', 'step.yaml', '-p', 'params.yaml', '-n', 'all', '-v', '3'], cwd=directory)
+	assert not os.path.exists(os.path.join(directory, 'scratch'))
+	assert not os.path.exists(os.path.join(directory, '.virAnnot'))
+	for s in SAMPLES:
+		assert not os.path.exists(os.path.join(directory, s, s + '_contigs.fa.sent'))
+
+
+def test_rerun_starts_from_a_clean_directory(tmp_path, fake_bin):
+	directory = str(tmp_path)
+	_write_run(directory, False, False)
+	_run_step(directory)
+	scratch = os.path.join(directory, 'scratch')
+	run_dir = [d for d in os.listdir(scratch) if d.endswith('_S1_blastx')][0]
+	# chunk files of an earlier run, e.g. the exit codes of its array tasks
+	stale = os.path.join(scratch, run_dir, run_dir + '_split', 'group_99.exit')
+	open(stale, 'w').write('0\n')
+	contigs = os.path.join(directory, 'S1', 'S1_contigs.fa')
+	records = open(contigs).read().split('>')[1:]
+	open(contigs, 'w').write(''.join(['>' + r for r in records[:len(records) // 2]]))
+	results = _run_step(directory)
+	assert not os.path.exists(stale)
+	ref = str(tmp_path / 'ref.xml')
+	subprocess.check_call(['blastx', '-query', contigs, '-out', ref, '-outfmt', '5', '-parse_deflines'])
+	assert sorted(results[0]) == sorted(iterations(ref))
+
+
+def test_samples_with_different_options_are_not_pooled(tmp_path, fake_bin):
+	directory = str(tmp_path)
+	_write_run(directory, True, False)
+	# the database of each sample comes from the map file
+	open(os.path.join(directory, 'map.txt'), 'w').write('#SampleID\tfile\tdb\n' + ''.join([s + '\tx\t' + db + '\n' for s, db in zip(SAMPLES, ['nr', 'nr', 'nt'])]))
+	step = open(os.path.join(directory, 'step.yaml')).read().replace('db: nr', 'db: (db)')
+	open(os.path.join(directory, 'step.yaml'), 'w').write(step)
+	subprocess.call([sys.executable, os.path.join(LAUNCHERS, 'virAnnot.py'), '-m', 'map.txt', '-s', 'step.yaml', '-p', 'params.yaml', '-n', 'Blast_nr'], cwd=directory)
+	assert not os.path.exists(os.path.join(directory, 'scratch'))
+	for s in SAMPLES:
+		assert not os.path.exists(os.path.join(directory, s, s + '_bltx.xml'))
+
+
+def test_plan_and_init_write_nothing(tmp_path, fake_bin):
+	directory = str(tmp_path)
+	_write_run(directory, True, False)
+	subprocess.check_call([sys.executable, os.path.join(LAUNCHERS, 'virAnnot.py'), '-m', 'map.txt', '-s', 'step.yaml', '-p', 'params.yaml', '-n', 'Blast_nr', '--plan'], cwd=directory)
+	open(os.path.join(directory, 'init.txt'), 'w').write('#SampleID\tfile\nS4\tS4.fq\n')
+	open(os.path.join(directory, 'S4.fq'), 'w').write('')
+	subprocess.check_call([sys.executable, os.path.join(LAUNCHERS, 'virAnnot.py'), '-m', 'init.txt', '-s', 'step.yaml', '-p', 'params.yaml', '-n', 'init'], cwd=directory)
+	assert os.path.exists(os.path.join(directory, 'S4', 'S4.fq'))
+	assert not os.path.exists(os.path.join(directory, '.virAnnot'))
+
+
+def test_only_pooled_blast_steps_get_the_out_of_each_sample():
+	maps = [{'SampleID': 'S1'}, {'SampleID': 'S2'}]
+	steps = {'Blast_nr': {'contigs': '(SampleID)_contigs.fa', 'out': '(SampleID)_bltx.xml', 'iter': 'global'},
+		'Ecsv2excel': {'b1': '(SampleID)_bltx.csv', 'out': 'blast.xlsx', 'iter': 'global'}}
+	blast = virAnnot._step_args('Blast_nr', steps, maps, {}, 'Blast')[0][1]
+	assert [blast['args'][s]['out'] for s in ['S1', 'S2']] == ['S1_bltx.xml', 'S2_bltx.xml']
+	other = virAnnot._step_args('Ecsv2excel', steps, maps, {}, 'Ecsv2excel')[0][1]
+	assert other['out'] == 'blast.xlsx'
+	assert other['args'] == {'S1': {'b1': 'S1_bltx.csv'}, 'S2': {'b1': 'S2_bltx.csv'}}
@@ -0,0 +1,123 @@
+"""
+This module is a part of the virAnnot module
+Tests of the retries and speculative runs of the BLAST chunks of a cluster
+run, against the fake scheduler of the job monitor tests.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+import os
+import sys
+import time
+
+import pytest
+
+from conftest import LAUNCHERS, fake_scheduler
+
+sys.path.insert(0, LAUNCHERS)
+
+import blast_launch
+from blast_launch import ChunkTracker
+from job_monitor import JobMonitor
+
+
+class FakeCluster:
+	"""
+	Submission and cancellation of the chunk tasks: each submission is a
+	job running its tasks at once, as given by outcomes[chunk] for each
+	attempt (ok by default): ok, fail (exit code 1), hang (started long
+	ago, still running) or lost (no exit code, job in error with sge).
+	"""
+
+	def __init__(self, directory, scheduler, outcomes):
+		self.directory = directory
+		self.o_d = str(directory / 'split')
+		self.scheduler = scheduler
+		self.outcomes = outcomes
+		self.events = []
+		self.next_job = 100
+		self.listed = {}
+
+	def submit(self, ids):
+		self.next_job += 1
+		jobid = str(self.next_job)
+		self.events.append(('submit', sorted(ids)))
+		for i in ids:
+			outcome = 'ok'
+			if self.outcomes.get(i):
+				outcome = self.outcomes[i].pop(0)
+			chunk = self.o_d + '/group_%i.' % i
+			if outcome == 'lost':
+				self._list(jobid, 'Eqw')
+				continue
+			open(chunk + 'start', 'w').write('%i\n' % (time.time() - 1000 * (outcome == 'hang')))
+			if outcome == 'hang':
+				self._list(jobid, 'r')
+			elif outcome == 'fail':
+				open(chunk + 'exit', 'w').write('1\n')
+			else:
+				open(chunk + 'm8', 'w').write('q%i\thit\t99\n' % i)
+				open(chunk + 'time', 'w').write('5\n')
+				open(chunk + 'exit', 'w').write('0\n')
+		if jobid not in self.listed:
+			(self.directory / ('acct_' + jobid)).write_text({'sge': 'exit_status 0\n', 'slurm': 'COMPLETED\n'}[self.scheduler])
+		self._write()
+		return {jobid: sorted(ids)}
+
+	def cancel(self, jobid, ids):
+		self.events.append(('cancel', jobid, sorted(ids)))
+		self.listed.pop(jobid, None)
+		self._write()
+
+	def _list(self, jobid, state):
+		if self.scheduler == 'slurm':
+			state = {'r': 'RUNNING', 'Eqw': 'PENDING'}[state]
+		self.listed[jobid] = state
+
+	def _write(self):
+		if self.scheduler == 'sge':
+			lines = [j + ' 0.5 blast me ' + self.listed[j] + ' 01/01/2020 1 1\n' for j in sorted(self.listed)]
+		else:
+			lines = [j + ' ' + self.listed[j] + '\n' for j in sorted(self.listed)]
+		(self.directory / 'out').write_text(''.join(lines))
+
+
+def _tracker(tmp_path, monkeypatch, outcomes, scheduler='slurm', retries=2, speculate=None):
+	monkeypatch.setattr(blast_launch.time, 'sleep', lambda interval: None)
+	cluster = FakeCluster(tmp_path, scheduler, outcomes)
+	os.mkdir(cluster.o_d)
+	for i in range(1, 4):
+		open(cluster.o_d + '/group_%i.fa' % i, 'w').write(''.join(['>c%i_%i\n%s\n' % (i, j, 'ACGT' * (j + 1)) for j in range(4)]))
+	monitor = JobMonitor(scheduler, interval=1, command=fake_scheduler(tmp_path, []), user='me', accounting=str(tmp_path / 'sacct'))
+	tracker = ChunkTracker(cluster.o_d, 3, 6, cluster.submit, cluster.cancel, monitor, retries, speculate)
+	return tracker, cluster
+
+
+def _results(cluster, chunks):
+	return [cluster.o_d + '/group_%i.m8' % i for i in chunks]
+
+
+def test_failed_chunk_is_submitted_again(tmp_path, monkeypatch):
+	tracker, cluster = _tracker(tmp_path, monkeypatch, {2: ['fail', 'ok']})
+	assert tracker.run() == _results(cluster, [1, 2, 3])
+	assert cluster.events == [('submit', [1, 2, 3]), ('submit', [2])]
+
+
+def test_chunk_failing_every_attempt_stops_the_run(tmp_path, monkeypatch):
+	tracker, cluster = _tracker(tmp_path, monkeypatch, {2: ['fail', 'fail'], 3: ['hang']}, retries=1)
+	with pytest.raises(ValueError):
+		tracker.run()
+	# the running chunk 3 is cancelled with the run
+	assert cluster.events == [('submit', [1, 2, 3]), ('submit', [2]), ('cancel', '101', [3])]
+
+
+def test_task_in_error_is_deleted_before_it_is_submitted_again(tmp_path, monkeypatch):
+	tracker, cluster = _tracker(tmp_path, monkeypatch, {2: ['lost', 'ok']}, scheduler='sge')
+	assert tracker.run() == _results(cluster, [1, 2, 3])
+	assert cluster.events == [('submit', [1, 2, 3]), ('cancel', '101', [2]), ('submit', [2])]
+
+
+def test_straggler_is_raced_by_its_halves(tmp_path, monkeypatch):
+	tracker, cluster = _tracker(tmp_path, monkeypatch, {3: ['hang']}, speculate=2)
+	assert tracker.run() == _results(cluster, [1, 2, 4, 5])
+	assert cluster.events == [('submit', [1, 2, 3]), ('submit', [4, 5]), ('cancel', '101', [3])]
+	halves = [open(cluster.o_d + '/group_%i.fa' % i).read() for i in [4, 5]]
+	assert ''.join(halves) == open(cluster.o_d + '/group_3.fa').read()
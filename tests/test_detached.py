@@ -0,0 +1,59 @@
+"""
+This module is a part of the virAnnot module
+Test of the detached Blast runs and of their collect on a local server.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+import os
+import subprocess
+import sys
+import time
+
+from conftest import LAUNCHERS, iterations, write_samples
+
+
+def _virannot(directory, step, verbosity='1'):
+	subprocess.check_call([sys.executable, os.path.join(LAUNCHERS, 'virAnnot.py'), '-m', 'map.txt', '-s', 'step.yaml', '-p', 'params.yaml', '-n', step, '-v', verbosity], cwd=directory)
+
+
+def _write_run(directory, steps=''):
+	open(os.path.join(directory, 'map.txt'), 'w').write('#SampleID\tfile\nS1\tx\nS2\tx\n')
+	open(os.path.join(directory, 'params.yaml'), 'w').write(
+		'servers:\n  local:\n    transport: local\n    scratch: ' + os.path.join(directory, 'scratch') + '\n    username: me\n    db:\n      nr: nr\n')
+	open(os.path.join(directory, 'step.yaml'), 'w').write(
+		'Blast_nr:\n  type: blastx\n  contigs: (SampleID)_contigs.fa\n  db: nr\n  out: (SampleID)_bltx.xml\n  server: local\n  num_chunk: 7\n  sge: False\n  detach: True\n' + steps)
+	for s in ['S1', 'S2']:
+		os.mkdir(os.path.join(directory, s))
+	write_samples(directory, ['S1/S1_contigs.fa', 'S2/S2_contigs.fa'])
+
+
+def test_collect_fetches_the_detached_runs(tmp_path, fake_bin):
+	directory = str(tmp_path)
+	_write_run(directory)
+	state = os.path.join(directory, '.virAnnot', 'detached')
+	_virannot(directory, 'Blast_nr')
+	records = sorted(os.listdir(state))
+	assert len([f for f in records if f.endswith('.job')]) == 2
+	# a dry run of the step creates the launchers again without touching the records
+	_virannot(directory, 'Blast_nr', '3')
+	assert sorted(os.listdir(state)) == records
+	# a launch before the collect does not replace the runs
+	jobs = [open(os.path.join(state, f)).read() for f in records if f.endswith('.job')]
+	_virannot(directory, 'Blast_nr')
+	assert [open(os.path.join(state, f)).read() for f in records if f.endswith('.job')] == jobs
+	for i in range(60):
+		_virannot(directory, 'collect')
+		if not [f for f in os.listdir(state) if f.endswith('.job')]:
+			break
+		time.sleep(1)
+	for s in ['S1', 'S2']:
+		ref = os.path.join(directory, 'ref.xml')
+		subprocess.check_call(['blastx', '-query', os.path.join(directory, s, s + '_contigs.fa'), '-out', ref, '-outfmt', '5', '-parse_deflines'])
+		assert sorted(iterations(os.path.join(directory, s, s + '_bltx.xml'))) == sorted(iterations(ref))
+
+
+def test_all_refuses_a_detached_step_needed_later(tmp_path, fake_bin):
+	directory = str(tmp_path)
+	_write_run(directory, 'Blast2ecsv_nr:\n  contigs: (SampleID)_contigs.fa\n  b: (SampleID)_bltx.xml\n  out: (SampleID)_bltx.csv\n  sge: False\n')
+	_virannot(directory, 'all')
+	assert not os.path.exists(os.path.join(directory, '.virAnnot', 'detached'))
+	assert not os.path.exists(os.path.join(directory, 'scratch'))
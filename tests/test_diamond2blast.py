@@ -0,0 +1,43 @@
+"""
+This module is a part of the virAnnot module
+Tests of the selection of the Diamond2blast queries from an ecsv file.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+import sys
+
+from conftest import LAUNCHERS
+
+sys.path.insert(0, LAUNCHERS)
+
+from Diamond2blast import Diamond2blast
+
+ECSV = ('#"query_id"\t"tax_id"\t"taxonomy"\n'
+	'"c1"\t"1"\t"Viruses;Tombusviridae"\n'
+	'"c2"\t"2"\t"Bacteria;Proteobacteria"\n'
+	'"c3"\t"3"\t"Viruses;Potyviridae"\n')
+
+
+def _selection(tmp_path, ecsv, contigs=None):
+	d2b = Diamond2blast.__new__(Diamond2blast)
+	d2b.sample = 'S1'
+	d2b.type = 'blastx'
+	d2b.taxonomy = ['Viruses']
+	d2b.exclude_taxonomy = []
+	d2b.i = str(tmp_path / 'S1.csv')
+	d2b.icontigs = str(tmp_path / 'S1_contigs.fa')
+	d2b.contigs = str(tmp_path / 'S1_selected.fa')
+	open(d2b.i, 'w').write(ecsv)
+	if contigs is not None:
+		open(d2b.icontigs, 'w').write(contigs)
+	d2b.csv_to_fasta()
+	return open(d2b.contigs).read()
+
+
+def test_blast2ecsv_header_is_read(tmp_path):
+	contigs = '>c1\nACGT\n>c2\nGGGG\n>c3\nTTTT\n'
+	assert _selection(tmp_path, ECSV, contigs) == '>c1\nACGT\n>c3\nTTTT\n'
+
+
+def test_available_sequences_are_written_without_contigs(tmp_path):
+	ecsv = ECSV.replace('"taxonomy"\n', '"taxonomy"\t"sequence"\n').replace('Tombusviridae"\n', 'Tombusviridae"\t"ACGT"\n')
+	assert _selection(tmp_path, ecsv) == '>c1\nACGT\n'
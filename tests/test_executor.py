@@ -0,0 +1,79 @@
+"""
+This module is a part of the virAnnot module
+Tests of the scheduling of the nodes of -n all by the executor.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+import functools
+import sys
+
+from conftest import LAUNCHERS
+
+sys.path.insert(0, LAUNCHERS)
+
+import virAnnot
+from executor import LocalExecutor
+
+
+def _node(name, cmds, cluster, deps=()):
+	return (name, list(deps), lambda: (cmds, '1', None, cluster))
+
+
+def test_cluster_jobs_do_not_use_the_local_cores(tmp_path):
+	# each cluster job waits for the other one: they only end if they run together
+	a = str(tmp_path / 'a')
+	b = str(tmp_path / 'b')
+	wait = 'touch %s; for i in $(seq 50); do [ -f %s ] && exit 0; sleep 0.1; done; exit 1'
+	ex = LocalExecutor(1, cluster_jobs=2)
+	nodes = [_node('A', [wait % (a, b)], True), _node('B', [wait % (b, a)], True),
+		_node('C', ['test -f ' + a], False, ['A', 'B'])]
+	assert ex.run_graph(nodes) == []
+	ex.shutdown()
+
+
+def test_failed_dependency_skips_the_node(tmp_path):
+	ex = LocalExecutor(1, cluster_jobs=2)
+	nodes = [_node('A', ['false'], True), _node('B', ['true'], False, ['A'])]
+	assert ex.run_graph(nodes) == ['A', 'B']
+	ex.shutdown()
+
+
+def test_failed_preparation_only_skips_the_dependents(tmp_path):
+	def broken():
+		raise IOError('cannot write the command file')
+	ex = LocalExecutor(1, cluster_jobs=2)
+	nodes = [('A', [], broken), _node('B', ['true'], False, ['A']), _node('C', ['touch ' + str(tmp_path / 'c')], False)]
+	assert ex.run_graph(nodes) == ['A', 'B']
+	assert (tmp_path / 'c').exists()
+	ex.shutdown()
+
+
+def test_skipped_module_does_not_skip_the_dependents(monkeypatch):
+	class Skipped:
+		execution = 0
+	monkeypatch.setattr(virAnnot, '_create_module', lambda name, args: Skipped())
+	ex = LocalExecutor(1)
+	nodes = [('A', [], functools.partial(virAnnot._prepare_node, {}, 'Blast', None, 'A')), _node('B', ['true'], False, ['A'])]
+	assert ex.run_graph(nodes) == []
+	ex.shutdown()
+
+
+class _Graph:
+	report = None
+
+	def run_graph(self, nodes):
+		self.nodes = nodes
+		return []
+
+
+def test_inputs_not_declared_by_a_previous_step_are_warned_about(tmp_path, monkeypatch, caplog):
+	monkeypatch.chdir(tmp_path)
+	maps = [{'SampleID': 'S1'}]
+	steps = {'Map_a': {'contigs': '(SampleID)_contigs.fa', 'out': '(SampleID)_a.rn'},
+		'Normalization': {'i1': '(SampleID)_truePairs_r1.fq', 'o1': '(SampleID)_norm_r1.fq', 'iter': 'sample'},
+		'Blast2ecsv': {'rn': '(SampleID)_a.rn', 'out': '(SampleID)_a.csv'}}
+	ex = _Graph()
+	virAnnot._launch_all(list(steps), steps, maps, {}, ex, None)
+	assert [(name, deps) for name, deps, prepare in ex.nodes] == [('Map_a/S1', []), ('Normalization/S1', []), ('Blast2ecsv/S1', ['Map_a/S1'])]
+	warnings = [r.getMessage() for r in caplog.records if r.levelname == 'WARNING']
+	assert len(warnings) == 1
+	assert warnings[0].startswith('Normalization does not wait') and 'S1_truePairs_r1.fq' in warnings[0]
@@ -0,0 +1,88 @@
+"""
+This module is a part of the virAnnot module
+Tests of the job monitor against a fake scheduler script.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+import sys
+
+from conftest import LAUNCHERS, fake_scheduler
+
+sys.path.insert(0, LAUNCHERS)
+
+import job_monitor
+from job_monitor import JobMonitor
+
+def test_monitor_follows_the_jobs_with_one_query_per_poll(tmp_path, monkeypatch):
+	sleeps = []
+	monkeypatch.setattr(job_monitor.time, 'sleep', sleeps.append)
+	waiting = '11 PENDING\n12_[1-3] RUNNING\n'
+	command = fake_scheduler(tmp_path, [waiting] * 5 + ['11 RUNNING\n12_1 RUNNING\n', ''], {'11': 'COMPLETED\n', '12': 'COMPLETED\n' * 3, '13': 'COMPLETED\n'})
+	changes = []
+	monitor = JobMonitor('slurm', interval=1, max_interval=4, factor=2, command=command, accounting=str(tmp_path / 'sacct'))
+	for jobid in ['11', '12', '13']:
+		monitor.watch(jobid, lambda jobid, old, new: changes.append((jobid, old, new)))
+	assert monitor.wait() == {'11': 'done', '12': 'done', '13': 'done'}
+	calls = (tmp_path / 'calls').read_text().splitlines()
+	assert len(calls) == 7
+	assert calls[0] == '--noheader --format=%i %T --jobs 11,12,13'
+	# 13, never listed, is done once the accounting says so after MISSES queries
+	assert calls[2] == '--noheader --format=%i %T --jobs 11,12'
+	# 11 and 12 left the queue, the accounting tells how they ended
+	assert (tmp_path / 'accounting_calls').read_text().splitlines() == ['--noheader --allocations --format=State --jobs ' + j for j in ['13', '11', '12']]
+	# the interval doubles while nothing changes, up to max_interval
+	assert sleeps == [1, 1, 2, 4, 4, 1]
+	assert [c for c in changes if c[0] == '11'] == [('11', 'submitted', 'pending'), ('11', 'pending', 'running'), ('11', 'running', 'done')]
+	assert [c for c in changes if c[0] == '12'] == [('12', 'submitted', 'running'), ('12', 'running', 'done')]
+	assert [c for c in changes if c[0] == '13'] == [('13', 'submitted', 'done')]
+
+
+def test_monitor_reads_qstat(tmp_path, monkeypatch):
+	monkeypatch.setattr(job_monitor.time, 'sleep', lambda interval: None)
+	header = 'job-ID prior name user state submit/start at queue slots ja-task-ID\n' + '-' * 20 + '\n'
+	command = fake_scheduler(tmp_path, [header + '21 0.5 b me r 01/01/2020 q 1 1\n22 0.5 b me qw 01/01/2020 1 1\n',
+		header + '22 0.5 b me Eqw 01/01/2020 1 1\n'], {'21': 'failed 0\nexit_status 0\n'})
+	monitor = JobMonitor('sge', interval=1, command=command, user='me', accounting=str(tmp_path / 'sacct'))
+	monitor.watch('21')
+	monitor.watch('22')
+	assert monitor.wait() == {'21': 'done', '22': 'error'}
+	assert (tmp_path / 'calls').read_text().splitlines() == ['-u me', '-u me']
+
+
+def test_job_never_listed_waits_for_the_accounting(tmp_path, monkeypatch):
+	monkeypatch.setattr(job_monitor.time, 'sleep', lambda interval: None)
+	# 31 shows up late, 32 ended before the first query and failed
+	command = fake_scheduler(tmp_path, ['', '', '', '31 RUNNING\n', ''], {'31_1': '', '31_2': '', '31': 'COMPLETED\n', '32': 'COMPLETED\nFAILED\n'})
+	changes = []
+	monitor = JobMonitor('slurm', interval=1, command=command, accounting=str(tmp_path / 'sacct'))
+	for jobid in ['31', '32']:
+		monitor.watch(jobid, lambda jobid, old, new: changes.append((jobid, old, new)))
+	assert monitor.wait() == {'31': 'done', '32': 'error'}
+	assert [c for c in changes if c[0] == '31'] == [('31', 'submitted', 'running'), ('31', 'running', 'done')]
+
+
+def test_job_leaving_the_queue_gets_its_state_from_the_accounting(tmp_path, monkeypatch):
+	monkeypatch.setattr(job_monitor.time, 'sleep', lambda interval: None)
+	# 51 is killed by the scheduler, 52 has no accounting record
+	running = '51 0.5 b me r 01/01/2020 q 1 1\n52 0.5 b me r 01/01/2020 q 1 1\n'
+	command = fake_scheduler(tmp_path, [running, ''], {'51': 'failed 100 : assumedly after job\nexit_status 137\n'})
+	monitor = JobMonitor('sge', interval=1, command=command, user='me', accounting=str(tmp_path / 'sacct'))
+	monitor.watch('51')
+	monitor.watch('52')
+	assert monitor.wait() == {'51': 'error', '52': 'done'}
+	# 52 is done after MISSES queries without record
+	assert len((tmp_path / 'calls').read_text().splitlines()) == 1 + job_monitor.MISSES
+
+
+def test_monitors_sharing_a_directory_share_the_queries(tmp_path):
+	command = fake_scheduler(tmp_path, ['41 RUNNING\n', '41 RUNNING\n42 PENDING\n'])
+	shared = str(tmp_path / 'shared')
+	monitors = [JobMonitor('slurm', interval=1000, command=command, shared=shared) for i in range(2)]
+	monitors[0].watch('41')
+	monitors[1].watch('42')
+	for i in range(3):
+		for monitor in monitors:
+			monitor.poll()
+	# the second monitor adds its job to the query, then both read it
+	assert (tmp_path / 'calls').read_text().splitlines() == ['--noheader --format=%i %T --jobs 41', '--noheader --format=%i %T --jobs 41,42']
+	assert monitors[0].jobs == {'41': 'running'}
+	assert monitors[1].jobs == {'42': 'pending'}
@@ -0,0 +1,101 @@
+"""
+This module is a part of the virAnnot module
+Tests of the run journal: a killed driver resumed with -r, job array tasks.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+import os
+import subprocess
+import sys
+
+from conftest import LAUNCHERS
+
+sys.path.insert(0, LAUNCHERS)
+
+from job_array import JobArray
+from journal import Journal
+
+# runs the commands given after the journal path as one job, with resume
+DRIVER = r"""
+import sys
+sys.path.insert(0, sys.argv[1])
+from executor import LocalExecutor
+from journal import Journal
+journal = Journal(sys.argv[2])
+ex = LocalExecutor(1, journal=journal, resume=True)
+ex.submit('Step/S1', sys.argv[3:])
+print(ex.wait())
+ex.shutdown()
+journal.close()
+"""
+
+
+def _states(path, job):
+	journal = Journal(path)
+	states = [row[0] for row in journal.conn.execute('SELECT state FROM command WHERE job = ? ORDER BY position', (job,))]
+	journal.close()
+	return states
+
+
+def test_killed_driver_resumes_after_the_commands_done(tmp_path):
+	path = str(tmp_path / '.virAnnot' / 'journal.sqlite')
+	# the second command kills the driver until resumed exists
+	cmds = ['echo a >> log', '[ -f resumed ] || kill -9 $PPID', 'echo c >> log']
+	driver = [sys.executable, '-c', DRIVER, LAUNCHERS, path] + cmds
+	assert subprocess.call(driver, cwd=str(tmp_path)) != 0
+	assert _states(path, 'Step/S1') == ['done', 'running', 'pending']
+	(tmp_path / 'resumed').write_text('')
+	assert subprocess.call(driver, cwd=str(tmp_path)) == 0
+	assert _states(path, 'Step/S1') == ['done', 'done', 'done']
+	# the first command did not run again
+	assert (tmp_path / 'log').read_text() == 'a\nc\n'
+
+
+def _run_tasks(arr):
+	# the array script run for each task, as the scheduler would
+	arr.write()
+	for i in range(len(arr.tasks)):
+		env = dict(os.environ, SGE_TASK_ID=str(i + 1))
+		subprocess.call(['sh', arr.script], env=env)
+
+
+def test_array_tasks_get_the_exit_code_of_their_task(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	path = str(tmp_path / 'journal.sqlite')
+	journal = Journal(path)
+	cmds = {'S1': ['true'], 'S2': ['echo S2 >> ../log', 'test -f ../fixed']}
+	for resume in [False, True]:
+		arr = JobArray('Step', 'sge', journal=journal, resume=resume)
+		for s in sorted(cmds):
+			if not os.path.exists(s):
+				os.mkdir(s)
+			first = arr.add(s, s + '/cmd.txt', 1, 'Step/' + s, cmds[s])
+			if first < len(cmds[s]):
+				open(s + '/cmd.txt', 'w').write(''.join([c + '\n' for c in cmds[s][first:]]))
+		arr.started()
+		assert [t[2] for t in arr.tasks] == [['Step/S1', 'Step/S2'], ['Step/S2']][resume]
+		_run_tasks(arr)
+		if not resume:
+			assert arr.collect() == ['Step/S2']
+			assert _states(path, 'Step/S2') == ['failed', 'failed']
+			(tmp_path / 'fixed').write_text('')
+		else:
+			assert arr.collect() == []
+	assert _states(path, 'Step/S1') == ['done']
+	assert _states(path, 'Step/S2') == ['done', 'done']
+	journal.close()
+
+
+def test_array_not_waited_for_is_journaled_on_resume(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	journal = Journal(str(tmp_path / 'journal.sqlite'))
+	os.mkdir('S1')
+	open('S1/cmd.txt', 'w').write('true\n')
+	arr = JobArray('Step', 'sge', journal=journal)
+	arr.add('S1', 'S1/cmd.txt', 1, 'Step/S1', ['true'])
+	arr.started()
+	_run_tasks(arr)
+	# the next run finds the exit code of the task and does not add it again
+	arr = JobArray('Step', 'sge', journal=journal, resume=True)
+	assert arr.add('S1', 'S1/cmd.txt', 1, 'Step/S1', ['true']) == 1
+	assert arr.tasks == []
+	journal.close()
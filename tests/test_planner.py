@@ -0,0 +1,62 @@
+"""
+This module is a part of the virAnnot module
+Tests of the run plan learned from the run reports.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+import sys
+
+from conftest import LAUNCHERS
+
+sys.path.insert(0, LAUNCHERS)
+
+from planner import Planner, load_history
+from report import RunReport
+
+SETTINGS = {'n_cpu': 1, 'sge': False, 'num_chunk': None, 'tc': None, 'chunk_cpu': None}
+
+
+def _fasta(path, n, length):
+	path.write_text(''.join(['>s%i\n%s\n' % (i, 'A' * length) for i in range(n)]))
+	return str(path)
+
+
+def _usage(cpu):
+	return {'wall': cpu, 'user': cpu, 'sys': 0, 'max_rss': 1024, 'read_bytes': 0, 'write_bytes': 0}
+
+
+def test_new_samples_are_planned_from_the_history_of_others(tmp_path):
+	# a previous run of samples A and B: 10 core seconds per 1000 bases
+	report = RunReport()
+	for name, n in [('A', 10), ('B', 30)]:
+		contigs = _fasta(tmp_path / (name + '.fa'), n, 100)
+		out = tmp_path / (name + '.rn')
+		out.write_text('x' * n)
+		report.add_job('Map_idba/' + name, 'Map', [contigs], [str(out)], SETTINGS)
+		report.add('Map_idba/' + name, 0, 'bowtie2 ' + contigs, 1, 0, _usage(n))
+	report.write(str(tmp_path / 'reports' / 'run_1'))
+	# the inputs of the previous run are gone, the new batch has other samples
+	for name in ['A', 'B']:
+		(tmp_path / (name + '.fa')).unlink()
+	planner = Planner(load_history(str(tmp_path / 'reports')))
+	for name, n in [('C', 100), ('D', 260)]:
+		planner.add('Map_idba', 'Map', 'Map_idba/' + name, [_fasta(tmp_path / (name + '.fa'), n, 100)], [], SETTINGS)
+	row = planner.table()[0]
+	assert row['bases'] == 36000
+	assert row['history'] == 2
+	assert row['core_h'] == round(360 / 3600, 2)
+	assert row['wall_h'] == round(260 / 3600, 2)
+	assert row['disk_gb'] == round(360 / 1024 ** 3, 2)
+
+
+def test_step_without_history_of_the_unit_is_not_estimated(tmp_path):
+	report = RunReport()
+	contigs = _fasta(tmp_path / 'A.fa', 10, 100)
+	report.add_job('Map_idba/A', 'Map', [contigs], [], SETTINGS)
+	report.add('Map_idba/A', 0, 'bowtie2 ' + contigs, 1, 0, _usage(10))
+	report.write(str(tmp_path / 'reports' / 'run_1'))
+	planner = Planner(load_history(str(tmp_path / 'reports')))
+	# a job without sequence input is measured in bytes
+	other = tmp_path / 'table.tsv'
+	other.write_text('x' * 100)
+	planner.add('Map_idba', 'Map', 'Map_idba/B', [str(other)], [], SETTINGS)
+	assert planner.table()[0]['core_h'] is None
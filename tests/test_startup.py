@@ -0,0 +1,21 @@
+"""
+This module is a part of the virAnnot module
+Regression check of the startup of virAnnot.py: no heavy dependency is
+imported before a step needs it.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'startup.py')
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='-X importtime needs python 3.7 or later')
+def test_startup_imports_no_heavy_module():
+	run = subprocess.run([sys.executable, BENCHMARK, '--repeat', '1', '--top', '0'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	output = run.stdout.decode('utf-8')
+	assert run.returncode == 0, output
+	assert 'launchers_ms' in output
@@ -0,0 +1,50 @@
+"""
+This module is a part of the virAnnot module
+Tests of the checks of the files sent to the content store.
+Authors: Sebastien Theil, Marie Lefebvre
+"""
+import hashlib
+import os
+import subprocess
+import sys
+
+from conftest import LAUNCHERS
+
+sys.path.insert(0, LAUNCHERS)
+
+from transport import link_stored
+
+
+def _link(tmp_path, content):
+	# the scratch directory received contigs.fa, expected with content
+	path = str(tmp_path / 'store' / hashlib.md5(content).hexdigest())
+	(tmp_path / 'run').mkdir()
+	script = tmp_path / 'link.sh'
+	script.write_text(link_stored(['/local/contigs.fa'], {'/local/contigs.fa': path}, 'run'))
+	return subprocess.call(['bash', str(script)], cwd=str(tmp_path), stderr=subprocess.DEVNULL), path
+
+
+def test_checked_file_is_stored_and_linked(tmp_path):
+	(tmp_path / 'contigs.fa').write_bytes(b'>c\nACGT\n')
+	status, path = _link(tmp_path, b'>c\nACGT\n')
+	assert status == 0
+	assert os.path.realpath(str(tmp_path / 'run' / 'contigs.fa')) == path
+
+
+def test_corrupted_upload_is_not_linked(tmp_path):
+	(tmp_path / 'contigs.fa').write_bytes(b'>c\nAC')
+	status, path = _link(tmp_path, b'>c\nACGT\n')
+	assert status == 1
+	assert not os.path.lexists(str(tmp_path / 'run' / 'contigs.fa'))
+	assert not os.path.exists(path)
+
+
+def test_stale_file_does_not_stop_a_stored_file(tmp_path):
+	# a failed earlier run left another contigs.fa in the scratch directory
+	(tmp_path / 'contigs.fa').write_bytes(b'>c\nAC')
+	(tmp_path / 'store').mkdir()
+	path = tmp_path / 'store' / hashlib.md5(b'>c\nACGT\n').hexdigest()
+	path.write_bytes(b'>c\nACGT\n')
+	status, path = _link(tmp_path, b'>c\nACGT\n')
+	assert status == 0
+	assert open(os.path.realpath(str(tmp_path / 'run' / 'contigs.fa')), 'rb').read() == b'>c\nACGT\n'
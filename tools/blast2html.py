@@ -5,6 +5,7 @@
 # License: GPL version 3 or higher
 
 import sys
+import subprocess
 import math
 from os import path
 from itertools import repeat
@@ -274,16 +275,32 @@ class BlastVisualize:
                        accession = hit.Hit_accession)
 
 
+def open_result(fn):
+    """
+    argparse type opening a BLAST XML result, through gzip or zstd when
+    its name ends with .gz or .zst
+    """
+    if fn.endswith('.gz'):
+        tool = 'gzip'
+    elif fn.endswith('.zst'):
+        tool = 'zstd'
+    else:
+        return argparse.FileType(mode='r')(fn)
+    if not path.isfile(fn):
+        raise argparse.ArgumentTypeError("can't open '{}'".format(fn))
+    return subprocess.Popen([tool, '-dc', fn], stdout=subprocess.PIPE).stdout
+
+
 def main():
     default_template = path.join(path.dirname(__file__), 'blast2html.html.jinja')
 
     parser = argparse.ArgumentParser(description="Convert a BLAST XML result into a nicely readable html page",
                                      usage="{} [-i] INPUT [-o OUTPUT]".format(sys.argv[0]))
     input_group = parser.add_mutually_exclusive_group(required=True)
-    input_group.add_argument('positional_arg', metavar='INPUT', nargs='?', type=argparse.FileType(mode='r'),
-                             help='The input Blast XML file, same as -i/--input')
-    input_group.add_argument('-i', '--input', type=argparse.FileType(mode='r'),
-                             help='The input Blast XML file')
+    input_group.add_argument('positional_arg', metavar='INPUT', nargs='?', type=open_result,
+                             help='The input Blast XML file, same as -i/--input, may be gzipped (.gz) or zstd-compressed (.zst)')
+    input_group.add_argument('-i', '--input', type=open_result,
+                             help='The input Blast XML file, may be gzipped (.gz) or zstd-compressed (.zst)')
     parser.add_argument('-o', '--output', type=argparse.FileType(mode='w'), default=sys.stdout,
                         help='The output html file')
     # We just want the file name here, so jinja can open the file
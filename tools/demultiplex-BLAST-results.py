@@ -7,6 +7,7 @@ __build__ = ""
 
 import optparse
 import sys, os
+import subprocess
 
 p = optparse.OptionParser(description = """demultiplex-BLAST-results: split a
 XML-formatted BLAST results file into multiple XML-formatted files based on
@@ -47,13 +48,25 @@ XPATH = re.compile("(?P<xpath>(?:query|hit|HSP)(?:\.[A-Z][A-Za-z_\-]+)+)")
 wrap_xpath = lambda x: XPATH.sub("cast(\g<xpath>)", x)
 
 
+# the input file, or its content when it is compressed (.gz or .zst)
+def read_input (fn):
+    if fn.endswith('.gz'):
+        return subprocess.check_output(['gzip', '-dc', fn])
+    if fn.endswith('.zst'):
+        return subprocess.check_output(['zstd', '-dc', fn])
+    return fn
+
 #:::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
 print('reading xml...')
 print(p.input_fn)
+try:
+    xml = read_input(p.input_fn)
+except subprocess.CalledProcessError as msg:
+    error(str(msg))
 try:
     # note that we do not validate the XML file against
     # http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd
-    i = bindery.parse(p.input_fn, standalone = True)
+    i = bindery.parse(xml, standalone = True)
 
 except amara.ReaderError as msg:
     error(str(msg))
@@ -62,7 +75,7 @@ n_queries = len(i.BlastOutput.BlastOutput_iterations.Iteration)
 print(str(n_queries) + ' queries read.')
 # create an envelop from the input XML BLAST
 # results containing only the header
-envelop = bindery.parse(p.input_fn, standalone = True)
+envelop = bindery.parse(xml, standalone = True)
 envelop.BlastOutput.BlastOutput_iterations = "\n"
 
 copy = lambda x: bindery.parse(x.xml_encode(), standalone = True)
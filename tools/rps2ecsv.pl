@@ -161,6 +161,13 @@ sub _check_overlapping_domains {
 sub _readInputFile {
 	my ($self,$file) = @_;
   $logger->debug('Reading input xml file.');
+	# gzip or zstd compressed results are read through a pipe
+	if($file =~ /\.gz$/){
+		$file = 'gzip -dc ' . $file . ' |';
+	}
+	elsif($file =~ /\.zst$/){
+		$file = 'zstd -dc ' . $file . ' |';
+	}
 	$self->{_searchioObj} = Bio::SearchIO->new(   '-file'   => $file,
 	'-format' => 'BLASTXML');
 	my @matches;